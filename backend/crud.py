@@ -1,9 +1,14 @@
+import bisect
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
 import models
 import schemas
-from playhouse.shortcuts import model_to_dict
+from database import db
+from services import cohorts, fieldsets, filters, gc_bias, pagination, qc, sample_wide, search, stats
 from typing import Optional
-from peewee import Expression
-import operator
+from peewee import JOIN, SQL, BlobField, BooleanField, DateField, DateTimeField, fn
 
 def create_user(user: schemas.UserCreate, hashed_password: str) -> models.User:
     """
@@ -35,229 +40,904 @@ def update_user_status(user_id: int, status: str):
         user.save()
     return user
 
-def upsert_reported_ages(ages_data: schemas.ReportedAgesSchema):
-    models.ReportedAges.insert(**ages_data.dict()).on_conflict(
-        conflict_target=[models.ReportedAges.sample],
-        update=ages_data.dict()
-    ).execute()
-
-def upsert_bs_rate(bs_rate_data: schemas.BsRateSchema):
-    models.BsRate.insert(**bs_rate_data.dict()).on_conflict(
-        conflict_target=[models.BsRate.sample],
-        update=bs_rate_data.dict()
-    ).execute()
-
-def upsert_coverage(coverage_data: schemas.CoverageSchema):
-    models.Coverage.insert(**coverage_data.dict()).on_conflict(
-        conflict_target=[models.Coverage.sample],
-        update=coverage_data.dict()
-    ).execute()
-
-def upsert_fastp(fastp_data: schemas.FastpSchema):
-    models.Fastp.insert(**fastp_data.dict()).on_conflict(
-        conflict_target=[models.Fastp.sample],
-        update=fastp_data.dict()
-    ).execute()
-
-def upsert_markdup(markdup_data: schemas.MarkdupSchema):
-    models.Markdup.insert(**markdup_data.dict()).on_conflict(
-        conflict_target=[models.Markdup.sample],
-        update=markdup_data.dict()
-    ).execute()
-
-def upsert_picard_alignment_summary(picard_alignment_summary_data: schemas.PicardAlignmentSummarySchema):
-    models.PicardAlignmentSummary.insert(**picard_alignment_summary_data.dict()).on_conflict(
-        conflict_target=[models.PicardAlignmentSummary.sample],
-        update=picard_alignment_summary_data.dict()
-    ).execute()
-
-def upsert_picard_gc_bias(picard_gc_bias_data: schemas.PicardGcBiasSchema):
-    models.PicardGcBias.insert(**picard_gc_bias_data.dict()).on_conflict(
-        conflict_target=[models.PicardGcBias.sample],
-        update=picard_gc_bias_data.dict()
-    ).execute()
-
-def upsert_picard_gc_bias_summary(picard_gc_bias_summary_data: schemas.PicardGcBiasSummarySchema):
-    models.PicardGcBiasSummary.insert(**picard_gc_bias_summary_data.dict()).on_conflict(
-        conflict_target=[models.PicardGcBiasSummary.sample],
-        update=picard_gc_bias_summary_data.dict()
-    ).execute()
-
-def upsert_picard_hs(picard_hs_data: schemas.PicardHsSchema):
-    models.PicardHs.insert(**picard_hs_data.dict()).on_conflict(
-        conflict_target=[models.PicardHs.sample],
-        update=picard_hs_data.dict()
-    ).execute()
-
-def upsert_picard_insert_size(picard_insert_size_data: schemas.PicardInsertSizeSchema):
-    models.PicardInsertSize.insert(**picard_insert_size_data.dict()).on_conflict(
-        conflict_target=[models.PicardInsertSize.sample],
-        update=picard_insert_size_data.dict()
-    ).execute()
-
-def upsert_picard_quality_yield(picard_quality_yield_data: schemas.PicardQualityYieldSchema):
-    models.PicardQualityYield.insert(**picard_quality_yield_data.dict()).on_conflict(
-        conflict_target=[models.PicardQualityYield.sample],
-        update=picard_quality_yield_data.dict()
-    ).execute()
-
-def upsert_screen(screen_data: schemas.ScreenSchema):
-    models.Screen.insert(**screen_data.dict()).on_conflict(
-        conflict_target=[models.Screen.sample],
-        update=screen_data.dict()
-    ).execute()
-
-import re
-
-def get_samples_by_search_term(search_term: str) -> list[str]:
-    search_terms = [term.strip() for term in search_term.split(',')]
-    
-    sample_query = None
-    ptid_query = None
-
-    for term in search_terms:
-        if term.endswith("*"):
-            prefix = term[:-1]
-            if re.match(r"CAP\d+", prefix):
-                if sample_query is None:
-                    sample_query = (models.ReportedAges.sample.startswith(prefix))
-                else:
-                    sample_query |= (models.ReportedAges.sample.startswith(prefix))
-            else:
-                if ptid_query is None:
-                    ptid_query = models.ReportedAges.ptid.startswith(prefix)
-                else:
-                    ptid_query |= models.ReportedAges.ptid.startswith(prefix)
-        else:
-            if re.match(r"CAP\d+", term):
-                if sample_query is None:
-                    sample_query = (models.ReportedAges.sample == term)
-                else:
-                    sample_query |= (models.ReportedAges.sample == term)
-            else:
-                if ptid_query is None:
-                    ptid_query = (models.ReportedAges.ptid == term)
-                else:
-                    ptid_query |= (models.ReportedAges.ptid == term)
-
-    final_query = None
-    if sample_query is not None:
-        final_query = sample_query
-    if ptid_query is not None:
-        if final_query is not None:
-            final_query |= ptid_query
+def _max_sql_variables() -> int:
+    """
+    Returns the bound-variable limit of the current SQLite connection.
+    """
+    try:
+        return db.connection().getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    except AttributeError:
+        # Connection.getlimit() needs Python 3.11; fall back to SQLite's historic default.
+        return 999
+
+# Sample lists up to this length are bound inline as IN (?, ?, ...); longer ones are
+# loaded once into a temporary table that every lookup of the request joins against.
+SAMPLE_LIST_INLINE_LIMIT = int(os.getenv("SAMPLE_LIST_INLINE_LIMIT", "1000"))
+
+@contextmanager
+def selected_samples(samples: list[str]):
+    """
+    Yields the argument for `model.sample.in_(...)` selecting samples: the list
+    itself when it is short, otherwise a subquery over the selected_sample
+    temporary table, filled for the duration of the block.
+    """
+    if len(samples) <= SAMPLE_LIST_INLINE_LIMIT:
+        yield samples
+        return
+    table_name = models.SelectedSample._meta.table_name
+    models.SelectedSample.create_table(safe=True)
+    with db.atomic():
+        models.SelectedSample.delete().execute()
+        # One prepared statement reused per row beats multi-row INSERTs for a single column.
+        db.cursor().executemany(f'INSERT OR IGNORE INTO "{table_name}" ("sample") VALUES (?)', [(sample,) for sample in samples])
+    try:
+        yield models.SelectedSample.select(models.SelectedSample.sample)
+    finally:
+        models.SelectedSample.delete().execute()
+
+def bulk_upsert(model, rows: list[dict], batch_size: int = 500) -> int:
+    """
+    Upserts rows into the model's table using multi-row INSERT ... ON CONFLICT statements.
+    Rows sharing a primary key with an existing row replace its non-key columns.
+    Callers are expected to wrap this in a transaction.
+    """
+    if not rows:
+        return 0
+
+    fields = [model._meta.fields[name] for name in rows[0].keys()]
+    conflict_target = list(model._meta.get_primary_keys())
+    # Compare by name: peewee overloads == on fields to build SQL expressions.
+    key_names = {field.name for field in conflict_target}
+    preserve = [field for field in fields if field.name not in key_names]
+
+    # Keep each statement under SQLite's bound-variable limit.
+    batch_size = max(1, min(batch_size, _max_sql_variables() // len(fields)))
+
+    for start in range(0, len(rows), batch_size):
+        batch = [tuple(row.values()) for row in rows[start:start + batch_size]]
+        query = model.insert_many(batch, fields=fields)
+        if preserve:
+            query = query.on_conflict(conflict_target=conflict_target, preserve=preserve)
         else:
-            final_query = ptid_query
-            
-    if final_query is not None:
-        samples = models.ReportedAges.select(models.ReportedAges.sample).where(final_query).distinct()
-        return [s.sample for s in samples]
-    
-    return []
-
-def get_data_by_samples(samples: list[str]):
-    if not samples:
-        return {
-            "ReportedAges": [], "BsRate": [], "Coverage": [], "Fastp": [],
-            "Markdup": [], "PicardAlignmentSummary": [], "PicardGcBias": [],
-            "PicardGcBiasSummary": [], "PicardHs": [], "PicardInsertSize": [],
-            "PicardQualityYield": [], "Screen": []
-        }
+            query = query.on_conflict_ignore()
+        query.execute()
+    return len(rows)
 
-    reported_ages = models.ReportedAges.select().where(models.ReportedAges.sample.in_(samples))
-    bs_rate = models.BsRate.select().where(models.BsRate.sample.in_(samples))
-    coverage = models.Coverage.select().where(models.Coverage.sample.in_(samples))
-    fastp = models.Fastp.select().where(models.Fastp.sample.in_(samples))
-    markdup = models.Markdup.select().where(models.Markdup.sample.in_(samples))
-    picard_alignment_summary = models.PicardAlignmentSummary.select().where(models.PicardAlignmentSummary.sample.in_(samples))
-    picard_gc_bias = models.PicardGcBias.select().where(models.PicardGcBias.sample.in_(samples))
-    picard_gc_bias_summary = models.PicardGcBiasSummary.select().where(models.PicardGcBiasSummary.sample.in_(samples))
-    picard_hs = models.PicardHs.select().where(models.PicardHs.sample.in_(samples))
-    picard_insert_size = models.PicardInsertSize.select().where(models.PicardInsertSize.sample.in_(samples))
-    picard_quality_yield = models.PicardQualityYield.select().where(models.PicardQualityYield.sample.in_(samples))
-    screen = models.Screen.select().where(models.Screen.sample.in_(samples))
-    
-    return {
-        "ReportedAges": [model_to_dict(r) for r in reported_ages],
-        "BsRate": [model_to_dict(b) for b in bs_rate],
-        "Coverage": [model_to_dict(c) for c in coverage],
-        "Fastp": [model_to_dict(f) for f in fastp],
-        "Markdup": [model_to_dict(m) for m in markdup],
-        "PicardAlignmentSummary": [model_to_dict(p) for p in picard_alignment_summary],
-        "PicardGcBias": [model_to_dict(p) for p in picard_gc_bias],
-        "PicardGcBiasSummary": [model_to_dict(p) for p in picard_gc_bias_summary],
-        "PicardHs": [model_to_dict(p) for p in picard_hs],
-        "PicardInsertSize": [model_to_dict(p) for p in picard_insert_size],
-        "PicardQualityYield": [model_to_dict(p) for p in picard_quality_yield],
-        "Screen": [model_to_dict(s) for s in screen]
+def get_existing_rows(model, rows: list[dict], columns: list[str] = ()) -> dict[tuple, tuple]:
+    """
+    Returns the stored values of `columns`, by primary key, of the rows whose
+    primary keys are already stored in the model's table.
+    """
+    key_fields = list(model._meta.get_primary_keys())
+    keys = {tuple(row[field.name] for field in key_fields) for row in rows}
+    fields = [getattr(model, name) for name in columns]
+    # Narrow on the leading key column, then match whole keys here.
+    leading = list({key[0] for key in keys})
+    existing = {}
+    chunk_size = max(1, _max_sql_variables() - 1)
+    for start in range(0, len(leading), chunk_size):
+        query = (model
+                 .select(*key_fields, *fields)
+                 .where(key_fields[0].in_(leading[start:start + chunk_size]))
+                 .tuples())
+        for row in query:
+            key = row[:len(key_fields)]
+            if key in keys:
+                existing[key] = row[len(key_fields):]
+    return existing
+
+def get_last_ingested_file() -> Optional[models.IngestionLedger]:
+    return (models.IngestionLedger
+            .select()
+            .order_by(models.IngestionLedger.ingested_at.desc())
+            .first())
+
+def record_ingested_file(filename: str, content_hash: str, rows_written: int):
+    bulk_upsert(models.IngestionLedger, [{
+        "content_hash": content_hash,
+        "filename": filename,
+        "rows_written": rows_written,
+        "ingested_at": datetime.now(),
+    }])
+
+def get_sheet_hash(sheet_name: str) -> Optional[str]:
+    entry = models.SheetLedger.get_or_none(models.SheetLedger.sheet_name == sheet_name)
+    return entry.content_hash if entry else None
+
+def record_sheet_hash(sheet_name: str, table_name: str, content_hash: str, rows: int):
+    bulk_upsert(models.SheetLedger, [{
+        "sheet_name": sheet_name,
+        "table_name": table_name,
+        "content_hash": content_hash,
+        "rows": rows,
+        "ingested_at": datetime.now(),
+    }])
+
+def init_row_counts(tables: list) -> None:
+    """
+    Counts the rows of every given table that has no stored count yet.
+    """
+    stored = {row[0] for row in models.TableCount.select(models.TableCount.table_name).tuples()}
+    missing = [model for model in tables if model._meta.table_name not in stored]
+    if missing:
+        bulk_upsert(models.TableCount, [
+            {"table_name": model._meta.table_name, "rows": model.select().count()} for model in missing
+        ])
+
+def load_table_stats(model) -> stats.TableStats:
+    """
+    Returns the stored sketches of a table's numeric columns, empty ones for columns without one.
+    """
+    query = (models.ColumnStats
+             .select(models.ColumnStats.column_name, models.ColumnStats.sketch)
+             .where(models.ColumnStats.table_name == model._meta.table_name)
+             .tuples())
+    stored = {name: sketch for name, sketch in query}
+    sketches = {
+        name: stats.Sketch.loads(stored[name]) if name in stored else stats.Sketch()
+        for name in stats.numeric_columns(model)
     }
+    return stats.TableStats(model, sketches)
 
-def get_filtered_data(filters: schemas.FilterSchema):
-    base_model = models.ReportedAges
-    query = base_model.select(base_model.sample)
-
-    field_to_model = {
-        "age": models.ReportedAges,
-        "total_bases": models.Fastp,
-        "puc19vector": models.BsRate,
-        "lambda_dna_conversion_rate": models.BsRate,
-        "human": models.Screen,
-        "lambda_dna": models.Screen,
-        "pUC19": models.Screen,
-        "q30_rate": models.Fastp,
-        "mean_insert_size": models.PicardInsertSize,
-        "percent_duplication": models.Markdup,
-        "pct_selected_bases": models.PicardHs,
-        "fold_enrichment": models.PicardHs,
-        "zero_cvg_targets_pct": models.PicardHs,
-        "mean_target_coverage": models.PicardHs,
-        "pct_exc_dupe": models.PicardHs,
-        "pct_exc_off_target": models.PicardHs,
-        "fold_80_base_penalty": models.PicardHs,
-        "pct_target_bases_10x": models.PicardHs,
-        "pct_target_bases_20x": models.PicardHs,
-        "pct_target_bases_30x": models.PicardHs,
-    }
+def save_table_stats(table_stats: stats.TableStats):
+    """
+    Stores a table's sketches, first re-reading the min and max of columns whose
+    extreme value an update replaced.
+    """
+    model = table_stats.model
+    stale = [name for name, sketch in table_stats.sketches.items() if sketch.stale]
+    if stale:
+        # Text stored in a numeric column sorts above every number; the sketches skip it.
+        extremes = [
+            aggregate(getattr(model, name)).filter(fn.typeof(getattr(model, name)).in_(("integer", "real")))
+            for name in stale for aggregate in (fn.MIN, fn.MAX)
+        ]
+        row = model.select(*extremes).tuples().get()
+        for position, name in enumerate(stale):
+            sketch = table_stats.sketches[name]
+            sketch.min, sketch.max, sketch.stale = row[2 * position], row[2 * position + 1], False
+    bulk_upsert(models.ColumnStats, [
+        {"table_name": model._meta.table_name, "column_name": name, "sketch": sketch.dumps()}
+        for name, sketch in table_stats.sketches.items()
+    ])
+
+def rebuild_table_stats(model, chunk_rows: int = 50000):
+    """
+    Rebuilds a table's sketches from a scan of its rows.
+    """
+    table_stats = stats.TableStats(model, {name: stats.Sketch() for name in stats.numeric_columns(model)})
+    columns = list(table_stats.sketches)
+    if columns:
+        query = model.select(*[getattr(model, name) for name in columns]).tuples()
+        cursor = db.execute(query)
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            values = stats.to_array(rows)
+            for position, name in enumerate(columns):
+                table_stats.sketches[name].add(values[:, position])
+    save_table_stats(table_stats)
+
+def rebuild_column_stats() -> int:
+    """
+    Rebuilds the sketches of every metric table, returning how many tables there are.
+    """
+    for model in sample_wide.SOURCE_MODELS:
+        rebuild_table_stats(model)
+    return len(sample_wide.SOURCE_MODELS)
+
+def init_column_stats(tables: list) -> None:
+    """
+    Builds the sketches of every given table that has none yet.
+    """
+    stored = {row[0] for row in models.ColumnStats.select(models.ColumnStats.table_name).distinct().tuples()}
+    for model in tables:
+        if model._meta.table_name not in stored:
+            with db.atomic():
+                rebuild_table_stats(model)
+
+def get_column_stats(field: str, criteria: Optional[schemas.FilterSchema] = None,
+                     quantiles: list[float] = stats.DEFAULT_QUANTILES, bins: int = stats.DEFAULT_BINS) -> dict:
+    """
+    Summarizes a catalogued column over all rows of its table, from the sketch
+    ingest keeps, or exactly over the rows of the samples matching a filter.
+    """
+    column = filters.resolve(field)
+    model = column.model
+    summary = {"field": field, "table": model._meta.table_name, "column": column.field}
+    if criteria is None:
+        entry = models.ColumnStats.get_or_none(
+            (models.ColumnStats.table_name == model._meta.table_name) & (models.ColumnStats.column_name == column.field))
+        sketch = stats.Sketch.loads(entry.sketch) if entry else stats.Sketch()
+        return {**summary, **stats.summarize(sketch, quantiles, bins)}
+    samples = get_filtered_samples(criteria)
+    with selected_samples(samples) as selected:
+        query = model.select(getattr(model, column.field)).where(model.sample.in_(selected)).tuples()
+        values = stats.to_array([row[0] for row in query])
+    return {**summary, **stats.summarize_values(values, quantiles, bins)}
+
+def get_qc_matrix(metrics: list[str]) -> qc.Matrix:
+    """
+    Loads the value of each metric for every sample, one query per table read.
+    """
+    key = "matrix:" + ",".join(metrics)
+    matrix, generation = qc.QC_CACHE.get(key)
+    if matrix is not None:
+        return matrix
+    samples = [sample for sample, in models.SampleWide.select(models.SampleWide.sample).order_by(models.SampleWide.sample).tuples()]
+    index = {sample: row for row, sample in enumerate(samples)}
+    matrix = qc.empty_matrix(samples, metrics)
+    columns = {}
+    for position, metric in enumerate(metrics):
+        model, field = qc.metric_target(metric)
+        columns.setdefault(model, []).append((position, field))
+    for model, targets in columns.items():
+        query = model.select(model.sample, *[getattr(model, field) for _, field in targets]).tuples()
+        qc.fill(matrix, [position for position, _ in targets], list(query), index)
+    qc.QC_CACHE.put(key, matrix, generation)
+    return matrix
+
+def get_qc_flags(request: schemas.QcSchema) -> dict:
+    """
+    Flags the samples whose metrics are outliers or outside their limits, from
+    the QC cache when the same check was run since the last ingest.
+    """
+    check = qc.parse_check(request)
+    key = qc.check_key(check)
+    result, generation = qc.QC_CACHE.get(key)
+    if result is not None:
+        return result
+    result = qc.flag(get_qc_matrix(check.metrics), check)
+    qc.QC_CACHE.put(key, result, generation)
+    return result
+
+def count_rows(model) -> int:
+    """
+    Returns the stored row count of a table, falling back to COUNT(*) if it has none.
+    """
+    entry = models.TableCount.get_or_none(models.TableCount.table_name == model._meta.table_name)
+    return entry.rows if entry else model.select().count()
 
-    joined_models = {base_model}
-    expressions = []
+def add_row_counts(new_rows: dict[str, int]):
+    """
+    Adds the rows an ingest inserted to the stored count of each table.
+    """
+    for table_name, rows in new_rows.items():
+        if rows:
+            (models.TableCount
+             .update(rows=models.TableCount.rows + rows)
+             .where(models.TableCount.table_name == table_name)
+             .execute())
+
+def get_dataset_generation() -> int:
+    entry = models.DatasetGeneration.get_or_none(models.DatasetGeneration.id == 1)
+    return entry.generation if entry else 0
+
+def bump_dataset_generation() -> int:
+    """
+    Counts one more change to the data, in the caller's transaction, and returns the new generation.
+    """
+    generation = models.DatasetGeneration.generation
+    (models.DatasetGeneration
+     .insert(id=1, generation=1)
+     .on_conflict(conflict_target=[models.DatasetGeneration.id], update={generation: generation + 1})
+     .execute())
+    return get_dataset_generation()
+
+def get_row_hashes(table_name: str, row_keys: list[str]) -> dict[str, int]:
+    """
+    Returns the stored row hashes for the given keys of one table.
+    """
+    hashes = {}
+    chunk_size = max(1, _max_sql_variables() - 1)
+    for start in range(0, len(row_keys), chunk_size):
+        chunk = row_keys[start:start + chunk_size]
+        query = (models.RowLedger
+                 .select(models.RowLedger.row_key, models.RowLedger.row_hash)
+                 .where((models.RowLedger.table_name == table_name) & (models.RowLedger.row_key.in_(chunk)))
+                 .tuples())
+        hashes.update(query)
+    return hashes
+
+def record_row_hashes(table_name: str, row_hashes: dict[str, int]):
+    bulk_upsert(models.RowLedger, [
+        {"table_name": table_name, "row_key": row_key, "row_hash": row_hash}
+        for row_key, row_hash in row_hashes.items()
+    ])
 
-    for f in filters.filters:
-        model = field_to_model.get(f.field)
-        if not model:
+def get_samples_by_search_term(search_term: str) -> list[str]:
+    """
+    Returns the samples whose id, ptid or alias matches any of the comma-separated
+    terms, case-insensitively and in sample order. See search.plan for the index
+    each kind of term uses.
+    """
+    samples = set()
+    names = models.SampleName
+    for term in search.split_terms(search_term):
+        lookup, value = search.plan(term)
+        if lookup == "trigram":
+            index = models.SampleNameIndex
+            query = (names
+                     .select(names.sample, names.name_key)
+                     .join(index, on=(index.rowid == names.id))
+                     .where(index.name ** search.like_pattern(term))
+                     .tuples())
+            pattern = search.matcher(term)
+            samples.update(sample for sample, key in query if pattern.fullmatch(key))
             continue
+        if lookup == "exact":
+            condition = names.name_key == value
+        else:
+            key = names.name_key if lookup == "prefix" else names.name_rkey
+            # Every key from value up to the next possible prefix, e.g. 'cap41' <= key < 'cap41\U0010ffff'.
+            condition = (key >= value) & (key < value + "\U0010ffff")
+        samples.update(row[0] for row in names.select(names.sample).where(condition).tuples())
+    return sorted(samples)
+
+def create_sample_name_triggers():
+    """
+    Keeps the external-content trigram index in step with sample_name.
+    """
+    db.execute_sql(
+        "CREATE TRIGGER IF NOT EXISTS sample_name_ai AFTER INSERT ON sample_name BEGIN "
+        "INSERT INTO sample_name_index(rowid, name) VALUES (new.id, new.name); END"
+    )
+    db.execute_sql(
+        "CREATE TRIGGER IF NOT EXISTS sample_name_ad AFTER DELETE ON sample_name BEGIN "
+        "INSERT INTO sample_name_index(sample_name_index, rowid, name) VALUES ('delete', old.id, old.name); END"
+    )
+
+def refresh_sample_names(samples) -> int:
+    """
+    Brings the search names of the given samples in line with sample_wide and the
+    alias columns, writing only the names that were added or removed.
+    Returns the number of names written or deleted.
+    """
+    samples = list(samples)
+    changes = 0
+    chunk_size = max(1, _max_sql_variables() - 1)
+    for start in range(0, len(samples), chunk_size):
+        chunk = samples[start:start + chunk_size]
+        wanted = set()
+        query = models.SampleWide.select(models.SampleWide.sample, models.SampleWide.ptid).where(models.SampleWide.sample.in_(chunk))
+        for sample, ptid in query.tuples():
+            wanted.add((sample, "sample", sample))
+            if ptid:
+                wanted.add((sample, "ptid", ptid))
+        for field in search.ALIAS_FIELDS:
+            query = field.model.select(field.model.sample, field).where(field.model.sample.in_(chunk) & field.is_null(False))
+            wanted.update((sample, "alias", alias) for sample, alias in query.tuples() if alias != sample)
+
+        stored = {}
+        query = (models.SampleName
+                 .select(models.SampleName.id, models.SampleName.sample, models.SampleName.kind, models.SampleName.name)
+                 .where(models.SampleName.sample.in_(chunk))
+                 .tuples())
+        for name_id, *name in query:
+            stored[tuple(name)] = name_id
+        removed = [name_id for name, name_id in stored.items() if name not in wanted]
+        added = [
+            {"sample": sample, "kind": kind, "name": name, "name_key": search.name_key(name), "name_rkey": search.name_key(name)[::-1]}
+            for sample, kind, name in sorted(wanted - stored.keys())
+        ]
+        for removed_start in range(0, len(removed), chunk_size):
+            models.SampleName.delete().where(models.SampleName.id.in_(removed[removed_start:removed_start + chunk_size])).execute()
+        bulk_upsert(models.SampleName, added)
+        changes += len(removed) + len(added)
+    return changes
+
+def rebuild_sample_names() -> int:
+    """
+    Rebuilds the search names of every sample in sample_wide.
+    """
+    samples = [row[0] for row in models.SampleWide.select(models.SampleWide.sample).tuples()]
+    models.SampleName.delete().execute()
+    models.SampleNameIndex.rebuild()
+    return refresh_sample_names(samples)
+
+def index_samples(samples):
+    """
+    Gives every sample without one an id in sample_index.
+    """
+    samples = sorted(samples)
+    chunk_size = max(1, _max_sql_variables())
+    for start in range(0, len(samples), chunk_size):
+        chunk = [(sample,) for sample in samples[start:start + chunk_size]]
+        models.SampleIndex.insert_many(chunk, fields=[models.SampleIndex.sample]).on_conflict_ignore().execute()
+
+def init_sample_index() -> None:
+    """
+    Gives an id to every sample of sample_wide that has none yet.
+    """
+    index = models.SampleIndex
+    missing = (models.SampleWide
+               .select(models.SampleWide.sample)
+               .where(models.SampleWide.sample.not_in(index.select(index.sample)))
+               .order_by(models.SampleWide.sample))
+    index.insert_from(missing, fields=[index.sample]).execute()
+
+def get_sample_index() -> cohorts.SampleIndex:
+    sample_index, generation = cohorts.INDEX_CACHE.get("index")
+    if sample_index is None:
+        sample_index = cohorts.SampleIndex(list(models.SampleIndex.select(models.SampleIndex.id, models.SampleIndex.sample).tuples()))
+        cohorts.INDEX_CACHE.put("index", sample_index, generation)
+    return sample_index
+
+def get_cohort(name: str) -> Optional[models.Cohort]:
+    return models.Cohort.get_or_none(models.Cohort.name == name)
+
+def get_cohorts() -> list[dict]:
+    return [cohorts.cohort_to_dict(cohort) for cohort in models.Cohort.select().order_by(models.Cohort.name)]
+
+def evaluate_cohort(node: schemas.CohortNode) -> int:
+    """
+    Returns the bitmap of a cohort definition. Saved cohorts are read as stored;
+    filters and searches are run now.
+    """
+    if node.op in cohorts.SET_OPERATIONS:
+        return cohorts.combine(node.op, [evaluate_cohort(arg) for arg in node.args])
+    if node.op == "cohort":
+        cohort = get_cohort(node.name)
+        if cohort is None:
+            raise ValueError(f"Unknown cohort '{node.name}'")
+        return cohorts.loads(cohort.bitmap)
+    if node.op == "filter":
+        samples = get_filtered_samples(node.filter)
+    elif node.op == "search":
+        samples = get_samples_by_search_term(node.search_term)
+    else:
+        samples = node.samples
+    return get_sample_index().bitmap(samples)
+
+def count_cohort(node: schemas.CohortNode) -> int:
+    cohorts.check_definition(node)
+    return cohorts.size(evaluate_cohort(node))
+
+def save_cohort(name: str, node: schemas.CohortNode, owner: str) -> dict:
+    """
+    Evaluates a cohort definition and stores the resulting samples under `name`,
+    replacing any cohort of that name, which keeps its owner.
+    """
+    name = cohorts.check_name(name)
+    cohorts.check_definition(node)
+    bitmap = evaluate_cohort(node)
+    existing = get_cohort(name)
+    if existing is not None:
+        owner = existing.owner
+    with db.atomic():
+        bulk_upsert(models.Cohort, [{
+            "name": name,
+            "bitmap": cohorts.dumps(bitmap),
+            "size": cohorts.size(bitmap),
+            "definition": cohorts.dump_definition(node),
+            "owner": owner,
+            "updated_at": datetime.now(),
+        }])
+    return cohorts.cohort_to_dict(get_cohort(name))
+
+def refresh_cohort(cohort: models.Cohort) -> dict:
+    """
+    Re-evaluates a saved cohort's definition, e.g. to take in samples its filters match since.
+    """
+    return save_cohort(cohort.name, schemas.CohortNode.model_validate_json(cohort.definition), cohort.owner)
+
+def delete_cohort(name: str) -> bool:
+    return models.Cohort.delete().where(models.Cohort.name == name).execute() > 0
+
+def get_cohort_samples(cohort: models.Cohort) -> list[str]:
+    return get_sample_index().members(cohorts.loads(cohort.bitmap))
+
+# Fields whose stored value differs from the Python one, converted by fetch_dicts.
+CONVERTED_FIELDS = (BlobField, BooleanField, DateField, DateTimeField)
+
+def fetch_dicts(query) -> list[dict]:
+    """
+    Runs a select and returns its rows as dicts built straight from the cursor,
+    without peewee's per-value conversion. Numbers and text come back from
+    SQLite as they are returned; only CONVERTED_FIELDS go through python_value.
+    """
+    cursor = db.execute(query)
+    names = [column[0] for column in cursor.description]
+    rows = cursor.fetchall()
+    converters = [
+        (position, field.python_value) for position, field in enumerate(query.selected_columns)
+        if isinstance(field, CONVERTED_FIELDS)
+    ]
+    if not converters:
+        return [dict(zip(names, row)) for row in rows]
+    records = []
+    for row in rows:
+        row = list(row)
+        for position, convert in converters:
+            row[position] = convert(row[position])
+        records.append(dict(zip(names, row)))
+    return records
+
+def get_sub_rows(model, samples, columns: Optional[list[str]] = None) -> list[dict]:
+    """
+    Returns every sub-row (e.g. each read or category) of a multi-row-per-sample
+    table for a batch of samples, given as a list or a selected_samples subquery,
+    in key order. The tables are WITHOUT ROWID with `sample` leading the primary
+    key, so this is one covering range scan.
+    """
+    key_fields = list(model._meta.get_primary_keys())
+    fields = [getattr(model, name) for name in columns] if columns else []
+    return fetch_dicts(model.select(*fields).where(model.sample.in_(samples)).order_by(*key_fields))
 
-        if model not in joined_models:
-            query = query.join(model, on=(base_model.sample == model.sample))
-            joined_models.add(model)
-
-        field = getattr(model, f.field)
-        op_map = {
-            ">=": operator.ge,
-            "<=": operator.le,
-            ">": operator.gt,
-            "<": operator.lt,
-            "==": operator.eq,
+# Response layouts of the data endpoints: every metric table, or one summary row per sample.
+DATA_VIEWS = ("tables", "summary")
+
+def get_sample_summaries(samples: list[str], columns: Optional[list[str]] = None) -> list[dict]:
+    """
+    Returns the sample_wide rows of the given samples, optionally only some columns.
+    """
+    fields = [getattr(models.SampleWide, name) for name in columns] if columns else []
+    with selected_samples(samples) as selected:
+        return fetch_dicts(models.SampleWide.select(*fields).where(models.SampleWide.sample.in_(selected)))
+
+def refresh_sample_wide(samples) -> int:
+    """
+    Recomputes the sample_wide rows of the given samples from the metric tables.
+    Ingest calls this in its transaction for every sample it wrote.
+    """
+    samples = list(samples)
+    chunk_size = max(1, _max_sql_variables() - 1)
+    for start in range(0, len(samples), chunk_size):
+        chunk = samples[start:start + chunk_size]
+        merged = {sample: {"sample": sample} for sample in chunk}
+        for model, columns in sample_wide.SOURCES:
+            fields = [model.sample] + [getattr(model, name) for name in columns]
+            key_fields = list(model._meta.get_primary_keys())
+            query = model.select(*fields).where(model.sample.in_(chunk)).order_by(*key_fields)
+            for row in fetch_dicts(query):
+                merged[row["sample"]].update(row)
+        bulk_upsert(models.SampleWide, [sample_wide.wide_row(row) for row in merged.values()])
+    return len(samples)
+
+def rebuild_sample_wide() -> int:
+    """
+    Rebuilds sample_wide for every sample found in any metric table.
+    """
+    samples = set()
+    for model in sample_wide.SOURCE_MODELS:
+        samples.update(row[0] for row in model.select(model.sample).distinct().tuples())
+    models.SampleWide.delete().execute()
+    return refresh_sample_wide(sorted(samples))
+
+def get_data_by_samples(samples: list[str], view: str = "tables", fieldset: Optional[dict] = None):
+    """
+    Returns the rows of the given samples in every metric table, or in the tables
+    and columns of a fieldset (see services.fieldsets.resolve).
+    """
+    if view == "summary":
+        return {"summary": get_sample_summaries(samples, fieldset and fieldset["summary"])}
+    fieldset = fieldset or fieldsets.FULL
+    if not samples:
+        return {name: [] for name in fieldset}
+
+    data = {}
+    with selected_samples(samples) as selected:
+        for name, columns in fieldset.items():
+            model = fieldsets.TABLES[name]
+            if model._meta.composite_key:
+                data[name] = get_sub_rows(model, selected, columns)
+            else:
+                fields = [getattr(model, column) for column in columns]
+                data[name] = fetch_dicts(model.select(*fields).where(model.sample.in_(selected)))
+    return data
+
+def get_gc_bias_curves(samples: list[str], accumulation_level: Optional[str] = None, reads_used: Optional[str] = None,
+                       vectors: Optional[list[str]] = None) -> list[dict]:
+    """
+    Returns the unpacked GC-bias curves of the given samples, one record per
+    sample, accumulation level and read set.
+    """
+    if not samples:
+        return []
+    vectors = tuple(vectors) if vectors else tuple(gc_bias.CURVE_VECTORS)
+    with selected_samples(samples) as selected:
+        query = models.PicardGcBias.select().where(models.PicardGcBias.sample.in_(selected))
+        if accumulation_level is not None:
+            query = query.where(models.PicardGcBias.accumulation_level == accumulation_level)
+        if reads_used is not None:
+            query = query.where(models.PicardGcBias.reads_used == reads_used)
+        query = query.order_by(models.PicardGcBias.sample, models.PicardGcBias.accumulation_level, models.PicardGcBias.reads_used)
+        return [gc_bias.curve_to_dict(curve, vectors) for curve in query]
+
+_indexed_columns = {}
+
+def create_filter_indexes():
+    """
+    Creates the secondary indexes listed in FILTER_INDEXES and SORT_INDEXES that don't exist yet.
+    """
+    for name in filters.FILTER_INDEXES:
+        model, field = filters.target(filters.resolve(name))
+        db.execute(model.index(getattr(model, field)))
+    for name in filters.SORT_INDEXES:
+        model, field = filters.sort_target(filters.resolve(name))
+        db.execute(model.index(getattr(model, field)))
+    _indexed_columns.clear()
+
+def indexed_columns(model) -> set[str]:
+    """
+    Returns the columns that lead an index of the model's table.
+    """
+    table = model._meta.table_name
+    if table not in _indexed_columns:
+        _indexed_columns[table] = {index.columns[0] for index in db.get_indexes(table) if index.columns}
+    return _indexed_columns[table]
+
+def get_filter_fields() -> list[dict]:
+    return [
+        {
+            "name": name,
+            "table": column.model._meta.table_name,
+            "column": column.field,
+            "type": column.type,
+            "indexed": column.field in indexed_columns(filters.target(column)[0]),
         }
-        expressions.append(op_map[f.operator](field, f.value))
+        for name, column in filters.CATALOGUE.items()
+    ]
 
-    if not expressions:
-        return get_data_by_samples([])
+def _estimate_rows(model, expression) -> int:
+    """
+    Counts the rows an indexed condition matches, stopping at FILTER_PROBE_ROWS.
+    """
+    return model.select(SQL("1")).where(expression).limit(filters.FILTER_PROBE_ROWS).count()
 
-    final_expression = expressions[0]
-    for i, op in enumerate(filters.logical_operators):
-        if op == "and":
-            final_expression &= expressions[i + 1]
-        elif op == "or":
-            final_expression |= expressions[i + 1]
+def _is_indexed(expression: list) -> bool:
+    """
+    Whether a condition can be looked up through an index of the column it reads.
+    """
+    if expression[0] not in filters.OPERATORS and expression[0] not in filters.INDEXED_CONDITIONS:
+        return False
+    model, field = filters.target(filters.resolve(expression[1]))
+    return field in indexed_columns(model)
 
-    query = query.where(final_expression)
-    samples = [item.sample for item in query]
-    return get_data_by_samples(samples)
+def plan_filter(expression: list):
+    """
+    Returns the query selecting the samples that match a canonical filter
+    expression, and a description of its plan. Only tables the expression reads
+    are joined, plus reportedages, which every listed sample has a row in.
+
+    The top-level conjuncts that read one table are applied first, driven from
+    the indexed condition estimated to match fewest rows: their tables are
+    cross-joined in that order, an order SQLite keeps as its loop nesting, and
+    each later table is probed by sample. Tables only read by conjuncts spanning
+    several tables, e.g. an 'or' across tables, are left-joined, so a sample
+    without rows in one of them can still match through another branch.
+    """
+    base_model = models.ReportedAges
+    terms = []
+    for term in filters.conjuncts(expression):
+        tables = list(dict.fromkeys(model for model, _ in filters.expression_columns(term)))
+        estimate = None
+        if len(tables) == 1 and _is_indexed(term):
+            estimate = _estimate_rows(tables[0], filters.compile_expression(term))
+        terms.append((term, tables, estimate))
+    # Indexed conditions first, fewest matches first; then the other one-table
+    # conditions, then those spanning tables, each group in canonical order.
+    terms.sort(key=lambda term: (term[2] is None, len(term[1]) > 1, term[2] or 0))
+    indexed = terms[0][2] is not None
+
+    inner = []
+    for _, tables, _ in terms:
+        if len(tables) == 1 and tables[0] not in inner:
+            inner.append(tables[0])
+    if base_model not in inner:
+        inner.append(base_model)
+    outer = []
+    for _, tables, _ in terms:
+        outer.extend(model for model in tables if model not in inner and model not in outer)
+
+    driving = inner[0]
+    query = driving.select(driving.sample)
+    conditions = [filters.compile_expression(term) for term, _, _ in terms]
+    joins = [{"table": driving._meta.table_name, "join": "from"}]
+    for model in inner[1:]:
+        if indexed:
+            query = query.join(model, JOIN.CROSS)
+            conditions.append(model.sample == driving.sample)
+            joins.append({"table": model._meta.table_name, "join": "cross"})
+        else:
+            query = query.join(model, on=(driving.sample == model.sample))
+            joins.append({"table": model._meta.table_name, "join": "inner"})
+    for model in outer:
+        query = query.join(model, JOIN.LEFT_OUTER, on=(driving.sample == model.sample))
+        joins.append({"table": model._meta.table_name, "join": "left"})
+
+    plan = {
+        "expression": expression,
+        "strategy": "indexed" if indexed else "joined",
+        "tables": joins,
+        "conditions": [
+            {
+                "expression": term,
+                "tables": [model._meta.table_name for model in tables],
+                "indexed": len(tables) == 1 and _is_indexed(term),
+                "estimated_rows": estimate,
+            }
+            for term, tables, estimate in terms
+        ],
+    }
+    return query.where(*conditions), plan
 
-def get_initial_data(offset: int = 0, limit: int = 20):
-    samples = [item.sample for item in models.ReportedAges.select(models.ReportedAges.sample).offset(offset).limit(limit)]
-    return get_data_by_samples(samples)
+def explain_filter(criteria: schemas.FilterSchema) -> dict:
+    """
+    Returns the plan of a filter with its SQL and SQLite's EXPLAIN QUERY PLAN.
+    """
+    expression = filters.criteria_expression(criteria)
+    if expression is None:
+        return {"expression": None}
+    query, plan = plan_filter(expression)
+    sql, params = query.sql()
+    plan["sql"] = sql
+    plan["query_plan"] = [row[3] for row in db.execute_sql("EXPLAIN QUERY PLAN " + sql, params)]
+    return plan
+
+def get_filtered_samples(criteria: schemas.FilterSchema) -> list[str]:
+    """
+    Returns the samples matching a filter, from the result cache when the same
+    expression, in canonical form, was run since the last ingest.
+    """
+    expression = filters.criteria_expression(criteria)
+    if expression is None:
+        return []
+    key = filters.expression_key(expression)
+    samples, generation = filters.RESULT_CACHE.get(key)
+    if samples is not None:
+        return samples
+    if filters.FILTER_DEBUG:
+        print(f"Filter plan: {explain_filter(criteria)}")
+    query, _ = plan_filter(expression)
+    # Tables with several rows per sample (e.g. screen reads) match if any row does.
+    # Deduplicating here rather than with DISTINCT leaves SQLite free to drive the
+    # query from the condition's index instead of scanning in sample order.
+    samples = list(dict.fromkeys(sample for sample, in query.tuples()))
+    filters.RESULT_CACHE.put(key, samples, generation)
+    return samples
+
+def get_filtered_data(criteria: schemas.FilterSchema, view: str = "tables", fieldset: Optional[dict] = None):
+    return get_data_by_samples(get_filtered_samples(criteria), view, fieldset)
+
+def get_filtered_page(criteria: schemas.FilterSchema, view: str = "tables", fieldset: Optional[dict] = None,
+                      sort: Optional[str] = None, descending: bool = False, limit: Optional[int] = None,
+                      cursor: Optional[str] = None):
+    """
+    Returns the data of one page of the samples matching a filter, their total
+    count and the cursor of the next page; see get_samples_page.
+    """
+    return get_samples_page(get_filtered_samples(criteria), view, fieldset, sort, descending, limit, cursor)
+
+def get_samples_page(samples: list[str], view: str = "tables", fieldset: Optional[dict] = None,
+                     sort: Optional[str] = None, descending: bool = False, limit: Optional[int] = None,
+                     cursor: Optional[str] = None):
+    """
+    Returns the data of one page of the given samples, their total count and
+    the cursor of the next page (None on the last page). Samples are in sample
+    order, or in order of the `sort` metric; without a limit the page holds
+    every sample after the cursor.
+    """
+    if sort is not None:
+        after = pagination.decode_cursor(cursor, 2) if cursor is not None else None
+        with selected_samples(samples) as selected:
+            keys = get_sorted_samples(sort, descending, after, limit, selected)
+        page = [sample for _, sample in keys]
+    else:
+        ordered = sorted(samples)
+        start = 0
+        if cursor is not None:
+            after, = pagination.decode_cursor(cursor, 1)
+            start = bisect.bisect_right(ordered, after)
+        page = ordered[start:start + limit] if limit is not None else ordered[start:]
+        keys = [[sample] for sample in page]
+    next_cursor = pagination.encode_cursor(keys[-1]) if limit is not None and keys and len(keys) == limit else None
+    return _in_order(get_data_by_samples(page, view, fieldset), page), len(samples), next_cursor
+
+# Directions the data endpoints sort in.
+SORT_ORDERS = ("asc", "desc")
+
+def get_sorted_samples(sort: str, descending: bool = False, after: Optional[list] = None, limit: Optional[int] = None,
+                       samples=None) -> list[list]:
+    """
+    Returns the [value, sample] sort keys of listed samples in order of a
+    catalogued metric, of all of them or of `samples` (a list or a
+    selected_samples subquery). Samples without a value come last, in sample
+    order, as do ties. `after` is the key of the previous page's last sample.
+
+    The samples with a value come from a range scan of the metric's index in
+    sort order, stopping at `limit`, so a top-N costs N rows whatever the
+    cohort size; the rest are read only once those run out. A metric without
+    an index (see SORT_INDEXES) sorts its whole table instead.
+    """
+    model, field = filters.sort_target(filters.resolve(sort))
+    column = getattr(model, field)
+    ages = models.ReportedAges
+    value, sample = after if after is not None else (None, None)
+
+    keys = []
+    if after is None or value is not None:
+        query = model.select(column, model.sample).where(column.is_null(False))
+        if model is not ages:
+            query = query.join(ages, on=(model.sample == ages.sample))
+        if samples is not None:
+            query = query.where(model.sample.in_(samples))
+        if after is not None:
+            # Written as a range on the column so its index bounds the scan.
+            bound = column <= value if descending else column >= value
+            query = query.where(bound & ((column != value) | (model.sample > sample)))
+        query = query.order_by(column.desc() if descending else column, model.sample)
+        if limit is not None:
+            query = query.limit(limit)
+        keys = [list(row) for row in query.tuples()]
+
+    if limit is None or len(keys) < limit:
+        query = ages.select(ages.sample)
+        if model is not ages:
+            query = query.join(model, JOIN.LEFT_OUTER, on=(ages.sample == model.sample))
+        query = query.where(column.is_null())
+        if samples is not None:
+            query = query.where(ages.sample.in_(samples))
+        if after is not None and value is None:
+            query = query.where(ages.sample > sample)
+        query = query.order_by(ages.sample)
+        if limit is not None:
+            query = query.limit(limit - len(keys))
+        keys.extend([None, row[0]] for row in query.tuples())
+    return keys
+
+def _in_order(data: dict, samples: list[str]) -> dict:
+    """
+    Orders the rows of each table of get_data_by_samples like `samples`,
+    keeping the order of a sample's sub-rows.
+    """
+    position = {sample: index for index, sample in enumerate(samples)}
+    for rows in data.values():
+        rows.sort(key=lambda row: position[row["sample"]])
+    return data
+
+def get_initial_data(offset: int = 0, limit: int = 20, view: str = "tables", cursor: Optional[str] = None,
+                     fieldset: Optional[dict] = None, sort: Optional[str] = None, descending: bool = False):
+    """
+    Returns one page of samples in sample order, or in order of the `sort`
+    metric, and the cursor of the next page, or None on the last page. With a
+    cursor the page starts right after the sample it encodes, using the primary
+    key (or the metric's index), so every page costs the same; otherwise it
+    starts at offset.
+    """
+    if sort is not None:
+        if offset:
+            raise ValueError("offset can't be combined with sort, use cursor")
+        after = pagination.decode_cursor(cursor, 2) if cursor is not None else None
+        keys = get_sorted_samples(sort, descending, after, limit)
+        samples = [sample for _, sample in keys]
+        data = _in_order(get_data_by_samples(samples, view, fieldset), samples)
+        next_cursor = pagination.encode_cursor(keys[-1]) if keys and len(keys) == limit else None
+        return data, next_cursor
+
+    ages = models.ReportedAges
+    if view == "summary":
+        fields = [getattr(models.SampleWide, name) for name in fieldset["summary"]] if fieldset else []
+        query = models.SampleWide.select(*fields).join(ages, on=(models.SampleWide.sample == ages.sample))
+    else:
+        query = ages.select(ages.sample)
+    if cursor is not None:
+        after, = pagination.decode_cursor(cursor, 1)
+        query = query.where(ages.sample > after)
+    else:
+        query = query.offset(offset)
+    query = query.order_by(ages.sample).limit(limit)
+
+    if view == "summary":
+        rows = fetch_dicts(query)
+        samples = [row["sample"] for row in rows]
+        data = {"summary": rows}
+    else:
+        samples = [row[0] for row in query.tuples()]
+        data = get_data_by_samples(samples, view, fieldset)
+    next_cursor = pagination.encode_cursor(samples[-1:]) if samples and len(samples) == limit else None
+    return data, next_cursor
 
 def get_total_data_count():
-    return models.ReportedAges.select().count()
+    return count_rows(models.ReportedAges)
@@ -12,4 +12,9 @@ DB_PATH = os.path.abspath(DATABASE_URL)
 # Ensure the directory for the database exists
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
-db = SqliteDatabase(DB_PATH)
+# WAL lets readers keep serving while a background ingest holds the write lock;
+# busy_timeout makes concurrent writers wait instead of failing immediately.
+db = SqliteDatabase(DB_PATH, pragmas={
+    "journal_mode": "wal",
+    "busy_timeout": 30000,
+})
@@ -1,17 +1,17 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Depends, status
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Depends, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from typing import List
+from typing import List, Optional
 import crud
 import models
 import schemas
 from database import db
-from services import file_handler
+from services import cohorts, fieldsets, file_handler, filters, gc_bias, http_cache, jobs, sample_wide, serialization, stats
 from auth import create_access_token, verify_password, get_password_hash, decode_access_token, oauth2_scheme
 from datetime import timedelta
 
-app = FastAPI()
+app = FastAPI(default_response_class=serialization.FastJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -22,6 +22,12 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+@app.middleware("http")
+async def sync_dataset_generation(request: Request, call_next):
+    # Other worker processes ingest too; their commits must invalidate this process's caches.
+    file_handler.sync_generation()
+    return await call_next(request)
+
 @app.on_event("startup")
 def startup_event():
     db.connect()
@@ -39,7 +45,24 @@ def startup_event():
         models.PicardQualityYield,
         models.Screen,
         models.User, # Add User model to tables
+        models.IngestionLedger,
+        models.SheetLedger,
+        models.RowLedger,
+        models.SampleWide,
+        models.TableCount,
+        models.SampleName,
+        models.SampleNameIndex,
+        models.ColumnStats,
+        models.SampleIndex,
+        models.Cohort,
+        models.DatasetGeneration,
     ])
+    crud.create_sample_name_triggers()
+    crud.init_row_counts(sample_wide.SOURCE_MODELS)
+    crud.create_filter_indexes()
+    crud.init_column_stats(sample_wide.SOURCE_MODELS)
+    crud.init_sample_index()
+    http_cache.RESPONSE_CACHE.set_generation(crud.get_dataset_generation())
     # Ensure a default admin user exists and its password is up-to-date with the current hashing scheme
     admin_username = "admin"
     admin_password = "admin12345"
@@ -64,6 +87,7 @@ def startup_event():
 
 @app.on_event("shutdown")
 def shutdown_event():
+    jobs.shutdown()
     if not db.is_closed():
         db.close()
 
@@ -148,46 +172,280 @@ async def approve_user(user_id: int, current_user: models.User = Depends(get_cur
 async def reject_user(user_id: int, current_user: models.User = Depends(get_current_admin_user)):
     return crud.update_user_status(user_id=user_id, status="rejected")
 
-@app.post("/api/v1/data/upload")
-async def upload_data(file: UploadFile = File(...), current_user: models.User = Depends(get_current_admin_user)):
+@app.post("/api/v1/data/upload", status_code=status.HTTP_202_ACCEPTED)
+def upload_data(file: UploadFile = File(...), force: bool = Form(False), dry_run: bool = Form(False),
+                current_user: models.User = Depends(get_current_admin_user)):
+    # Spooling and queueing only; ingestion runs on the background worker pool.
+    # force re-ingests content the ledger has already seen; dry_run rolls the ingest back.
     try:
-        file_handler.process_uploaded_file(file)
-        return {"message": "File uploaded and processed successfully"}
+        job = jobs.submit_upload(file, force=force, dry_run=dry_run)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return {"message": "File queued for processing", "job_id": job.id, "status": job.status}
 
-@app.get("/api/v1/data/initial")
-async def get_initial_data_route(offset: int = 0, limit: int = 20, current_user: models.User = Depends(get_current_user)):
+@app.get("/api/v1/jobs/{job_id}")
+async def get_job_status(job_id: str, current_user: models.User = Depends(get_current_admin_user)):
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.snapshot()
+
+def check_view(view: str):
+    if view not in crud.DATA_VIEWS:
+        raise HTTPException(status_code=400, detail=f"Unknown view '{view}', expected one of {', '.join(crud.DATA_VIEWS)}")
+
+def check_sort(order: str) -> bool:
+    if order not in crud.SORT_ORDERS:
+        raise HTTPException(status_code=400, detail=f"Unknown order '{order}', expected one of {', '.join(crud.SORT_ORDERS)}")
+    return order == "desc"
+
+def check_layout(layout: str):
     try:
-        data = crud.get_initial_data(offset=offset, limit=limit)
+        serialization.check_layout(layout)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def check_fieldset(view: str, tables: Optional[str], columns: Optional[str], profile: Optional[str]) -> Optional[dict]:
+    check_view(view)
+    try:
+        return fieldsets.resolve(view, tables, columns, profile)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/v1/data/initial")
+async def get_initial_data_route(request: Request, offset: int = 0, limit: int = 20, view: str = "tables",
+                                 cursor: Optional[str] = None, tables: Optional[str] = None, columns: Optional[str] = None,
+                                 profile: Optional[str] = None, sort: Optional[str] = None, order: str = "asc",
+                                 layout: str = "rows", current_user: models.User = Depends(get_current_user)):
+    fieldset = check_fieldset(view, tables, columns, profile)
+    descending = check_sort(order)
+    check_layout(layout)
+
+    def render():
+        data, next_cursor = crud.get_initial_data(offset=offset, limit=limit, view=view, cursor=cursor, fieldset=fieldset,
+                                                  sort=sort, descending=descending)
         total_count = crud.get_total_data_count()
-        return {"data": data, "total_count": total_count}
+        return http_cache.json_body({"data": serialization.apply_layout(data, layout), "total_count": total_count,
+                                     "next_cursor": next_cursor})
+
+    try:
+        return http_cache.respond(request, render)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/v1/data/download")
-async def download_data(samples: str, current_user: models.User = Depends(get_current_user)):
+async def download_data(request: Request, samples: str, current_user: models.User = Depends(get_current_user)):
     sample_list = [s.strip() for s in samples.split(',')]
-    try:
+
+    def render():
         excel_file = file_handler.generate_excel_file(sample_list)
-        return StreamingResponse(excel_file, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={"Content-Disposition": "attachment; filename=cohort_data.xlsx"})
+        return http_cache.CachedResponse(excel_file.getvalue(), "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", {"Content-Disposition": "attachment; filename=cohort_data.xlsx"})
+
+    try:
+        return http_cache.respond(request, render)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/v1/data/gc-bias")
+async def get_gc_bias_curves(request: Request, samples: str, accumulation_level: Optional[str] = None,
+                             reads_used: Optional[str] = None, vectors: Optional[str] = None,
+                             current_user: models.User = Depends(get_current_user)):
+    sample_list = [s.strip() for s in samples.split(',') if s.strip()]
+    vector_list = [v.strip() for v in vectors.split(',') if v.strip()] if vectors else None
+    unknown = [v for v in vector_list or [] if v not in gc_bias.CURVE_VECTORS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown curve vectors: {', '.join(unknown)}")
+    try:
+        return http_cache.respond(request, lambda: http_cache.json_body(
+            {"curves": crud.get_gc_bias_curves(sample_list, accumulation_level, reads_used, vector_list)}))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/v1/data/filter")
-async def filter_data(filters: schemas.FilterSchema, current_user: models.User = Depends(get_current_user)):
+async def filter_data(request: Request, filters: schemas.FilterSchema, view: str = "tables", tables: Optional[str] = None,
+                      columns: Optional[str] = None, profile: Optional[str] = None, sort: Optional[str] = None,
+                      order: str = "asc", limit: Optional[int] = None, cursor: Optional[str] = None, layout: str = "rows",
+                      current_user: models.User = Depends(get_current_user)):
     print(filters)
+    fieldset = check_fieldset(view, tables, columns, profile)
+    descending = check_sort(order)
+    check_layout(layout)
+
+    def render():
+        if sort is None and limit is None and cursor is None:
+            return http_cache.json_body(serialization.apply_layout(crud.get_filtered_data(filters, view, fieldset), layout))
+        data, total_count, next_cursor = crud.get_filtered_page(filters, view, fieldset, sort=sort, descending=descending,
+                                                                limit=limit, cursor=cursor)
+        data = serialization.apply_layout(data, layout)
+        if limit is None and cursor is None:
+            return http_cache.json_body(data)
+        return http_cache.json_body({"data": data, "total_count": total_count, "next_cursor": next_cursor})
+
     try:
-        data = crud.get_filtered_data(filters)
-        return data
+        return http_cache.respond(request, render, filters.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/v1/data/search")
-async def search_data(search_term: str = Form(...), current_user: models.User = Depends(get_current_user)):
+@app.get("/api/v1/data/filter/fields")
+async def get_filter_fields(current_user: models.User = Depends(get_current_user)):
+    try:
+        return crud.get_filter_fields()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/v1/data/filter/explain")
+async def explain_filter(criteria: schemas.FilterSchema, current_user: models.User = Depends(get_current_user)):
+    if not filters.FILTER_DEBUG:
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        return crud.explain_filter(criteria)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/v1/stats")
+async def get_column_stats(request: Request, field: str, quantiles: Optional[str] = None, bins: int = stats.DEFAULT_BINS,
+                           current_user: models.User = Depends(get_current_user)):
+    try:
+        qs = stats.parse_request(quantiles, bins)
+        return http_cache.respond(request, lambda: http_cache.json_body(crud.get_column_stats(field, quantiles=qs, bins=bins)))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/v1/stats")
+async def get_filtered_column_stats(request: Request, criteria: schemas.FilterSchema, field: str,
+                                    quantiles: Optional[str] = None, bins: int = stats.DEFAULT_BINS,
+                                    current_user: models.User = Depends(get_current_user)):
+    try:
+        qs = stats.parse_request(quantiles, bins)
+        return http_cache.respond(request, lambda: http_cache.json_body(crud.get_column_stats(field, criteria, quantiles=qs, bins=bins)),
+                                  criteria.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/v1/qc/flags")
+async def get_qc_flags(request: Request, check: schemas.QcSchema, current_user: models.User = Depends(get_current_user)):
+    try:
+        return http_cache.respond(request, lambda: http_cache.json_body(crud.get_qc_flags(check)), check.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def get_cohort_or_404(name: str) -> models.Cohort:
+    cohort = crud.get_cohort(name)
+    if cohort is None:
+        raise HTTPException(status_code=404, detail="Cohort not found")
+    return cohort
+
+def check_cohort_owner(cohort: models.Cohort, user: models.User):
+    if cohort.owner != user.username and not user.is_admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only the cohort's owner or an admin can change it")
+
+@app.get("/api/v1/cohorts")
+async def get_cohorts(current_user: models.User = Depends(get_current_user)):
+    try:
+        return crud.get_cohorts()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/v1/cohorts/count")
+async def count_cohort(definition: schemas.CohortNode, current_user: models.User = Depends(get_current_user)):
+    try:
+        return {"size": crud.count_cohort(definition)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/v1/cohorts/{name}")
+async def get_cohort(name: str, current_user: models.User = Depends(get_current_user)):
+    return cohorts.cohort_to_dict(get_cohort_or_404(name))
+
+@app.put("/api/v1/cohorts/{name}")
+async def save_cohort(name: str, definition: schemas.CohortNode, current_user: models.User = Depends(get_current_user)):
+    existing = crud.get_cohort(name.strip())
+    if existing is not None:
+        check_cohort_owner(existing, current_user)
+    try:
+        return crud.save_cohort(name, definition, current_user.username)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/v1/cohorts/{name}/refresh")
+async def refresh_cohort(name: str, current_user: models.User = Depends(get_current_user)):
+    cohort = get_cohort_or_404(name)
+    check_cohort_owner(cohort, current_user)
+    try:
+        return crud.refresh_cohort(cohort)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/api/v1/cohorts/{name}")
+async def delete_cohort(name: str, current_user: models.User = Depends(get_current_user)):
+    check_cohort_owner(get_cohort_or_404(name), current_user)
+    if not crud.delete_cohort(name):
+        raise HTTPException(status_code=404, detail="Cohort not found")
+    return {"message": f"Cohort '{name}' deleted"}
+
+@app.get("/api/v1/cohorts/{name}/data")
+async def get_cohort_data(name: str, view: str = "tables", tables: Optional[str] = None, columns: Optional[str] = None,
+                          profile: Optional[str] = None, sort: Optional[str] = None, order: str = "asc",
+                          limit: Optional[int] = None, cursor: Optional[str] = None, layout: str = "rows",
+                          current_user: models.User = Depends(get_current_user)):
+    cohort = get_cohort_or_404(name)
+    fieldset = check_fieldset(view, tables, columns, profile)
+    descending = check_sort(order)
+    check_layout(layout)
     try:
+        samples = crud.get_cohort_samples(cohort)
+        data, total_count, next_cursor = crud.get_samples_page(samples, view, fieldset, sort=sort, descending=descending,
+                                                               limit=limit, cursor=cursor)
+        data = serialization.apply_layout(data, layout)
+        if limit is None and cursor is None:
+            return serialization.FastJSONResponse(data)
+        return serialization.FastJSONResponse({"data": data, "total_count": total_count, "next_cursor": next_cursor})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/v1/cohorts/{name}/download")
+async def download_cohort(name: str, current_user: models.User = Depends(get_current_user)):
+    cohort = get_cohort_or_404(name)
+    try:
+        excel_file = file_handler.generate_excel_file(crud.get_cohort_samples(cohort))
+        return StreamingResponse(excel_file, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={"Content-Disposition": "attachment; filename=cohort_data.xlsx"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/v1/data/search")
+async def search_data(request: Request, search_term: str = Form(...), view: str = "tables", tables: Optional[str] = None,
+                      columns: Optional[str] = None, profile: Optional[str] = None, layout: str = "rows",
+                      current_user: models.User = Depends(get_current_user)):
+    fieldset = check_fieldset(view, tables, columns, profile)
+    check_layout(layout)
+
+    def render():
         samples = crud.get_samples_by_search_term(search_term)
-        data = crud.get_data_by_samples(samples)
-        return data
+        return http_cache.json_body(serialization.apply_layout(crud.get_data_by_samples(samples, view, fieldset), layout))
+
+    try:
+        return http_cache.respond(request, render, search_term)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
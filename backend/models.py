@@ -1,4 +1,5 @@
-from peewee import Model, TextField, IntegerField, FloatField, DateField, BooleanField
+from peewee import Model, AutoField, TextField, IntegerField, FloatField, DateField, BooleanField, DateTimeField, BlobField, CompositeKey
+from playhouse.sqlite_ext import FTS5Model, SearchField
 from database import db
 
 class BaseModel(Model):
@@ -48,16 +49,20 @@ class Coverage(BaseModel):
 
 # TODO: Add other models for the rest of the sheets
 class Fastp(BaseModel):
+    """
+    fastp reports several metrics as "before|after" filtering pairs. The column
+    holds the after-filtering value and `<column>_before` the raw one.
+    """
     sample = TextField(primary_key=True)
-    total_reads = IntegerField(null=True)
-    total_bases = IntegerField(null=True)
+    total_reads = IntegerField(null=True, index=True)
+    total_bases = IntegerField(null=True, index=True)
     q20_bases = IntegerField(null=True)
     q30_bases = IntegerField(null=True)
-    q20_rate = FloatField(null=True)
-    q30_rate = FloatField(null=True)
+    q20_rate = FloatField(null=True, index=True)
+    q30_rate = FloatField(null=True, index=True)
     read1_mean_length = IntegerField(null=True)
     read2_mean_length = IntegerField(null=True)
-    gc_content = FloatField(null=True)
+    gc_content = FloatField(null=True, index=True)
     passed_filter_reads = IntegerField(null=True)
     corrected_reads = IntegerField(null=True)
     corrected_bases = IntegerField(null=True)
@@ -82,6 +87,23 @@ class Fastp(BaseModel):
     read2_total_bases = IntegerField(null=True)
     read2_q20_bases = IntegerField(null=True)
     read2_q30_bases = IntegerField(null=True)
+    total_reads_before = IntegerField(null=True)
+    total_bases_before = IntegerField(null=True)
+    q20_bases_before = IntegerField(null=True)
+    q30_bases_before = IntegerField(null=True)
+    q20_rate_before = FloatField(null=True)
+    q30_rate_before = FloatField(null=True)
+    read1_mean_length_before = IntegerField(null=True)
+    read2_mean_length_before = IntegerField(null=True)
+    gc_content_before = FloatField(null=True)
+    read1_total_reads_before = IntegerField(null=True)
+    read1_total_bases_before = IntegerField(null=True)
+    read1_q20_bases_before = IntegerField(null=True)
+    read1_q30_bases_before = IntegerField(null=True)
+    read2_total_reads_before = IntegerField(null=True)
+    read2_total_bases_before = IntegerField(null=True)
+    read2_q20_bases_before = IntegerField(null=True)
+    read2_q30_bases_before = IntegerField(null=True)
 
 class Markdup(BaseModel):
     sample = TextField(primary_key=True)
@@ -90,8 +112,9 @@ class Markdup(BaseModel):
     percent_duplication = FloatField(null=True)
 
 class PicardAlignmentSummary(BaseModel):
-    sample = TextField(primary_key=True)
-    category = TextField(null=True)
+    """One row per sample and CATEGORY (FIRST_OF_PAIR, SECOND_OF_PAIR, PAIR)."""
+    sample = TextField()
+    category = TextField(default='')
     total_reads = IntegerField(null=True)
     pf_reads = IntegerField(null=True)
     pct_pf_reads = FloatField(null=True)
@@ -127,23 +150,36 @@ class PicardAlignmentSummary(BaseModel):
     library = TextField(null=True)
     read_group = TextField(null=True)
 
+    class Meta:
+        # WITHOUT ROWID stores rows in primary-key order, so the key index covers every column.
+        primary_key = CompositeKey('sample', 'category')
+        without_rowid = True
+
 class PicardGcBias(BaseModel):
-    sample = TextField(primary_key=True)
-    accumulation_level = FloatField(null=True)
-    reads_used = IntegerField(null=True)
-    gc = IntegerField(null=True)
-    windows = IntegerField(null=True)
-    read_starts = IntegerField(null=True)
-    mean_base_quality = FloatField(null=True)
-    normalized_coverage = FloatField(null=True)
-    error_bar_width = FloatField(null=True)
+    """
+    One GC-bias curve per sample, accumulation level and read set. The per-bin
+    vectors are packed arrays; see services.gc_bias.CURVE_VECTORS for their dtypes.
+    """
+    sample = TextField()
+    accumulation_level = TextField(default='')
+    reads_used = TextField(default='')
+    bins = IntegerField(default=0)
+    gc = BlobField(null=True)
+    windows = BlobField(null=True)
+    read_starts = BlobField(null=True)
+    mean_base_quality = BlobField(null=True)
+    normalized_coverage = BlobField(null=True)
+    error_bar_width = BlobField(null=True)
     library = TextField(null=True)
     read_group = TextField(null=True)
 
+    class Meta:
+        primary_key = CompositeKey('sample', 'accumulation_level', 'reads_used')
+
 class PicardGcBiasSummary(BaseModel):
     sample = TextField(primary_key=True)
-    accumulation_level = FloatField(null=True)
-    reads_used = IntegerField(null=True)
+    accumulation_level = TextField(null=True)
+    reads_used = TextField(null=True)
     window_size = IntegerField(null=True)
     total_clusters = IntegerField(null=True)
     aligned_reads = IntegerField(null=True)
@@ -268,13 +304,132 @@ class PicardQualityYield(BaseModel):
     pf_q20_equivalent_yield = IntegerField(null=True)
 
 class Screen(BaseModel):
-    sample = TextField(primary_key=True)
+    """One row per sample and read (R1, R2); `sample_r1r2` keeps the source name."""
+    sample = TextField()
+    read = TextField(default='')
     sample_r1r2 = TextField(null=True)
     human = FloatField(null=True)
     lambda_dna = FloatField(null=True)
     pUC19 = FloatField(null=True)
     human_unmap = FloatField(null=True)
 
+    class Meta:
+        primary_key = CompositeKey('sample', 'read')
+        without_rowid = True
+
+class SampleWide(BaseModel):
+    """
+    One row per sample with the summary columns of the combined view, merged from
+    the metric tables the way get_data_by_samples lists them (a later table wins).
+    Maintained by ingest; see services.sample_wide.
+    """
+    sample = TextField(primary_key=True)
+    ptid = TextField(null=True)
+    gender = TextField(null=True)
+    esti_gender = TextField(null=True)
+    age = IntegerField(null=True)
+    total_bases = IntegerField(null=True)
+    puc19vector = FloatField(null=True)
+    lambda_dna_conversion_rate = FloatField(null=True)
+    human = FloatField(null=True)
+    lambda_dna = FloatField(null=True)
+    pUC19 = FloatField(null=True)
+    q20_rate = FloatField(null=True)
+    q30_rate = FloatField(null=True)
+    gc_content = FloatField(null=True)
+    mean_insert_size = FloatField(null=True)
+    percent_duplication = FloatField(null=True)
+    pct_selected_bases = FloatField(null=True)
+    fold_enrichment = FloatField(null=True)
+    zero_cvg_targets_pct = FloatField(null=True)
+    mean_target_coverage = FloatField(null=True)
+    pct_exc_dupe = FloatField(null=True)
+    pct_exc_off_target = FloatField(null=True)
+    fold_80_base_penalty = FloatField(null=True)
+    pct_target_bases_10x = FloatField(null=True)
+    pct_target_bases_20x = FloatField(null=True)
+    pct_target_bases_30x = FloatField(null=True)
+
+    class Meta:
+        table_name = 'sample_wide'
+
+class SampleName(BaseModel):
+    """
+    Every name a sample can be searched by: its id, its ptid and the source names
+    (aliases) its rows were ingested under. `name_key` is the lowercased name and
+    `name_rkey` the same reversed, so prefix and suffix searches are index range scans.
+    """
+    id = AutoField()
+    sample = TextField(index=True)
+    kind = TextField()
+    name = TextField()
+    name_key = TextField(index=True)
+    name_rkey = TextField(index=True)
+
+    class Meta:
+        table_name = 'sample_name'
+
+class SampleNameIndex(FTS5Model):
+    """
+    Trigram full-text index over sample_name.name, for infix and suffix searches.
+    Kept in sync with sample_name by triggers; see crud.create_sample_name_triggers.
+    """
+    name = SearchField()
+
+    class Meta:
+        database = db
+        table_name = 'sample_name_index'
+        options = {'content': SampleName, 'content_rowid': SampleName.id, 'tokenize': 'trigram'}
+
+class SelectedSample(BaseModel):
+    """Per-connection scratch list that large sample lookups join against; see crud.selected_samples."""
+    sample = TextField(primary_key=True)
+
+    class Meta:
+        table_name = 'selected_sample'
+        temporary = True
+        without_rowid = True
+
+class TableCount(BaseModel):
+    """Row count of each metric table, kept current by ingest so listings never run COUNT(*)."""
+    table_name = TextField(primary_key=True)
+    rows = IntegerField(default=0)
+
+class DatasetGeneration(BaseModel):
+    """Single row counting the ingests that changed the data, so responses can be tagged with the data they show."""
+    id = IntegerField(primary_key=True)
+    generation = IntegerField(default=0)
+
+class ColumnStats(BaseModel):
+    """Distribution sketch of one numeric column of a metric table, kept current by ingest; see services.stats."""
+    table_name = TextField()
+    column_name = TextField()
+    sketch = TextField()
+
+    class Meta:
+        table_name = 'column_stats'
+        primary_key = CompositeKey('table_name', 'column_name')
+
+class SampleIndex(BaseModel):
+    """Integer id of every sample ingested, the bit positions of cohort bitmaps. Ids are never reused."""
+    id = AutoField()
+    sample = TextField(unique=True)
+
+    class Meta:
+        table_name = 'sample_index'
+
+class Cohort(BaseModel):
+    """
+    A saved set of samples: a zlib-compressed bitmap over sample_index ids, with
+    the definition it was evaluated from (see services.cohorts).
+    """
+    name = TextField(primary_key=True)
+    bitmap = BlobField()
+    size = IntegerField()
+    definition = TextField()
+    owner = TextField()
+    updated_at = DateTimeField()
+
 class User(BaseModel):
     id = IntegerField(primary_key=True)
     username = TextField(unique=True)
@@ -283,3 +438,28 @@ class User(BaseModel):
     is_active = BooleanField(default=True)
     is_admin = BooleanField(default=False)
     status = TextField(default='pending')
+
+class IngestionLedger(BaseModel):
+    """One row per successfully ingested upload, keyed by a hash of its bytes."""
+    content_hash = TextField(primary_key=True)
+    filename = TextField()
+    rows_written = IntegerField(default=0)
+    ingested_at = DateTimeField()
+
+class SheetLedger(BaseModel):
+    """Content hash of the last ingested version of each sheet."""
+    sheet_name = TextField(primary_key=True)
+    table_name = TextField()
+    content_hash = TextField()
+    rows = IntegerField(default=0)
+    ingested_at = DateTimeField()
+
+class RowLedger(BaseModel):
+    """Hash of the last written values of each row, keyed by table and primary key."""
+    table_name = TextField()
+    row_key = TextField()
+    row_hash = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('table_name', 'row_key')
+        without_rowid = True
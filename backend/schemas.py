@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import date
-from typing import Optional, List, Union
+from typing import Dict, Optional, List, Union
 
 class UserBase(BaseModel):
     username: str
@@ -31,9 +31,50 @@ class Filter(BaseModel):
     operator: str
     value: Union[str, float]
 
+class FilterNode(BaseModel):
+    """
+    A node of a filter expression: "and"/"or" over `args`, "not" of one arg, or a
+    condition on `field`: a comparison (">=", "<=", ">", "<", "==") with `value`,
+    "in" a list of `values`, "between" two `values` (inclusive), or "is_null".
+    """
+    op: str
+    args: List["FilterNode"] = []
+    field: Optional[str] = None
+    value: Union[str, float, None] = None
+    values: List[Union[str, float]] = []
+
 class FilterSchema(BaseModel):
-    filters: List[Filter]
-    logical_operators: List[str]
+    filters: List[Filter] = []
+    logical_operators: List[str] = []
+    where: Optional[FilterNode] = None
+
+class CohortNode(BaseModel):
+    """
+    A node of a cohort definition: "union", "intersection" or "difference"
+    (the first argument less the others) of `args`, or a set of samples: a saved
+    "cohort" by `name`, the samples matching a "filter", those a "search" by
+    `search_term` finds, or listed "samples".
+    """
+    op: str
+    args: List["CohortNode"] = []
+    name: Optional[str] = None
+    filter: Optional[FilterSchema] = None
+    search_term: Optional[str] = None
+    samples: List[str] = []
+
+class QcLimits(BaseModel):
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+class QcSchema(BaseModel):
+    """
+    A cohort QC check: the metrics to score (default QC_METRICS), the robust
+    z-score beyond which a value is an outlier (default QC_Z_THRESHOLD) and
+    pass/fail limits by field (default QC_THRESHOLDS).
+    """
+    metrics: List[str] = []
+    z_threshold: Optional[float] = None
+    thresholds: Optional[Dict[str, QcLimits]] = None
 
 class ReportedAgesSchema(BaseModel):
     sample: str
@@ -61,15 +102,15 @@ class ReportedAgesSchema(BaseModel):
 
 class FastpSchema(BaseModel):
     sample: str
-    total_reads: Optional[str] = None
-    total_bases: Optional[str] = None
-    q20_bases: Optional[str] = None
-    q30_bases: Optional[str] = None
-    q20_rate: Optional[str] = None
-    q30_rate: Optional[str] = None
-    read1_mean_length: Optional[str] = None
-    read2_mean_length: Optional[str] = None
-    gc_content: Optional[str] = None
+    total_reads: Optional[int] = None
+    total_bases: Optional[int] = None
+    q20_bases: Optional[int] = None
+    q30_bases: Optional[int] = None
+    q20_rate: Optional[float] = None
+    q30_rate: Optional[float] = None
+    read1_mean_length: Optional[int] = None
+    read2_mean_length: Optional[int] = None
+    gc_content: Optional[float] = None
     passed_filter_reads: Optional[int] = None
     corrected_reads: Optional[int] = None
     corrected_bases: Optional[int] = None
@@ -86,14 +127,31 @@ class FastpSchema(BaseModel):
     polyx_trimmed_reads: Optional[str] = None
     total_polyx_trimmed_bases: Optional[int] = None
     polyx_trimmed_bases: Optional[str] = None
-    read1_total_reads: Optional[str] = None
-    read1_total_bases: Optional[str] = None
-    read1_q20_bases: Optional[str] = None
-    read1_q30_bases: Optional[str] = None
-    read2_total_reads: Optional[str] = None
-    read2_total_bases: Optional[str] = None
-    read2_q20_bases: Optional[str] = None
-    read2_q30_bases: Optional[str] = None
+    read1_total_reads: Optional[int] = None
+    read1_total_bases: Optional[int] = None
+    read1_q20_bases: Optional[int] = None
+    read1_q30_bases: Optional[int] = None
+    read2_total_reads: Optional[int] = None
+    read2_total_bases: Optional[int] = None
+    read2_q20_bases: Optional[int] = None
+    read2_q30_bases: Optional[int] = None
+    total_reads_before: Optional[int] = None
+    total_bases_before: Optional[int] = None
+    q20_bases_before: Optional[int] = None
+    q30_bases_before: Optional[int] = None
+    q20_rate_before: Optional[float] = None
+    q30_rate_before: Optional[float] = None
+    read1_mean_length_before: Optional[int] = None
+    read2_mean_length_before: Optional[int] = None
+    gc_content_before: Optional[float] = None
+    read1_total_reads_before: Optional[int] = None
+    read1_total_bases_before: Optional[int] = None
+    read1_q20_bases_before: Optional[int] = None
+    read1_q30_bases_before: Optional[int] = None
+    read2_total_reads_before: Optional[int] = None
+    read2_total_bases_before: Optional[int] = None
+    read2_q20_bases_before: Optional[int] = None
+    read2_q30_bases_before: Optional[int] = None
 
     class Config:
         from_attributes = True
@@ -109,7 +167,7 @@ class MarkdupSchema(BaseModel):
 
 class PicardAlignmentSummarySchema(BaseModel):
     sample: str
-    category: Optional[str] = None
+    category: str = ""
     total_reads: Optional[int] = None
     pf_reads: Optional[int] = None
     pct_pf_reads: Optional[float] = None
@@ -150,8 +208,8 @@ class PicardAlignmentSummarySchema(BaseModel):
 
 class PicardGcBiasSchema(BaseModel):
     sample: str
-    accumulation_level: Optional[float] = None
-    reads_used: Optional[int] = None
+    accumulation_level: Optional[str] = None
+    reads_used: Optional[str] = None
     gc: Optional[int] = None
     windows: Optional[int] = None
     read_starts: Optional[int] = None
@@ -166,8 +224,8 @@ class PicardGcBiasSchema(BaseModel):
 
 class PicardGcBiasSummarySchema(BaseModel):
     sample: str
-    accumulation_level: Optional[float] = None
-    reads_used: Optional[int] = None
+    accumulation_level: Optional[str] = None
+    reads_used: Optional[str] = None
     window_size: Optional[int] = None
     total_clusters: Optional[int] = None
     aligned_reads: Optional[int] = None
@@ -305,6 +363,7 @@ class PicardQualityYieldSchema(BaseModel):
 
 class ScreenSchema(BaseModel):
     sample: str
+    read: str = ""
     sample_r1r2: Optional[str] = None
     human: Optional[float] = None
     lambda_dna: Optional[float] = None
@@ -0,0 +1,120 @@
+import functools
+import json
+import operator
+import os
+import zlib
+
+import numpy as np
+from dotenv import load_dotenv
+
+from services import filters
+
+load_dotenv()
+
+# Leaves of a cohort definition, and the set operations combining them.
+SOURCES = ("cohort", "filter", "search", "samples")
+SET_OPERATIONS = {
+    "union": operator.or_,
+    "intersection": operator.and_,
+    "difference": lambda left, right: left & ~right,
+}
+
+# Longest cohort name accepted; names are used in URLs.
+COHORT_NAME_LENGTH = int(os.getenv("COHORT_NAME_LENGTH", "100"))
+
+# The sample index in memory; ingest empties it once it commits, as new samples get ids.
+INDEX_CACHE = filters.ResultCache(1)
+
+class SampleIndex:
+    """
+    The integer id of every sample, as stored in sample_index. Ids are never
+    reused, so a stored bitmap keeps its meaning as samples are added.
+    """
+
+    def __init__(self, rows: list[tuple[int, str]]):
+        self.ids = {sample: sample_id for sample_id, sample in rows}
+        self.samples = np.empty(max(self.ids.values(), default=-1) + 1, dtype=object)
+        for sample_id, sample in rows:
+            self.samples[sample_id] = sample
+
+    def bitmap(self, samples) -> int:
+        """
+        Returns the bitmap of the given samples; samples without an id (never ingested) are left out.
+        """
+        return to_bitmap([self.ids[sample] for sample in samples if sample in self.ids])
+
+    def members(self, bitmap: int) -> list[str]:
+        """
+        Returns the samples of a bitmap in sample order.
+        """
+        ids = to_ids(bitmap)
+        ids = ids[ids < len(self.samples)]
+        return sorted(sample for sample in self.samples[ids].tolist() if sample is not None)
+
+# A bitmap is a Python int with bit i set for sample id i, so union, intersection
+# and difference are single big-integer operations over 64-bit words.
+
+def to_bitmap(ids: list[int]) -> int:
+    if not ids:
+        return 0
+    ids = np.asarray(ids, dtype=np.int64)
+    bits = np.zeros(int(ids.max()) + 1, dtype=bool)
+    bits[ids] = True
+    return int.from_bytes(np.packbits(bits, bitorder="little").tobytes(), "little")
+
+def to_ids(bitmap: int) -> np.ndarray:
+    packed = np.frombuffer(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(packed, bitorder="little"))
+
+def dumps(bitmap: int) -> bytes:
+    # Runs of absent samples compress to almost nothing.
+    return zlib.compress(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little"))
+
+def loads(blob: bytes) -> int:
+    return int.from_bytes(zlib.decompress(blob), "little") if blob else 0
+
+def size(bitmap: int) -> int:
+    return bitmap.bit_count()
+
+def check_name(name: str) -> str:
+    name = name.strip()
+    if not name or len(name) > COHORT_NAME_LENGTH:
+        raise ValueError(f"Cohort names must be 1 to {COHORT_NAME_LENGTH} characters")
+    return name
+
+def check_definition(node):
+    """
+    Validates a CohortNode's shape before anything is evaluated.
+    """
+    op = node.op
+    if op in SET_OPERATIONS:
+        if not node.args:
+            raise ValueError(f"'{op}' needs at least one argument")
+        for arg in node.args:
+            check_definition(arg)
+        return
+    if op not in SOURCES:
+        raise ValueError(f"Unknown cohort operation '{op}', expected one of {', '.join(SOURCES + tuple(SET_OPERATIONS))}")
+    if op == "cohort" and not node.name:
+        raise ValueError("'cohort' needs a name")
+    if op == "filter":
+        if node.filter is None:
+            raise ValueError("'filter' needs a filter")
+        filters.criteria_expression(node.filter)
+    if op == "search" and not (node.search_term or "").strip():
+        raise ValueError("'search' needs a search_term")
+
+def combine(op: str, bitmaps: list[int]) -> int:
+    return functools.reduce(SET_OPERATIONS[op], bitmaps)
+
+def dump_definition(node) -> str:
+    return json.dumps(node.model_dump(exclude_defaults=True), separators=(",", ":"))
+
+def cohort_to_dict(cohort) -> dict:
+    return {
+        "name": cohort.name,
+        "size": cohort.size,
+        "owner": cohort.owner,
+        "updated_at": cohort.updated_at,
+        "definition": json.loads(cohort.definition),
+    }
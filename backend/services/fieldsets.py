@@ -0,0 +1,134 @@
+import os
+from typing import Optional
+
+from dotenv import load_dotenv
+
+import models
+from services import gc_bias, sample_wide
+
+load_dotenv()
+
+# Tables of the `tables` view, by the key each is returned under, in response order.
+TABLES = {
+    "ReportedAges": models.ReportedAges,
+    "BsRate": models.BsRate,
+    "Coverage": models.Coverage,
+    "Fastp": models.Fastp,
+    "Markdup": models.Markdup,
+    "PicardAlignmentSummary": models.PicardAlignmentSummary,
+    "PicardGcBias": models.PicardGcBias,
+    "PicardGcBiasSummary": models.PicardGcBiasSummary,
+    "PicardHs": models.PicardHs,
+    "PicardInsertSize": models.PicardInsertSize,
+    "PicardQualityYield": models.PicardQualityYield,
+    "Screen": models.Screen,
+}
+
+# Column sets a request can name with `profile`:
+#   full    - every column of every table
+#   summary - the combined view's columns, each from the table it is shown from
+PROFILES = ("full", "summary")
+
+# Profile of requests to the `tables` view that name no tables, columns or profile.
+DATA_PROFILE = os.getenv("DATA_PROFILE", "summary")
+
+def _table_names() -> dict[str, str]:
+    names = {name.lower(): name for name in TABLES}
+    names.update({model._meta.table_name: name for name, model in TABLES.items()})
+    return names
+
+TABLE_NAMES = _table_names()
+
+def table_columns(name: str) -> list[str]:
+    """
+    Returns every column a table returns. Packed GC-bias vectors are served by
+    the gc-bias endpoint instead.
+    """
+    model = TABLES[name]
+    excluded = gc_bias.CURVE_VECTORS if model is models.PicardGcBias else ()
+    return [field for field in model._meta.sorted_field_names if field not in excluded]
+
+def key_columns(name: str) -> list[str]:
+    return [field.name for field in TABLES[name]._meta.get_primary_keys()]
+
+def _profile_columns(name: str, profile: str) -> list[str]:
+    if profile == "full":
+        return table_columns(name)
+    return [column for column in sample_wide.SUMMARY_COLUMNS if sample_wide.COLUMN_SOURCES.get(column) is TABLES[name]]
+
+FULL = {name: table_columns(name) for name in TABLES}
+
+def _split(value: Optional[str]) -> list[str]:
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+def _table(name: str) -> str:
+    table = TABLE_NAMES.get(name.lower())
+    if table is None:
+        raise ValueError(f"Unknown table '{name}'")
+    return table
+
+def resolve(view: str, tables: Optional[str] = None, columns: Optional[str] = None,
+            profile: Optional[str] = None) -> Optional[dict[str, list[str]]]:
+    """
+    Returns the columns a data request returns per table (per "summary" for the
+    summary view), or None for everything. Key columns (sample, and e.g. read for
+    screen) are always returned; columns keep their table order.
+
+    `tables` and `columns` are comma-separated. A column is a bare name,
+    taken from every returned table that has it, or '<Table>.<column>'. Without
+    `tables`, the tables returned are those holding a requested column, or the
+    profile's tables.
+    """
+    requested = _split(columns)
+    if requested and profile is not None:
+        raise ValueError("Give either 'columns' or 'profile', not both")
+    if profile is not None and profile not in PROFILES:
+        raise ValueError(f"Unknown profile '{profile}', expected one of {', '.join(PROFILES)}")
+
+    if view == "summary":
+        if tables:
+            raise ValueError("'tables' does not apply to view=summary")
+        if not requested:
+            return None
+        for column in requested:
+            if column != "sample" and column not in sample_wide.WIDE_COLUMNS:
+                raise ValueError(f"Unknown column '{column}'")
+        return {"summary": ["sample"] + [column for column in sample_wide.WIDE_COLUMNS if column in requested]}
+
+    profile = profile or DATA_PROFILE
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown profile '{profile}', expected one of {', '.join(PROFILES)}")
+    selected = [_table(name) for name in _split(tables)]
+    if not requested and not selected and profile == "full":
+        return None
+
+    wanted = {}
+    if requested:
+        for column in requested:
+            table, _, name = column.rpartition(".")
+            if table:
+                table = _table(table)
+                if name not in table_columns(table):
+                    raise ValueError(f"Unknown column '{column}'")
+                if selected and table not in selected:
+                    raise ValueError(f"Column '{column}' is not in a requested table")
+                wanted.setdefault(table, set()).add(name)
+                continue
+            tables_with_column = [table for table in (selected or TABLES) if name in table_columns(table)]
+            if not tables_with_column:
+                raise ValueError(f"Unknown column '{column}'")
+            for table in tables_with_column:
+                wanted.setdefault(table, set()).add(name)
+    else:
+        for table in selected or TABLES:
+            profile_columns = _profile_columns(table, profile)
+            if profile_columns or selected:
+                wanted[table] = set(profile_columns)
+
+    fieldset = {}
+    for table in wanted:
+        keys = set(key_columns(table))
+        fieldset[table] = [column for column in table_columns(table) if column in keys or column in wanted[table]]
+    for table in selected:
+        fieldset.setdefault(table, key_columns(table))
+    return {table: fieldset[table] for table in TABLES if table in fieldset}
@@ -1,307 +1,334 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 from io import BytesIO
 import crud
-import schemas
-import math
-from typing import Type, Any, Optional
-from pydantic import BaseModel
-import re
+from database import db
+from services import cohorts, filters, http_cache, ledger, qc, readers, sample_wide, sheet_registry
 
-def extract_base_sample_id(sample_name: str) -> str:
+# Maximum number of rows written per multi-row INSERT statement.
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+
+# Worker processes used to parse workbook sheets in parallel; 0 or 1 parses serially.
+# Only spooled uploads (file paths) are parsed in parallel.
+INGEST_PARSE_PROCESSES = int(os.getenv("INGEST_PARSE_PROCESSES", "0"))
+
+# Invalid cells listed in full per sheet; further ones are only counted.
+INGEST_MAX_REPORTED_ERRORS = int(os.getenv("INGEST_MAX_REPORTED_ERRORS", "100"))
+
+# Rows per chunk when streaming the ages CSV and the sheets of a CSV zip;
+# 0 reads each file at once.
+# Peak memory scales with this value, not with the size of the upload.
+AGES_CSV_CHUNK_ROWS = int(os.getenv("AGES_CSV_CHUNK_ROWS", "50000"))
+
+def sheet_stats(sheet_name: str, model, row_count: int, started: float, rows_written: int = None, skipped: bool = False,
+                report: sheet_registry.SheetReport = None, rows_new: int = 0) -> dict:
     """
-    Extracts the base sample ID from a sample name like "CAP41WGS_MO026-preflight-R1".
+    Reports the throughput of one ingested sheet, and where its time went.
     """
-    match = re.match(r"(.+?)(?:-preflight-R\d+)?$", sample_name)
-    if match:
-        return match.group(1)
-    return sample_name
+    elapsed = time.perf_counter() - started
+    rows_per_second = row_count / elapsed if elapsed > 0 else 0.0
+    rows_written = row_count if rows_written is None else rows_written
+    rows_new = min(rows_new, rows_written)
+    if skipped:
+        print(f"{sheet_name}: unchanged since last ingest, skipped")
+    else:
+        print(f"{sheet_name}: {row_count} rows ({rows_written} changed) in {elapsed:.2f}s ({rows_per_second:.0f} rows/s)")
+    if report is not None and report.count:
+        print(f"{sheet_name}: {report.count} invalid cells stored as empty")
+    return {
+        "sheet": sheet_name,
+        "table": model._meta.table_name,
+        "rows": row_count,
+        "rows_written": rows_written,
+        "rows_skipped": row_count - rows_written,
+        "rows_new": rows_new,
+        "rows_updated": rows_written - rows_new,
+        "skipped": skipped,
+        "seconds": round(elapsed, 4),
+        "rows_per_second": round(rows_per_second, 1),
+        "stages": report.stage_seconds() if report is not None else {},
+        "invalid_cells": report.count if report is not None else 0,
+        "errors": report.errors if report is not None else [],
+    }
 
-def replace_nan_with_none(data: dict) -> dict:
+class IngestProgress:
     """
-    Replaces NaN values in a dictionary with None.
+    No-op progress hooks; background jobs override these to report per-sheet status.
     """
-    return {k: (None if isinstance(v, float) and math.isnan(v) else v) for k, v in data.items()}
 
-def normalize_keys_to_snake_case(data: dict) -> dict:
+    def file_skipped(self, content_hash: str):
+        pass
+
+    def sheets_found(self, sheet_names: list[str]):
+        pass
+
+    def sheet_started(self, sheet_name: str):
+        pass
+
+    def rows_written(self, sheet_name: str, rows: int):
+        pass
+
+    def sheet_finished(self, stats: dict):
+        pass
+
+    def sheet_failed(self, sheet_name: str, error: str):
+        pass
+
+SUPPORTED_EXTENSIONS = ('.csv', '.xlsx', '.zip')
+
+def check_supported(filename: str):
+    if not filename or not filename.endswith(SUPPORTED_EXTENSIONS):
+        raise ValueError("Unsupported file type")
+
+def process_uploaded_file(file, progress: IngestProgress = None, force: bool = False, dry_run: bool = False) -> list[dict]:
     """
-    Converts dictionary keys to snake_case.
-    Handles keys that might be in UPPERCASE_WITH_UNDERSCORES or PascalCase.
+    Ingests an uploaded ages CSV, QC workbook or zip of per-sheet CSVs and
+    returns per-sheet ingest statistics.
     """
-    normalized_data = {}
-    for key, value in data.items():
-        # First, handle the 'X' suffix specifically for numeric contexts (e.g., 1X, 10X)
-        # Convert '1X' to '1x' directly, without adding an underscore
-        temp_key = re.sub(r'(\d+)X', r'\1x', key)
-
-        # Determine if the key is predominantly ALL_CAPS_WITH_UNDERSCORES
-        # A simple heuristic: if it contains only uppercase letters, digits, and underscores
-        if re.fullmatch(r'[A-Z0-9_]+', temp_key):
-            snake_case_key = temp_key.lower()
+    return ingest_file(file.filename, file.file, progress, force=force, dry_run=dry_run)
+
+def ingest_file(filename: str, source, progress: IngestProgress = None, force: bool = False,
+                dry_run: bool = False) -> list[dict]:
+    """
+    Ingests an ages CSV, QC workbook or zip of per-sheet CSVs, given as a path
+    or file object, in a single transaction and returns per-sheet ingest statistics.
+
+    A file with the same content as the last file ingested is skipped, as are
+    unchanged sheets and rows within any other file, so re-uploading an earlier
+    version rolls back to it. force re-writes everything.
+    dry_run runs every stage, writes included, then rolls the transaction back.
+    The sample_wide rows, search names and cohort ids of every sample written are
+    refreshed in the same transaction, as is the dataset generation if anything was
+    written. Once it commits, cached filter and QC results, the sample index and
+    cached responses are dropped.
+    """
+    check_supported(filename)
+    progress = progress or IngestProgress()
+    content_hash = ledger.file_content_hash(source)
+    if not force:
+        previous = crud.get_last_ingested_file()
+        if previous is not None and previous.content_hash == content_hash:
+            print(f"{filename}: same content as {previous.filename} ingested at {previous.ingested_at}, skipped")
+            progress.file_skipped(content_hash)
+            return []
+    touched_samples = set()
+    with db.atomic() as transaction:
+        if filename.endswith('.csv'):
+            stats = process_ages_file(source, progress, force=force, content_hash=content_hash, touched_samples=touched_samples)
         else:
-            # Otherwise, assume it's PascalCase or camelCase and convert
-            s1 = re.sub(r'(.)([A-Z][a-z]+)', r'\1_\2', temp_key)
-            snake_case_key = re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
-        
-        # Clean up any multiple underscores that might have been introduced
-        snake_case_key = re.sub(r'_{2,}', '_', snake_case_key)
-        
-        # Remove leading/trailing underscores
-        snake_case_key = snake_case_key.strip('_')
+            stats = process_qc_file(source, progress, filename=filename, force=force, touched_samples=touched_samples)
+        started = time.perf_counter()
+        crud.refresh_sample_wide(touched_samples)
+        crud.refresh_sample_names(touched_samples)
+        crud.index_samples(touched_samples)
+        print(f"sample_wide: {len(touched_samples)} samples refreshed in {time.perf_counter() - started:.2f}s")
+        new_rows = {}
+        for sheet in stats:
+            new_rows[sheet["table"]] = new_rows.get(sheet["table"], 0) + sheet["rows_new"]
+        crud.add_row_counts(new_rows)
+        crud.record_ingested_file(filename, content_hash, sum(sheet["rows_written"] for sheet in stats))
+        if touched_samples:
+            generation = crud.bump_dataset_generation()
+        if dry_run:
+            transaction.rollback()
+            print(f"{filename}: dry run, rolled back")
+    if touched_samples and not dry_run:
+        drop_caches(generation)
+    return stats
 
-        normalized_data[snake_case_key] = value
-    return normalized_data
+def drop_caches(generation: int):
+    """
+    Drops this process's cached filter and QC results, sample index and responses,
+    all computed before the data reached `generation`.
+    """
+    filters.RESULT_CACHE.clear()
+    qc.QC_CACHE.clear()
+    cohorts.INDEX_CACHE.clear()
+    http_cache.RESPONSE_CACHE.set_generation(generation)
 
+def sync_generation():
+    """
+    Drops this process's caches if an ingest committed since it last looked,
+    including one run by another worker process. Costs one primary-key lookup.
+    """
+    generation = crud.get_dataset_generation()
+    if generation > http_cache.RESPONSE_CACHE.generation:
+        drop_caches(generation)
 
-def convert_numeric_fields(row_data: dict, schema_class: Type[BaseModel]) -> dict:
+def _ingest_sheet(sheet_name: str, spec, read_batches, progress: IngestProgress, started: float = None,
+                  content_hash: str = None, force: bool = False, report: sheet_registry.SheetReport = None,
+                  touched_samples: set = None) -> dict:
     """
-    Converts fields in row_data to int or float based on schema_class annotations.
-    Handles cases where numeric data might be read as strings from Excel.
+    Upserts each batch of parsed rows yielded by read_batches(report) before reading the next;
+    invalid cells are collected in report rather than failing the sheet.
+    Sheets whose content hash matches the last ingest are skipped, and within a
+    batch only rows whose hash changed are written. The samples of written rows
+    are added to touched_samples, and the table's column sketches updated.
     """
-    converted_data = row_data.copy()
-    for field_name, field_info in schema_class.model_fields.items():
-        if field_name in converted_data and converted_data[field_name] is not None:
-            value = converted_data[field_name]
-            # Check if the field is Optional[int] or Optional[float]
-            if field_info.annotation == Optional[int] or field_info.annotation == int:
-                try:
-                    converted_data[field_name] = int(value)
-                except (ValueError, TypeError):
-                    converted_data[field_name] = None
-            elif field_info.annotation == Optional[float] or field_info.annotation == float:
-                try:
-                    converted_data[field_name] = float(value)
-                except (ValueError, TypeError):
-                    converted_data[field_name] = None
-    return converted_data
-
-
-def process_uploaded_file(file):
-    if file.filename.endswith('.csv'):
-        process_ages_file(file.file)
-    elif file.filename.endswith('.xlsx'):
-        process_qc_file(file.file)
-    else:
-        raise ValueError("Unsupported file type")
+    progress.sheet_started(sheet_name)
+    started = started if started is not None else time.perf_counter()
+    table_name = spec.model._meta.table_name
+    report = report if report is not None else sheet_registry.SheetReport(sheet_name, INGEST_MAX_REPORTED_ERRORS)
+    if content_hash is not None and not force and crud.get_sheet_hash(sheet_name) == content_hash:
+        stats = sheet_stats(sheet_name, spec.model, 0, started, skipped=True, report=report)
+        progress.sheet_finished(stats)
+        return stats
+    row_count = 0
+    rows_written = 0
+    rows_new = 0
+    table_stats = crud.load_table_stats(spec.model)
+    try:
+        for rows in read_batches(report):
+            with report.timed("write"):
+                changed, row_hashes = ledger.changed_rows(spec.model, rows, force=force)
+                if changed:
+                    # The stored values of updated rows leave the column sketches as the new ones enter.
+                    columns = table_stats.columns(changed)
+                    existing = crud.get_existing_rows(spec.model, changed, columns)
+                    rows_new += len(changed) - len(existing)
+                    table_stats.update(changed, columns, existing)
+                crud.bulk_upsert(spec.model, changed, batch_size=INGEST_BATCH_SIZE)
+                crud.record_row_hashes(table_name, row_hashes)
+            if touched_samples is not None:
+                touched_samples.update(row["sample"] for row in changed)
+            row_count += len(rows)
+            rows_written += len(changed)
+            progress.rows_written(sheet_name, row_count)
+        with report.timed("write"):
+            if rows_written:
+                crud.save_table_stats(table_stats)
+            if content_hash is not None:
+                crud.record_sheet_hash(sheet_name, table_name, content_hash, row_count)
+        stats = sheet_stats(sheet_name, spec.model, row_count, started, rows_written=rows_written, report=report,
+                            rows_new=rows_new)
+    except Exception as e:
+        progress.sheet_failed(sheet_name, str(e))
+        raise
+    progress.sheet_finished(stats)
+    return stats
+
+def process_ages_file(ages_file, progress: IngestProgress = None, force: bool = False, content_hash: str = None,
+                      touched_samples: set = None) -> list[dict]:
+    # Process ages file; the whole file is one sheet, so its hash is the file's
+    progress = progress or IngestProgress()
+    spec = sheet_registry.REPORTED_AGES
+    progress.sheets_found([spec.name])
+    read_batches = lambda report: sheet_registry.parse_frames(spec, readers.read_csv_frames(ages_file, AGES_CSV_CHUNK_ROWS), report)
+    return [_ingest_sheet(spec.name, spec, read_batches, progress, content_hash=content_hash, force=force,
+                          touched_samples=touched_samples)]
+
+def parse_sheet(qc_path: str, filename: str, sheet_name: str) -> tuple[str, list[dict], float, str, sheet_registry.SheetReport]:
+    """
+    Reads and maps one sheet of a workbook or CSV zip. Runs in a parse worker
+    process, so it only touches the file and the sheet registry, never the database.
+    """
+    started = time.perf_counter()
+    spec = sheet_registry.get_sheet_spec(sheet_name)
+    rows = []
+    report = sheet_registry.SheetReport(sheet_name, INGEST_MAX_REPORTED_ERRORS)
+    with readers.open_sheet_source(filename, qc_path, chunk_rows=AGES_CSV_CHUNK_ROWS) as source:
+        # Hashing an Excel sheet parses it, so it counts as reading.
+        with report.timed("read"):
+            content_hash = source.content_hash(sheet_name)
+        for batch in sheet_registry.parse_frames(spec, source.read_frames(sheet_name), report):
+            rows.extend(batch)
+    return sheet_name, rows, time.perf_counter() - started, content_hash, report
 
-def process_ages_file(ages_file):
-    # Process ages file
-    ages_df = pd.read_csv(ages_file)
-    for _, row in ages_df.iterrows():
-        # Clean up column names
-        row_data = {
-            "sample": row.get("Sample"),
-            "gender": row.get("gender"),
-            "age": row.get("age"),
-            "sample_date": row.get("sampleDate"),
-            "menopausal_status": row.get("menopausalStatus"),
-            "ptid": row.get("ptid"),
-            "esti_gender": row.get("esti_gender"),
-            "cfdna": row.get("cfdna"),
-            "wbc": row.get("WBC"),
-            "colon": row.get("colon"),
-            "liver": row.get("liver"),
-            "ovary": row.get("ovary"),
-            "pancreas": row.get("pancreas"),
-            "prostate": row.get("prostate"),
-            "small_intestine": row.get("small_intestine"),
-            "spleen": row.get("spleen"),
-            "stomach": row.get("stomach"),
-            "adj_ovary_menopause": row.get("adjOvary(menopause)"),
-            "adj_ovary_no_menopause": row.get("adjOvary(noMenopause)")
-        }
-        cleaned_row_data = replace_nan_with_none(row_data)
-        ages_schema = schemas.ReportedAgesSchema(**cleaned_row_data)
-        crud.upsert_reported_ages(ages_schema)
-
-def process_qc_file(qc_file):
-    # Process qc file
-    xls = pd.ExcelFile(qc_file)
-    for sheet_name in xls.sheet_names:
-        print(sheet_name)
-        df = pd.read_excel(xls, sheet_name=sheet_name)
-        if sheet_name == "bsrate":
-            for _, row in df.iterrows():
-                row_data = {
-                    "sample": row.get("Sample"),
-                    "puc19vector": row.get("pUC19vector"),
-                    "lambda_dna_conversion_rate": row.get("λ-DNA(ConversionRate)")
-                }
-                cleaned_row_data = replace_nan_with_none(row_data)
-                bs_rate_schema = schemas.BsRateSchema(**cleaned_row_data)
-                crud.upsert_bs_rate(bs_rate_schema)
-        elif sheet_name == "coverage":
-            for _, row in df.iterrows():
-                row_data = {
-                    "sample": row.get("Sample"),
-                    "pct_v2_sites_5x": row.get("PCT_V2_sites_5X"),
-                    "pct_v2_sites_15x": row.get("PCT_V2_sites_15X"),
-                    "pct_v2_sites_20x": row.get("PCT_V2_sites_20X"),
-                    "pct_pcages_sites_5x": row.get("PCT_PCages_sites_5X"),
-                    "pct_pcages_sites_15x": row.get("PCT_PCages_sites_15X"),
-                    "pct_pcages_sites_20x": row.get("PCT_PCages_sites_20X"),
-                    "pct_horvath_sites_5x": row.get("PCT_horvath_sites_5X"),
-                    "pct_horvath_sites_15x": row.get("PCT_horvath_sites_15X"),
-                    "pct_horvath_sites_20x": row.get("PCT_horvath_sites_20X"),
-                    "pct_skinblood_sites_5x": row.get("PCT_skinblood_sites_5X"),
-                    "pct_skinblood_sites_15x": row.get("PCT_skinblood_sites_15X"),
-                    "pct_skinblood_sites_20x": row.get("PCT_skinblood_sites_20X")
-                }
-                cleaned_row_data = replace_nan_with_none(row_data)
-                coverage_schema = schemas.CoverageSchema(**cleaned_row_data)
-                crud.upsert_coverage(coverage_schema)
-        elif sheet_name == "fastp":
-            for _, row in df.iterrows():
-                row_data = row.to_dict()
-                row_data['sample'] = row_data.pop('Sample')
-                cleaned_row_data = replace_nan_with_none(row_data)
-                fastp_schema = schemas.FastpSchema(**cleaned_row_data)
-                crud.upsert_fastp(fastp_schema)
-        elif sheet_name == "markdup.markdup.txt":
-            for _, row in df.iterrows():
-                row_data = row.to_dict()
-                
-                # Prioritize 'Sample' (correct sample name) and remove 'SAMPLE' if it's empty
-                if "SAMPLE" in row_data and (pd.isna(row_data["SAMPLE"]) or row_data["SAMPLE"] is None):
-                    del row_data["SAMPLE"]
-                
-                row_data = normalize_keys_to_snake_case(row_data) # Normalize keys
-                
-                cleaned_row_data = replace_nan_with_none(row_data)
-                converted_row_data = convert_numeric_fields(cleaned_row_data, schemas.MarkdupSchema)
-                markdup_schema = schemas.MarkdupSchema(**converted_row_data)
-                crud.upsert_markdup(markdup_schema)
-        elif sheet_name == "picard.alignmentSummary.txt":
-            for _, row in df.iterrows():
-                row_data = row.to_dict()
-                
-                # Prioritize 'Sample' (correct sample name) and remove 'SAMPLE' if it's empty
-                if "SAMPLE" in row_data and (pd.isna(row_data["SAMPLE"]) or row_data["SAMPLE"] is None):
-                    del row_data["SAMPLE"]
-                
-                row_data = normalize_keys_to_snake_case(row_data) # Normalize keys
-                
-                cleaned_row_data = replace_nan_with_none(row_data)
-                converted_row_data = convert_numeric_fields(cleaned_row_data, schemas.PicardAlignmentSummarySchema)
-                picard_alignment_summary_schema = schemas.PicardAlignmentSummarySchema(**converted_row_data)
-                crud.upsert_picard_alignment_summary(picard_alignment_summary_schema)
-        elif sheet_name == "picard.gcBias":
-            for _, row in df.iterrows():
-                row_data = row.to_dict()
-                
-                # Prioritize 'Sample' (correct sample name) and remove 'SAMPLE' if it's empty
-                if "SAMPLE" in row_data and (pd.isna(row_data["SAMPLE"]) or row_data["SAMPLE"] is None):
-                    del row_data["SAMPLE"]
-                
-                row_data = normalize_keys_to_snake_case(row_data) # Normalize keys
-                
-                cleaned_row_data = replace_nan_with_none(row_data)
-                converted_row_data = convert_numeric_fields(cleaned_row_data, schemas.PicardGcBiasSchema)
-                picard_gc_bias_schema = schemas.PicardGcBiasSchema(**converted_row_data)
-                crud.upsert_picard_gc_bias(picard_gc_bias_schema)
-        elif sheet_name == "picard.gcBiasSummary.txt":
-            for _, row in df.iterrows():
-                row_data = row.to_dict()
-                
-                # Prioritize 'Sample' (correct sample name) and remove 'SAMPLE' if it's empty
-                if "SAMPLE" in row_data and (pd.isna(row_data["SAMPLE"]) or row_data["SAMPLE"] is None):
-                    del row_data["SAMPLE"]
-                
-                row_data = normalize_keys_to_snake_case(row_data) # Normalize keys
-                
-                cleaned_row_data = replace_nan_with_none(row_data)
-                converted_row_data = convert_numeric_fields(cleaned_row_data, schemas.PicardGcBiasSummarySchema)
-                picard_gc_bias_summary_schema = schemas.PicardGcBiasSummarySchema(**converted_row_data)
-                crud.upsert_picard_gc_bias_summary(picard_gc_bias_summary_schema)
-        elif sheet_name == "picard.hs.txt":
-            for _, row in df.iterrows():
-                row_data = row.to_dict()
-                
-                # Prioritize 'Sample' (correct sample name) and remove 'SAMPLE' if it's empty
-                if "SAMPLE" in row_data and (pd.isna(row_data["SAMPLE"]) or row_data["SAMPLE"] is None):
-                    del row_data["SAMPLE"]
-                
-                row_data = normalize_keys_to_snake_case(row_data) # Normalize keys
-                
-                cleaned_row_data = replace_nan_with_none(row_data)
-                converted_row_data = convert_numeric_fields(cleaned_row_data, schemas.PicardHsSchema)
-                picard_hs_schema = schemas.PicardHsSchema(**converted_row_data)
-                crud.upsert_picard_hs(picard_hs_schema)
-        elif sheet_name == "picard.insertSize.txt":
-            for _, row in df.iterrows():
-                row_data = row.to_dict()
-                
-                # Prioritize 'Sample' (correct sample name) and remove 'SAMPLE' if it's empty
-                if "SAMPLE" in row_data and (pd.isna(row_data["SAMPLE"]) or row_data["SAMPLE"] is None):
-                    del row_data["SAMPLE"]
-                
-                row_data = normalize_keys_to_snake_case(row_data) # Normalize keys
-                
-                cleaned_row_data = replace_nan_with_none(row_data)
-                converted_row_data = convert_numeric_fields(cleaned_row_data, schemas.PicardInsertSizeSchema)
-                picard_insert_size_schema = schemas.PicardInsertSizeSchema(**converted_row_data)
-                crud.upsert_picard_insert_size(picard_insert_size_schema)
-        elif sheet_name == "picard.qualityYield.txt":
-            for _, row in df.iterrows():
-                row_data = row.to_dict()
-                
-                # Prioritize 'Sample' (correct sample name) and remove 'SAMPLE' if it's empty
-                if "SAMPLE" in row_data and (pd.isna(row_data["SAMPLE"]) or row_data["SAMPLE"] is None):
-                    del row_data["SAMPLE"]
-                
-                row_data = normalize_keys_to_snake_case(row_data) # Normalize keys
-                
-                cleaned_row_data = replace_nan_with_none(row_data)
-                converted_row_data = convert_numeric_fields(cleaned_row_data, schemas.PicardQualityYieldSchema)
-                picard_quality_yield_schema = schemas.PicardQualityYieldSchema(**converted_row_data)
-                crud.upsert_picard_quality_yield(picard_quality_yield_schema)
-        elif sheet_name == "screen":
-            for _, row in df.iterrows():
-                sample_name = row.get("Sample")
-                base_sample_id = extract_base_sample_id(sample_name) if sample_name else None
-                
-                row_data = {
-                    "sample": base_sample_id,
-                    "sample_r1r2": sample_name,
-                    "human": row.get("Human"),
-                    "lambda_dna": row.get("λ-DNA"),
-                    "pUC19": row.get("pUC19"),
-                    "human_unmap": row.get("Human_unmap")
-                }
-                
-                cleaned_row_data = replace_nan_with_none(row_data)
-                converted_row_data = convert_numeric_fields(cleaned_row_data, schemas.ScreenSchema)
-                screen_schema = schemas.ScreenSchema(**converted_row_data)
-                crud.upsert_screen(screen_schema)
+_parse_pool = None
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """
+    Returns the shared parse pool, starting it on first use. Workers are spawned
+    rather than forked because the server process runs threads.
+    """
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(
+            max_workers=INGEST_PARSE_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _parse_pool
+
+def shutdown_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+def process_qc_file(qc_file, progress: IngestProgress = None, filename: str = "methyl_qc.xlsx", force: bool = False,
+                    touched_samples: set = None) -> list[dict]:
+    # Process qc file; a .zip filename selects the per-sheet CSV layout
+    progress = progress or IngestProgress()
+    with readers.open_sheet_source(filename, qc_file, chunk_rows=AGES_CSV_CHUNK_ROWS) as source:
+        sheet_names = []
+        for sheet_name in source.sheet_names():
+            if sheet_registry.get_sheet_spec(sheet_name) is None:
+                print(f"{sheet_name}: no table registered, skipped")
+                continue
+            sheet_names.append(sheet_name)
+        progress.sheets_found(sheet_names)
+
+        parallel = INGEST_PARSE_PROCESSES > 1 and isinstance(qc_file, (str, os.PathLike)) and len(sheet_names) > 1
+        if not parallel:
+            stats = []
+            for sheet_name in sheet_names:
+                spec = sheet_registry.get_sheet_spec(sheet_name)
+                started = time.perf_counter()
+                report = sheet_registry.SheetReport(sheet_name, INGEST_MAX_REPORTED_ERRORS)
+                # Hashing an Excel sheet parses it, so it counts as reading.
+                with report.timed("read"):
+                    content_hash = source.content_hash(sheet_name)
+                read_batches = lambda report: sheet_registry.parse_frames(spec, source.read_frames(sheet_name), report)
+                stats.append(_ingest_sheet(
+                    sheet_name, spec, read_batches, progress, started,
+                    content_hash=content_hash, force=force, report=report, touched_samples=touched_samples,
+                ))
+            return stats
+    return _process_qc_file_parallel(qc_file, filename, sheet_names, progress, force=force, touched_samples=touched_samples)
+
+def _process_qc_file_parallel(qc_path, filename: str, sheet_names: list[str], progress: IngestProgress, force: bool = False,
+                              touched_samples: set = None) -> list[dict]:
+    """
+    Parses sheets in the parse pool and writes each one from this thread as soon
+    as it arrives, so SQLite only ever sees a single writer.
+    """
+    pool = get_parse_pool()
+    futures = {pool.submit(parse_sheet, qc_path, filename, sheet_name): sheet_name for sheet_name in sheet_names}
+    stats = {}
+    try:
+        for future in as_completed(futures):
+            try:
+                sheet_name, rows, parse_seconds, content_hash, report = future.result()
+            except Exception as e:
+                progress.sheet_failed(futures[future], str(e))
+                raise
+            spec = sheet_registry.get_sheet_spec(sheet_name)
+            # Count parse time in the sheet's throughput, as the serial path does.
+            started = time.perf_counter() - parse_seconds
+            stats[sheet_name] = _ingest_sheet(
+                sheet_name, spec, lambda report: [rows], progress, started,
+                content_hash=content_hash, force=force, report=report, touched_samples=touched_samples,
+            )
+    finally:
+        for future in futures:
+            future.cancel()
+    return [stats[sheet_name] for sheet_name in sheet_names]
 
 def generate_excel_file(samples: list[str]):
     data = crud.get_data_by_samples(samples)
 
-    DESIRED_COLUMNS = [
-        "sample", "ptid", "gender", "esti_gender", "age", "total_bases",
-        "puc19vector", "lambda_dna_conversion_rate", "human", "lambda_dna",
-        "pUC19", "q30_rate", "mean_insert_size", "percent_duplication",
-        "pct_selected_bases", "fold_enrichment", "zero_cvg_targets_pct",
-        "mean_target_coverage", "pct_exc_dupe", "pct_exc_off_target",
-        "fold_80_base_penalty", "pct_target_bases_10x",
-        "pct_target_bases_20x", "pct_target_bases_30x",
-    ]
-
-    # Process data to create a combined view
-    sample_map = {}
-    for table_name, records in data.items():
-        for record in records:
-            sample_id = record.get("sample")
-            if sample_id:
-                if sample_id not in sample_map:
-                    sample_map[sample_id] = {}
-                sample_map[sample_id].update(record)
+    # The combined view is materialized in sample_wide
+    sample_map = {record["sample"]: record for record in crud.get_sample_summaries(samples)}
 
     combined_data = []
     # Use the original samples list to maintain order
     for sample_id in samples:
         if sample_id in sample_map:
             record = sample_map[sample_id]
-            processed_record = {col: record.get(col) for col in DESIRED_COLUMNS}
+            processed_record = {col: record.get(col) for col in sample_wide.SUMMARY_COLUMNS}
             combined_data.append(processed_record)
 
     output = BytesIO()
@@ -0,0 +1,287 @@
+import functools
+import json
+import operator
+import os
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from dotenv import load_dotenv
+from peewee import FloatField, IntegerField
+
+import models
+from services import sample_wide
+
+load_dotenv()
+
+OPERATORS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    ">": operator.gt,
+    "<": operator.lt,
+    "==": operator.eq,
+}
+
+LOGICAL_OPERATORS = ("and", "or")
+
+# Conditions a column index can serve, besides the comparisons.
+INDEXED_CONDITIONS = ("in", "between", "is_null")
+
+class Column(NamedTuple):
+    name: str
+    model: type
+    field: str
+    type: str
+
+def numeric_fields(model) -> list:
+    return [
+        field for field in model._meta.sorted_fields
+        if isinstance(field, (IntegerField, FloatField)) and not field.primary_key
+    ]
+
+def _catalogue() -> dict[str, Column]:
+    """
+    Every numeric column of the metric tables, by '<table>.<column>' and by bare
+    column name. A bare name shared by several tables (e.g. total_reads) means
+    the first of them in SOURCE_MODELS order.
+    """
+    catalogue = {}
+    for model in sample_wide.SOURCE_MODELS:
+        for field in numeric_fields(model):
+            kind = "integer" if isinstance(field, IntegerField) else "float"
+            column = Column(field.name, model, field.name, kind)
+            catalogue[f"{model._meta.table_name}.{field.name}"] = column
+            catalogue.setdefault(field.name, column)
+    return catalogue
+
+CATALOGUE = _catalogue()
+
+def resolve(name: str) -> Column:
+    column = CATALOGUE.get(name)
+    if column is None:
+        raise ValueError(f"Unknown field '{name}'")
+    return column
+
+def target(column: Column) -> tuple[type, str]:
+    """
+    Returns the table and column a filter on `column` reads. sample_wide holds the
+    value of single-row tables it shows, so those filters need no join of their own;
+    multi-row tables (e.g. screen reads) are read directly, a sample matching if
+    any of its rows does, as are columns sample_wide can take from another table.
+    """
+    model = column.model
+    if (
+        model is not models.ReportedAges
+        and column.field in sample_wide.SINGLE_SOURCE_COLUMNS
+        and sample_wide.COLUMN_SOURCES.get(column.field) is model
+        and not model._meta.composite_key
+    ):
+        return models.SampleWide, column.field
+    return model, column.field
+
+def sort_target(column: Column) -> tuple[type, str]:
+    """
+    Returns the table and column a sort on `column` reads. Columns the summary
+    view shows sort by the value it shows, so a multi-row table's column (e.g. a
+    screen read's human) sorts by its last row; other multi-row columns have no
+    single value per sample and can't be sorted on. A single-row table's column
+    that sample_wide can take from another table sorts by the table's own value.
+    """
+    model = column.model
+    if (
+        model is not models.ReportedAges
+        and sample_wide.COLUMN_SOURCES.get(column.field) is model
+        and (column.field in sample_wide.SINGLE_SOURCE_COLUMNS or model._meta.composite_key)
+    ):
+        return models.SampleWide, column.field
+    if model._meta.composite_key:
+        raise ValueError(f"Can't sort by '{column.name}': {model._meta.table_name} has several rows per sample")
+    return model, column.field
+
+def qualified_name(column: Column) -> str:
+    return f"{column.model._meta.table_name}.{column.field}"
+
+def _number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Filter value '{value}' is not a number")
+
+def canonical(node) -> list:
+    """
+    Returns a FilterNode as a nested list in a canonical form, so equivalent
+    filters compare and hash alike: fields are qualified, values are floats,
+    nested and/or are flattened and their arguments sorted and deduplicated,
+    double negations are dropped and 'in' values sorted.
+      ["and"|"or", arg, ...], ["not", arg],
+      [">=", field, value] (and the other comparisons), ["in", field, [value, ...]],
+      ["between", field, low, high], ["is_null", field]
+    """
+    op = node.op
+    if op in LOGICAL_OPERATORS:
+        if not node.args:
+            raise ValueError(f"'{op}' needs at least one argument")
+        args = []
+        for arg in map(canonical, node.args):
+            args.extend(arg[1:] if arg[0] == op else [arg])
+        args = sorted({json.dumps(arg): arg for arg in args}.values(), key=json.dumps)
+        return args[0] if len(args) == 1 else [op, *args]
+    if op == "not":
+        if len(node.args) != 1:
+            raise ValueError("'not' needs exactly one argument")
+        arg = canonical(node.args[0])
+        return arg[1] if arg[0] == "not" else ["not", arg]
+
+    if node.field is None:
+        raise ValueError(f"'{op}' needs a field")
+    field = qualified_name(resolve(node.field))
+    if op in OPERATORS:
+        return [op, field, _number(node.value)]
+    if op == "in":
+        if not node.values:
+            raise ValueError("'in' needs at least one value")
+        return [op, field, sorted({_number(value) for value in node.values})]
+    if op == "between":
+        if len(node.values) != 2:
+            raise ValueError("'between' needs exactly two values")
+        return [op, field, *map(_number, node.values)]
+    if op == "is_null":
+        return [op, field]
+    raise ValueError(f"Unknown operator '{op}'")
+
+class FilterTree(NamedTuple):
+    """A FilterNode built in code, e.g. from the flat filter list."""
+    op: str
+    args: list = []
+    field: Optional[str] = None
+    value: object = None
+    values: list = []
+
+def _leaf(f) -> FilterTree:
+    return FilterTree(f.operator, field=f.field, value=f.value)
+
+def criteria_expression(criteria) -> Optional[list]:
+    """
+    Returns the canonical expression of a FilterSchema, or None if it has no
+    conditions. The flat `filters` list is folded left to right by its
+    `logical_operators`, as (a and b) or c.
+    """
+    if criteria.where is not None:
+        if criteria.filters:
+            raise ValueError("Give either 'where' or 'filters', not both")
+        return canonical(criteria.where)
+    if len(criteria.logical_operators) != max(len(criteria.filters) - 1, 0):
+        raise ValueError("Expected one logical operator between each pair of filters")
+    for op in criteria.logical_operators:
+        if op not in LOGICAL_OPERATORS:
+            raise ValueError(f"Unknown logical operator '{op}'")
+    if not criteria.filters:
+        return None
+    first, *rest = criteria.filters
+    node = _leaf(first)
+    for op, f in zip(criteria.logical_operators, rest):
+        node = FilterTree(op, [node, _leaf(f)])
+    return canonical(node)
+
+def expression_key(expression: list) -> str:
+    return json.dumps(expression, separators=(",", ":"))
+
+def conjuncts(expression: list) -> list[list]:
+    """
+    Returns the arguments of a top-level 'and', or the expression itself.
+    """
+    return expression[1:] if expression[0] == "and" else [expression]
+
+def expression_columns(expression: list) -> list[tuple[type, str]]:
+    """
+    Returns the (table, column) pairs an expression reads, in order of appearance.
+    """
+    if expression[0] in LOGICAL_OPERATORS or expression[0] == "not":
+        pairs = [pair for arg in expression[1:] for pair in expression_columns(arg)]
+        return list(dict.fromkeys(pairs))
+    return [target(resolve(expression[1]))]
+
+def compile_expression(expression: list):
+    """
+    Compiles a canonical expression into a peewee expression over the tables target() picks.
+    """
+    op = expression[0]
+    if op == "and":
+        return functools.reduce(operator.and_, map(compile_expression, expression[1:]))
+    if op == "or":
+        return functools.reduce(operator.or_, map(compile_expression, expression[1:]))
+    if op == "not":
+        return ~compile_expression(expression[1])
+    model, field = target(resolve(expression[1]))
+    column = getattr(model, field)
+    if op == "in":
+        return column.in_(expression[2])
+    if op == "between":
+        return column.between(expression[2], expression[3])
+    if op == "is_null":
+        return column.is_null()
+    return OPERATORS[op](column, expression[2])
+
+class ResultCache:
+    """
+    LRU of results read from the ingested data, e.g. the samples each filter
+    expression matched. Ingest empties it once its transaction commits; results
+    computed while an ingest was committing are not stored.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.generation = 0
+        self._results: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[Optional[object], int]:
+        """
+        Returns the cached result (or None) and the generation to store a fresh result under.
+        """
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+            return result, self.generation
+
+    def put(self, key: str, result, generation: int):
+        with self._lock:
+            if generation != self.generation or self.size <= 0:
+                return
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._results.clear()
+
+# Catalogue names to give a secondary index on the column their filters read.
+# The default covers the columns the frontend sidebar offers.
+FILTER_INDEXES = [name.strip() for name in os.getenv(
+    "FILTER_INDEXES",
+    "age,total_reads,total_bases,puc19vector,lambda_dna_conversion_rate,human,"
+    "lambda_dna,pUC19,q20_rate,q30_rate,gc_content,mean_insert_size,"
+    "percent_duplication,pct_selected_bases,fold_enrichment,zero_cvg_targets_pct,"
+    "mean_target_coverage,pct_exc_dupe,pct_exc_off_target,fold_80_base_penalty,"
+    "pct_target_bases_10x,pct_target_bases_20x,pct_target_bases_30x",
+).split(",") if name.strip()]
+
+# Catalogue names to give a secondary index on the column sorts on them read, so
+# their pages come from an index range scan; indexes of FILTER_INDEXES serve too.
+# Sorts on other columns scan and sort their whole table.
+SORT_INDEXES = [name.strip() for name in os.getenv("SORT_INDEXES", "").split(",") if name.strip()]
+
+# Matching rows counted, at most, per indexed predicate when estimating selectivity.
+FILTER_PROBE_ROWS = int(os.getenv("FILTER_PROBE_ROWS", "1000"))
+
+# With FILTER_DEBUG=1 every filter prints its plan and /api/v1/data/filter/explain is served.
+FILTER_DEBUG = os.getenv("FILTER_DEBUG", "0") == "1"
+
+# Filter expressions whose matching samples are kept in memory; 0 disables the cache.
+FILTER_CACHE_SIZE = int(os.getenv("FILTER_CACHE_SIZE", "256"))
+
+RESULT_CACHE = ResultCache(FILTER_CACHE_SIZE)
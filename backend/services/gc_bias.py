@@ -0,0 +1,71 @@
+from typing import Iterator
+
+import numpy as np
+
+# Storage dtype of each per-bin vector of a GC-bias curve, packed little-endian.
+# Missing values are stored as NaN in float vectors and 0 in integer vectors.
+CURVE_VECTORS = {
+    "gc": "<u1",
+    "windows": "<i8",
+    "read_starts": "<i8",
+    "mean_base_quality": "<f8",
+    "normalized_coverage": "<f8",
+    "error_bar_width": "<f8",
+}
+
+# Picard writes one curve per sample, accumulation level and read set (ALL / UNIQUE).
+CURVE_KEY = ("sample", "accumulation_level", "reads_used")
+
+def pack(values: list, dtype: str) -> bytes:
+    array = np.asarray([np.nan if value is None else value for value in values], dtype=np.float64)
+    if np.dtype(dtype).kind in "iu":
+        array = np.nan_to_num(array, nan=0.0)
+    return array.astype(dtype).tobytes()
+
+def unpack(blob: bytes, dtype: str) -> np.ndarray:
+    return np.frombuffer(blob, dtype=dtype) if blob else np.empty(0, dtype=dtype)
+
+def collect_curves(batches: Iterator[list[dict]]) -> Iterator[list[dict]]:
+    """
+    Folds per-bin rows into one record per curve, with each vector packed into a BLOB.
+    A curve's bins may be spread over several batches, so curves are emitted once the sheet is read;
+    only the bin values are held until then.
+    """
+    curves = {}
+    for rows in batches:
+        for row in rows:
+            key = tuple(row.get(name) or "" for name in CURVE_KEY)
+            curve = curves.get(key)
+            if curve is None:
+                curve = curves[key] = {
+                    "library": row.get("library"),
+                    "read_group": row.get("read_group"),
+                    "bins": [],
+                }
+            curve["bins"].append(tuple(row.get(name) for name in CURVE_VECTORS))
+
+    records = []
+    for key, curve in curves.items():
+        bins = sorted(curve["bins"], key=lambda values: (values[0] is None, values[0]))
+        record = dict(zip(CURVE_KEY, key))
+        record["bins"] = len(bins)
+        for index, (name, dtype) in enumerate(CURVE_VECTORS.items()):
+            record[name] = pack([values[index] for values in bins], dtype)
+        record["library"] = curve["library"]
+        record["read_group"] = curve["read_group"]
+        records.append(record)
+    if records:
+        yield records
+
+def curve_to_dict(curve, vectors: tuple[str, ...] = tuple(CURVE_VECTORS)) -> dict:
+    """
+    Unpacks a stored curve into plain lists, keeping only the requested vectors.
+    """
+    result = {name: getattr(curve, name) for name in CURVE_KEY}
+    result["bins"] = curve.bins
+    result["library"] = curve.library
+    result["read_group"] = curve.read_group
+    for name in vectors:
+        values = unpack(getattr(curve, name), CURVE_VECTORS[name])
+        result[name] = [None if value != value else value for value in values.tolist()]
+    return result
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional
+
+from dotenv import load_dotenv
+from fastapi import Request, Response
+
+from services import serialization
+
+load_dotenv()
+
+# Bytes of response bodies kept in memory across all cached responses; 0 disables the cache.
+# ETags and 304s work either way.
+HTTP_CACHE_BYTES = int(os.getenv("HTTP_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Browsers keep the response but revalidate it with If-None-Match on every use;
+# private keeps shared proxies from serving it to other users.
+CACHE_CONTROL = "private, no-cache"
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    media_type: str
+    headers: dict
+
+class ResponseCache:
+    """
+    LRU of response bodies by ETag, within a byte budget. An ETag is derived
+    from the request and the dataset generation, which each committed ingest
+    bumps; changing the generation empties the cache, and responses computed
+    while it changed are not stored.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.generation = 0
+        self.size = 0
+        self._responses: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def etag(self, request: Request, key=None) -> tuple[str, int]:
+        """
+        Returns the strong ETag of a request at the current generation, and that
+        generation. `key` holds what the response depends on beyond the method,
+        path and query string, e.g. the parsed body of a POST.
+        """
+        generation = self.generation
+        request_key = json.dumps(
+            [request.method, request.url.path, sorted(request.query_params.multi_items()), key],
+            separators=(",", ":"), sort_keys=True, default=str,
+        )
+        digest = hashlib.sha256(request_key.encode()).hexdigest()[:32]
+        return f'"{generation}-{digest}"', generation
+
+    def get(self, etag: str) -> Optional[CachedResponse]:
+        with self._lock:
+            response = self._responses.get(etag)
+            if response is not None:
+                self._responses.move_to_end(etag)
+            return response
+
+    def put(self, etag: str, response: CachedResponse, generation: int):
+        with self._lock:
+            if generation != self.generation or len(response.body) > self.budget or etag in self._responses:
+                return
+            self._responses[etag] = response
+            self.size += len(response.body)
+            while self.size > self.budget:
+                _, evicted = self._responses.popitem(last=False)
+                self.size -= len(evicted.body)
+
+    def set_generation(self, generation: int):
+        with self._lock:
+            # Ingests can finish committing out of order; the generation never goes back.
+            self.generation = max(self.generation, generation)
+            self._responses.clear()
+            self.size = 0
+
+RESPONSE_CACHE = ResponseCache(HTTP_CACHE_BYTES)
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match compares weakly: W/"x" matches "x".
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+def json_body(content) -> CachedResponse:
+    return CachedResponse(serialization.dumps(content), "application/json", {})
+
+def respond(request: Request, compute: Callable[[], CachedResponse], key=None) -> Response:
+    """
+    Answers a read request: 304 if the client already holds the current
+    response, the cached body if there is one, otherwise the body `compute`
+    renders, cached for the next request. Exceptions of `compute` propagate.
+    """
+    etag, generation = RESPONSE_CACHE.etag(request, key)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if _matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    cached = RESPONSE_CACHE.get(etag)
+    if cached is None:
+        cached = compute()
+        RESPONSE_CACHE.put(etag, cached, generation)
+    return Response(content=cached.body, media_type=cached.media_type, headers={**cached.headers, **headers})
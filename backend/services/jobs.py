@@ -0,0 +1,187 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from database import db
+from services import file_handler
+
+load_dotenv()
+
+# Number of uploads ingested concurrently. SQLite serializes writers, so 1 is usually right.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+# Directory uploads are spooled to before a worker picks them up.
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "cohortdb_uploads"))
+# Number of finished jobs kept in memory for status queries.
+JOB_HISTORY_LIMIT = int(os.getenv("JOB_HISTORY_LIMIT", "100"))
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+class IngestJob:
+    """
+    Tracks one queued upload. Workers report progress through the
+    file_handler.IngestProgress hooks; readers take snapshots.
+    """
+
+    def __init__(self, filename: str, path: str, force: bool = False, dry_run: bool = False):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.path = path
+        self.force = force
+        self.dry_run = dry_run
+        self.skipped = False
+        self.status = "queued"
+        self.created_at = _now()
+        self.started_at: Optional[str] = None
+        self.finished_at: Optional[str] = None
+        self.current_sheet: Optional[str] = None
+        self.error: Optional[str] = None
+        self._sheets: "OrderedDict[str, dict]" = OrderedDict()
+        self._started = None
+        self._elapsed: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def file_skipped(self, content_hash: str):
+        with self._lock:
+            self.skipped = True
+
+    def sheets_found(self, sheet_names: list[str]):
+        with self._lock:
+            for name in sheet_names:
+                self._sheets.setdefault(name, {"sheet": name, "status": "pending", "rows": 0})
+
+    def sheet_started(self, sheet_name: str):
+        with self._lock:
+            self.current_sheet = sheet_name
+            entry = self._sheets.setdefault(sheet_name, {"sheet": sheet_name, "rows": 0})
+            entry["status"] = "running"
+
+    def rows_written(self, sheet_name: str, rows: int):
+        with self._lock:
+            self._sheets.setdefault(sheet_name, {"sheet": sheet_name})["rows"] = rows
+
+    def sheet_finished(self, stats: dict):
+        with self._lock:
+            entry = self._sheets.setdefault(stats["sheet"], {"sheet": stats["sheet"]})
+            entry.update(stats)
+            entry["status"] = "done"
+            self.current_sheet = None
+
+    def sheet_failed(self, sheet_name: str, error: str):
+        with self._lock:
+            entry = self._sheets.setdefault(sheet_name, {"sheet": sheet_name, "rows": 0})
+            entry["status"] = "failed"
+            entry["error"] = error
+
+    def mark_running(self):
+        with self._lock:
+            self.status = "running"
+            self.started_at = _now()
+            self._started = time.perf_counter()
+
+    def mark_finished(self, error: Optional[str] = None):
+        with self._lock:
+            self.status = "failed" if error else "succeeded"
+            self.error = error
+            self.finished_at = _now()
+            self.current_sheet = None
+            if self._started is not None:
+                self._elapsed = time.perf_counter() - self._started
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            sheets = [dict(entry) for entry in self._sheets.values()]
+            if self._elapsed is not None:
+                elapsed = self._elapsed
+            elif self._started is not None:
+                elapsed = time.perf_counter() - self._started
+            else:
+                elapsed = None
+            return {
+                "id": self.id,
+                "filename": self.filename,
+                "status": self.status,
+                "dry_run": self.dry_run,
+                "skipped": self.skipped,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "seconds": round(elapsed, 4) if elapsed is not None else None,
+                "current_sheet": self.current_sheet,
+                "sheets_done": sum(1 for sheet in sheets if sheet.get("status") == "done"),
+                "sheets_total": len(sheets),
+                "rows": sum(sheet.get("rows", 0) for sheet in sheets),
+                "invalid_cells": sum(sheet.get("invalid_cells", 0) for sheet in sheets),
+                "sheets": sheets,
+                "error": self.error,
+            }
+
+_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+_jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+_jobs_lock = threading.Lock()
+
+def spool_upload(upload) -> str:
+    """
+    Copies an UploadFile to the spool directory and returns the path.
+    """
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    suffix = os.path.splitext(upload.filename or "")[1]
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=UPLOAD_SPOOL_DIR)
+    with os.fdopen(fd, "wb") as spooled:
+        upload.file.seek(0)
+        shutil.copyfileobj(upload.file, spooled, length=1024 * 1024)
+    return path
+
+def _prune_history():
+    finished = [job_id for job_id, job in _jobs.items() if job.is_finished]
+    for job_id in finished[:max(0, len(finished) - JOB_HISTORY_LIMIT)]:
+        del _jobs[job_id]
+
+def _run(job: IngestJob):
+    job.mark_running()
+    try:
+        with db.connection_context():
+            file_handler.ingest_file(job.filename, job.path, progress=job, force=job.force, dry_run=job.dry_run)
+    except Exception as e:
+        print(f"Ingest job {job.id} ({job.filename}) failed: {e}")
+        job.mark_finished(error=str(e))
+    else:
+        job.mark_finished()
+    finally:
+        try:
+            os.remove(job.path)
+        except OSError:
+            pass
+
+def submit_upload(upload, force: bool = False, dry_run: bool = False) -> IngestJob:
+    """
+    Spools an upload to disk and queues it for background ingestion.
+    """
+    file_handler.check_supported(upload.filename)
+    job = IngestJob(upload.filename, spool_upload(upload), force=force, dry_run=dry_run)
+    with _jobs_lock:
+        _prune_history()
+        _jobs[job.id] = job
+    _executor.submit(_run, job)
+    return job
+
+def get_job(job_id: str) -> Optional[IngestJob]:
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
+    file_handler.shutdown_parse_pool()
@@ -0,0 +1,60 @@
+import hashlib
+import os
+
+import pandas as pd
+
+import crud
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def new_hash():
+    return hashlib.blake2b(digest_size=16)
+
+def file_content_hash(source) -> str:
+    """
+    Hashes an upload given as a path or a seekable file object, leaving the
+    file object rewound.
+    """
+    digest = new_hash()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+    else:
+        source.seek(0)
+        for block in iter(lambda: source.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+        source.seek(0)
+    return digest.hexdigest()
+
+def frame_content_hash(df: pd.DataFrame) -> str:
+    """
+    Hashes a parsed sheet: its headers and the vectorized per-row hashes of its cells.
+    """
+    digest = new_hash()
+    digest.update("\x1f".join(str(column) for column in df.columns).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def row_key(key_names: tuple[str, ...], row: dict) -> str:
+    return "\x1f".join(str(row[name]) for name in key_names)
+
+def row_hash(row: dict) -> int:
+    digest = hashlib.blake2b(repr(tuple(row.values())).encode(), digest_size=8).digest()
+    # Signed, so it fits SQLite's 64-bit INTEGER.
+    return int.from_bytes(digest, "big", signed=True)
+
+def changed_rows(model, rows: list[dict], force: bool = False) -> tuple[list[dict], dict[str, int]]:
+    """
+    Drops rows whose values match the hash recorded at their last write, unless
+    force is set. Returns the rows to write and the new hashes to record for them.
+    """
+    if not rows:
+        return [], {}
+    key_names = tuple(field.name for field in model._meta.get_primary_keys())
+    # Rows sharing a key collapse to the last one, as they would in the upsert.
+    latest = {row_key(key_names, row): row for row in rows}
+    hashes = {key: row_hash(row) for key, row in latest.items()}
+    stored = {} if force else crud.get_row_hashes(model._meta.table_name, list(hashes))
+    changed = {key: digest for key, digest in hashes.items() if stored.get(key) != digest}
+    return [latest[key] for key in changed], changed
@@ -0,0 +1,21 @@
+import base64
+import json
+
+def encode_cursor(key: list) -> str:
+    """
+    Encodes the sort key of the last row of a page as an opaque, URL-safe cursor.
+    """
+    payload = json.dumps(key, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+def decode_cursor(cursor: str, length: int) -> list:
+    """
+    Decodes a cursor made by encode_cursor, checking it holds a key of `length` values.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, list) or len(key) != length:
+        raise ValueError("Invalid cursor")
+    return key
@@ -0,0 +1,170 @@
+import json
+import os
+import warnings
+from typing import NamedTuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from services import filters, stats
+
+load_dotenv()
+
+# Metrics a cohort QC check reads when the request names none.
+QC_METRICS = [name.strip() for name in os.getenv(
+    "QC_METRICS",
+    "total_bases,puc19vector,lambda_dna_conversion_rate,human,lambda_dna,pUC19,"
+    "q30_rate,mean_insert_size,percent_duplication,pct_selected_bases,"
+    "fold_enrichment,zero_cvg_targets_pct,mean_target_coverage,pct_exc_dupe,"
+    "pct_exc_off_target,fold_80_base_penalty,pct_target_bases_10x,"
+    "pct_target_bases_20x,pct_target_bases_30x",
+).split(",") if name.strip()]
+
+# Robust z-score beyond which a value is an outlier (3.5 is Iglewicz and Hoaglin's cut-off).
+QC_Z_THRESHOLD = float(os.getenv("QC_Z_THRESHOLD", "3.5"))
+
+# Pass/fail limits applied when the request gives none, as JSON: {"<field>": {"min": 0.99, "max": null}, ...}
+QC_THRESHOLDS = json.loads(os.getenv("QC_THRESHOLDS", "{}"))
+
+# QC checks whose flags are kept in memory until the next ingest; 0 disables the cache.
+QC_CACHE_SIZE = int(os.getenv("QC_CACHE_SIZE", "32"))
+
+QC_CACHE = filters.ResultCache(QC_CACHE_SIZE)
+
+# Scales the median absolute deviation (or, when it is 0, the mean absolute
+# deviation) to the standard deviation of normally distributed values.
+_MAD_SCALE = 0.6745
+_MEAN_AD_SCALE = 0.7979
+
+class Matrix(NamedTuple):
+    """The value of each metric (column) for each sample (row); NaN where a sample has none."""
+    samples: list[str]
+    metrics: list[str]
+    values: np.ndarray
+
+class Check(NamedTuple):
+    metrics: list[str]
+    z_threshold: float
+    low: np.ndarray
+    high: np.ndarray
+
+def metric_target(name: str) -> tuple[type, str]:
+    """
+    Returns the table and column a metric is read from: one value per sample,
+    as for sorting, so a screen metric is that of the R2 read.
+    """
+    column = filters.resolve(name)
+    try:
+        return filters.sort_target(column)
+    except ValueError:
+        raise ValueError(f"Can't check '{name}': {column.model._meta.table_name} has several rows per sample")
+
+def parse_check(request) -> Check:
+    """
+    Resolves a QcSchema against the defaults: its metrics (plus any metric it
+    gives a threshold for) by qualified name, and each metric's limits, NaN
+    where it has none.
+    """
+    names = request.metrics or QC_METRICS
+    thresholds = request.thresholds
+    if thresholds is None:
+        thresholds = {field: limits for field, limits in QC_THRESHOLDS.items()}
+    else:
+        thresholds = {field: limits.model_dump() for field, limits in thresholds.items()}
+    z_threshold = QC_Z_THRESHOLD if request.z_threshold is None else request.z_threshold
+    if z_threshold <= 0:
+        raise ValueError("z_threshold must be positive")
+
+    limits = {}
+    for name in list(names) + list(thresholds):
+        # Raises for columns with no single value per sample.
+        metric_target(name)
+        limits.setdefault(filters.qualified_name(filters.resolve(name)), {})
+    for name, bounds in thresholds.items():
+        limits[filters.qualified_name(filters.resolve(name))].update(
+            {bound: value for bound, value in bounds.items() if value is not None})
+    metrics = list(limits)
+    low = np.array([limits[metric].get("min", np.nan) for metric in metrics], dtype=float)
+    high = np.array([limits[metric].get("max", np.nan) for metric in metrics], dtype=float)
+    return Check(metrics, z_threshold, low, high)
+
+def check_key(check: Check) -> str:
+    return json.dumps([check.metrics, check.z_threshold, check.low.tolist(), check.high.tolist()], separators=(",", ":"))
+
+def empty_matrix(samples: list[str], metrics: list[str]) -> Matrix:
+    return Matrix(samples, metrics, np.full((len(samples), len(metrics)), np.nan))
+
+def fill(matrix: Matrix, positions: list[int], rows: list[tuple], index: dict[str, int]):
+    """
+    Writes rows of (sample, value, ...) into the matrix columns at `positions`.
+    Samples not in `index` are skipped; text stored in a numeric column reads as NaN.
+    """
+    rows = [row for row in rows if row[0] in index]
+    if rows:
+        matrix.values[np.ix_([index[row[0]] for row in rows], positions)] = stats.to_array([row[1:] for row in rows])
+
+def robust_z(values: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the robust z-score of every value, by column, with each column's
+    median and scaled median absolute deviation. A column whose MAD is 0 falls
+    back to its mean absolute deviation; one without spread scores 0.
+    """
+    present = ~np.isnan(values)
+    # Columns without any value get NaN statistics and no flags.
+    with warnings.catch_warnings(), np.errstate(all="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(values, axis=0)
+        deviation = np.abs(values - median)
+        mad = np.nanmedian(deviation, axis=0) / _MAD_SCALE
+        mean_ad = np.nanmean(deviation, axis=0) / _MEAN_AD_SCALE
+    scale = np.where(mad > 0, mad, mean_ad)
+    spread = scale > 0
+    z = np.zeros_like(values)
+    np.divide(values - median, scale, out=z, where=present & spread)
+    z[~present] = np.nan
+    return z, median, scale
+
+def flag(matrix: Matrix, check: Check) -> dict:
+    """
+    Flags, in one pass over the whole matrix, every value that is an outlier
+    (|robust z| above the threshold) or outside its metric's limits, and returns
+    the flagged samples with their offending metrics.
+    """
+    values = matrix.values
+    z, median, scale = robust_z(values)
+    with np.errstate(invalid="ignore"):
+        outlier = np.abs(z) > check.z_threshold
+        below = values < check.low
+        above = values > check.high
+    flagged = outlier | below | above
+
+    samples = []
+    for row in np.flatnonzero(flagged.any(axis=1)).tolist():
+        metrics = []
+        for position in np.flatnonzero(flagged[row]).tolist():
+            reasons = [reason for reason, hit in (("outlier", outlier), ("below_min", below), ("above_max", above))
+                       if hit[row, position]]
+            metrics.append({
+                "field": matrix.metrics[position],
+                "value": float(values[row, position]),
+                "z": float(z[row, position]),
+                "reasons": reasons,
+            })
+        samples.append({"sample": matrix.samples[row], "metrics": metrics})
+
+    return {
+        "samples_checked": len(matrix.samples),
+        "z_threshold": check.z_threshold,
+        "metrics": [
+            {
+                "field": metric,
+                "median": None if np.isnan(median[position]) else float(median[position]),
+                "scale": None if np.isnan(scale[position]) else float(scale[position]),
+                "min": None if np.isnan(check.low[position]) else float(check.low[position]),
+                "max": None if np.isnan(check.high[position]) else float(check.high[position]),
+                "flagged": int(flagged[:, position].sum()),
+            }
+            for position, metric in enumerate(matrix.metrics)
+        ],
+        "flagged": samples,
+    }
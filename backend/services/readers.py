@@ -0,0 +1,182 @@
+import codecs
+import importlib.util
+import os
+import posixpath
+import zipfile
+from abc import ABC, abstractmethod
+from typing import Iterator
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from services import ledger
+
+load_dotenv()
+
+# Engine used to read QC workbooks:
+#   openpyxl        - pandas' default reader
+#   openpyxl-stream - openpyxl in read-only mode, rows streamed straight into a DataFrame
+#   calamine        - Rust-based reader, needs the optional python-calamine package
+XLSX_ENGINE = os.getenv("XLSX_ENGINE", "openpyxl")
+XLSX_ENGINES = ("openpyxl", "openpyxl-stream", "calamine")
+
+# Encodings tried, in order, for per-sheet CSVs. The exported sheets use GBK for 'λ'.
+CSV_ENCODINGS = [encoding.strip() for encoding in os.getenv("CSV_ENCODINGS", "utf-8,gb18030").split(",") if encoding.strip()]
+
+def check_xlsx_engine(engine: str):
+    if engine not in XLSX_ENGINES:
+        raise ValueError(f"Unknown XLSX_ENGINE '{engine}', expected one of {', '.join(XLSX_ENGINES)}")
+    if engine == "calamine" and importlib.util.find_spec("python_calamine") is None:
+        raise ValueError("XLSX_ENGINE=calamine requires the python-calamine package")
+
+def read_csv_frames(csv_file, chunk_rows: int = 0, encoding: str = None) -> Iterator[pd.DataFrame]:
+    """
+    Yields a CSV as DataFrames of at most chunk_rows rows, or as one frame if chunk_rows <= 0.
+    """
+    if chunk_rows <= 0:
+        yield pd.read_csv(csv_file, encoding=encoding)
+        return
+    with pd.read_csv(csv_file, chunksize=chunk_rows, encoding=encoding) as reader:
+        yield from reader
+
+class SheetSource(ABC):
+    """
+    An upload made of named sheets: an XLSX workbook or a zip of per-sheet CSVs.
+    """
+
+    @abstractmethod
+    def sheet_names(self) -> list[str]:
+        ...
+
+    @abstractmethod
+    def read_frames(self, sheet_name: str) -> Iterator[pd.DataFrame]:
+        ...
+
+    @abstractmethod
+    def content_hash(self, sheet_name: str) -> str:
+        """
+        Returns a hash that changes whenever the sheet's content does.
+        """
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ExcelSource(SheetSource):
+    def __init__(self, source, engine: str = XLSX_ENGINE):
+        check_xlsx_engine(engine)
+        self.engine = engine
+        self._cached = None
+        if engine == "openpyxl-stream":
+            import openpyxl
+            self._workbook = openpyxl.load_workbook(source, read_only=True, data_only=True, keep_links=False)
+            self._excel = None
+        else:
+            self._workbook = None
+            self._excel = pd.ExcelFile(source, engine=engine)
+
+    def sheet_names(self) -> list[str]:
+        if self._workbook is not None:
+            return list(self._workbook.sheetnames)
+        return list(self._excel.sheet_names)
+
+    def _read_frame(self, sheet_name: str) -> pd.DataFrame:
+        # The last sheet read is cached so hashing it and then ingesting it parses it once.
+        if self._cached is not None and self._cached[0] == sheet_name:
+            return self._cached[1]
+        if self._workbook is None:
+            frame = pd.read_excel(self._excel, sheet_name=sheet_name)
+        else:
+            frame = self._read_stream(sheet_name)
+        self._cached = (sheet_name, frame)
+        return frame
+
+    def _read_stream(self, sheet_name: str) -> pd.DataFrame:
+        rows = self._workbook[sheet_name].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return pd.DataFrame()
+        columns = [f"Unnamed: {index}" if name is None else str(name) for index, name in enumerate(header)]
+        frame = pd.DataFrame.from_records(rows, columns=columns)
+        # Read-only worksheets can report trailing blank rows; drop them like pandas does.
+        return frame.dropna(how="all")
+
+    def read_frames(self, sheet_name: str) -> Iterator[pd.DataFrame]:
+        frame = self._read_frame(sheet_name)
+        self._cached = None
+        yield frame
+
+    def content_hash(self, sheet_name: str) -> str:
+        return ledger.frame_content_hash(self._read_frame(sheet_name))
+
+    def close(self):
+        if self._workbook is not None:
+            self._workbook.close()
+        if self._excel is not None:
+            self._excel.close()
+
+class CsvZipSource(SheetSource):
+    """
+    A zip of per-sheet CSVs named '<sheet>.csv', e.g. 'picard.hs.txt.csv' holds sheet 'picard.hs.txt'.
+    """
+
+    def __init__(self, source, chunk_rows: int = 0):
+        self.chunk_rows = chunk_rows
+        self._zip = zipfile.ZipFile(source)
+        self._scans = {}
+        self._members = {}
+        for info in self._zip.infolist():
+            name = posixpath.basename(info.filename)
+            if info.is_dir() or info.filename.startswith("__MACOSX/") or not name.lower().endswith(".csv"):
+                continue
+            self._members.setdefault(name[:-len(".csv")], info)
+
+    def sheet_names(self) -> list[str]:
+        return list(self._members)
+
+    def _scan(self, info: zipfile.ZipInfo) -> tuple[str, str]:
+        """
+        Returns the member's encoding and content hash from one streaming pass.
+        Decoding the whole member up front means a late non-UTF-8 byte can't fail mid-ingest.
+        """
+        if info.filename in self._scans:
+            return self._scans[info.filename]
+        for encoding in CSV_ENCODINGS:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            digest = ledger.new_hash()
+            try:
+                with self._zip.open(info) as member:
+                    for block in iter(lambda: member.read(1024 * 1024), b""):
+                        decoder.decode(block)
+                        digest.update(block)
+                decoder.decode(b"", final=True)
+            except UnicodeDecodeError:
+                continue
+            self._scans[info.filename] = (encoding, digest.hexdigest())
+            return self._scans[info.filename]
+        raise ValueError(f"Could not decode {info.filename} as any of {', '.join(CSV_ENCODINGS)}")
+
+    def read_frames(self, sheet_name: str) -> Iterator[pd.DataFrame]:
+        info = self._members[sheet_name]
+        encoding, _ = self._scan(info)
+        with self._zip.open(info) as member:
+            yield from read_csv_frames(member, self.chunk_rows, encoding)
+
+    def content_hash(self, sheet_name: str) -> str:
+        return self._scan(self._members[sheet_name])[1]
+
+    def close(self):
+        self._zip.close()
+
+def open_sheet_source(filename: str, source, chunk_rows: int = 0) -> SheetSource:
+    """
+    Opens an uploaded workbook (.xlsx) or zip of per-sheet CSVs (.zip).
+    """
+    if filename.endswith(".zip"):
+        return CsvZipSource(source, chunk_rows=chunk_rows)
+    return ExcelSource(source)
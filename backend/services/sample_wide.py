@@ -0,0 +1,53 @@
+import models
+
+# Columns of the combined per-sample view, in display order: the frontend grid
+# and the summary sheet of the Excel export show these.
+SUMMARY_COLUMNS = [
+    "sample", "ptid", "gender", "esti_gender", "age", "total_bases",
+    "puc19vector", "lambda_dna_conversion_rate", "human", "lambda_dna",
+    "pUC19", "q30_rate", "mean_insert_size", "percent_duplication",
+    "pct_selected_bases", "fold_enrichment", "zero_cvg_targets_pct",
+    "mean_target_coverage", "pct_exc_dupe", "pct_exc_off_target",
+    "fold_80_base_penalty", "pct_target_bases_10x",
+    "pct_target_bases_20x", "pct_target_bases_30x",
+]
+
+# Metric tables in the order get_data_by_samples lists them. The combined view
+# merges a sample's rows in this order, so a later table's value wins, and of a
+# multi-row table (e.g. screen reads) the last row in key order.
+SOURCE_MODELS = [
+    models.ReportedAges,
+    models.BsRate,
+    models.Coverage,
+    models.Fastp,
+    models.Markdup,
+    models.PicardAlignmentSummary,
+    models.PicardGcBias,
+    models.PicardGcBiasSummary,
+    models.PicardHs,
+    models.PicardInsertSize,
+    models.PicardQualityYield,
+    models.Screen,
+]
+
+WIDE_COLUMNS = [name for name in models.SampleWide._meta.sorted_field_names if name != "sample"]
+
+# The wide columns each metric table contributes, for the tables that contribute any.
+SOURCES = [
+    (model, [name for name in WIDE_COLUMNS if name in model._meta.fields])
+    for model in SOURCE_MODELS
+    if any(name in model._meta.fields for name in WIDE_COLUMNS)
+]
+
+# The table whose value a wide column shows when a sample has rows in all of them.
+COLUMN_SOURCES = {name: [model for model, columns in SOURCES if name in columns][-1] for name in WIDE_COLUMNS}
+
+# Wide columns only one metric table contributes. Any other column (total_bases)
+# falls back to an earlier table's value for samples without a row in the last one.
+SINGLE_SOURCE_COLUMNS = {name for name in WIDE_COLUMNS if sum(name in columns for _, columns in SOURCES) == 1}
+
+def wide_row(merged: dict) -> dict:
+    """
+    Projects a sample's merged rows onto the sample_wide columns.
+    """
+    return {"sample": merged["sample"], **{name: merged.get(name) for name in WIDE_COLUMNS}}
@@ -0,0 +1,42 @@
+import re
+
+import models
+
+# '*' matches any run of characters in a search term: 'CAP41*', '*MO026' or '*MO02*'.
+WILDCARD = "*"
+
+# Columns holding the source names a sample's rows were ingested under.
+ALIAS_FIELDS = [models.Screen.sample_r1r2]
+
+def split_terms(search_term: str) -> list[str]:
+    return [term.strip() for term in search_term.split(",") if term.strip()]
+
+def name_key(name: str) -> str:
+    return name.lower()
+
+def plan(term: str) -> tuple[str, str]:
+    """
+    Picks the index lookup for a term:
+      ("exact", key)     - no wildcard; seeks name_key
+      ("prefix", key)    - only a trailing wildcard; range scan on name_key
+      ("suffix", rkey)   - only a leading wildcard; range scan on the reversed name_rkey
+      ("trigram", term)  - anything else; trigram index, then matcher()
+    """
+    if WILDCARD not in term:
+        return "exact", name_key(term)
+    if WILDCARD not in term[:-1]:
+        return "prefix", name_key(term[:-1])
+    if WILDCARD not in term[1:]:
+        return "suffix", name_key(term[1:])[::-1]
+    return "trigram", term
+
+def like_pattern(term: str) -> str:
+    """
+    Translates a term into a LIKE pattern for the trigram index. LIKE also treats
+    '_' and '%' as wildcards, so candidates are re-checked with matcher().
+    """
+    return term.replace(WILDCARD, "%")
+
+def matcher(term: str) -> re.Pattern:
+    parts = (re.escape(part) for part in name_key(term).split(WILDCARD))
+    return re.compile(".*".join(parts), re.DOTALL)
@@ -0,0 +1,53 @@
+from typing import Optional
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional: responses fall back to FastAPI's encoder
+    orjson = None
+
+# Layouts of each table of a data response:
+#   rows    - a list of {column: value} records
+#   columns - {column: [value, ...]}, one list per column, in row order
+LAYOUTS = ("rows", "columns")
+
+def dumps(content) -> bytes:
+    """
+    Renders content as JSON with orjson when it is installed: dates and
+    datetimes become ISO strings and NaN becomes null. Otherwise content goes
+    through jsonable_encoder, as FastAPI's default response does.
+    """
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return JSONResponse(content=jsonable_encoder(content)).body
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response rendered by dumps(). Routes that return it directly skip
+    FastAPI's jsonable_encoder pass over the content.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+def to_columns(rows: list[dict]) -> dict[str, list]:
+    """
+    Transposes the rows of one table, which share their columns and column order.
+    """
+    if not rows:
+        return {}
+    return {name: [row[name] for row in rows] for name in rows[0]}
+
+def apply_layout(data: dict, layout: Optional[str]) -> dict:
+    """
+    Returns the tables of a data response in the given layout.
+    """
+    if layout in (None, "rows"):
+        return data
+    return {name: to_columns(rows) for name, rows in data.items()}
+
+def check_layout(layout: str):
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout '{layout}', expected one of {', '.join(LAYOUTS)}")
@@ -0,0 +1,371 @@
+import re
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Iterator, Optional, Type, Union, get_args, get_origin
+
+import pandas as pd
+from peewee import Model
+from pydantic import BaseModel
+
+import models
+import schemas
+from services import gc_bias
+
+def extract_read_id(sample_name: str) -> str:
+    """
+    Extracts the read from a sample name like "CAP41WGS_MO026-preflight-R1", or "" if it has none.
+    """
+    match = re.search(r"-preflight-(R\d+)$", sample_name)
+    return match.group(1) if match else ""
+
+def normalize_key(key: str) -> str:
+    """
+    Converts a single column header to snake_case.
+    Handles headers that might be in UPPERCASE_WITH_UNDERSCORES or PascalCase.
+    """
+    # First, handle the 'X' suffix specifically for numeric contexts (e.g., 1X, 10X)
+    # Convert '1X' to '1x' directly, without adding an underscore
+    temp_key = re.sub(r'(\d+)X', r'\1x', key)
+
+    # Determine if the key is predominantly ALL_CAPS_WITH_UNDERSCORES
+    if re.fullmatch(r'[A-Z0-9_]+', temp_key):
+        snake_case_key = temp_key.lower()
+    else:
+        # Otherwise, assume it's PascalCase or camelCase and convert
+        s1 = re.sub(r'(.)([A-Z][a-z]+)', r'\1_\2', temp_key)
+        snake_case_key = re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
+
+    # Clean up any multiple underscores and leading/trailing underscores
+    snake_case_key = re.sub(r'_{2,}', '_', snake_case_key)
+    return snake_case_key.strip('_')
+
+def _present(values: pd.Series) -> pd.Series:
+    """
+    Marks cells holding a value; blank strings count as missing.
+    """
+    present = values.notna()
+    if values.dtype == object or isinstance(values.dtype, pd.StringDtype):
+        present &= values.astype("string").str.strip().ne("").fillna(False)
+    return present
+
+def _to_int(values: pd.Series) -> pd.Series:
+    numbers = pd.to_numeric(values, errors="coerce")
+    # Non-integral values are invalid rather than truncated.
+    return numbers.where(numbers.isna() | (numbers % 1 == 0)).astype("Int64")
+
+def _to_float(values: pd.Series) -> pd.Series:
+    return pd.to_numeric(values, errors="coerce").astype("Float64")
+
+def _to_str(values: pd.Series) -> pd.Series:
+    return values.astype("string").str.strip()
+
+def _to_date(values: pd.Series) -> pd.Series:
+    parsed = pd.to_datetime(values, errors="coerce", format="ISO8601")
+    return parsed.dt.date.where(parsed.notna(), None)
+
+def _passthrough(values: pd.Series) -> pd.Series:
+    return values
+
+# Column-wise converters by schema type. Each returns the column with unconvertible cells missing.
+_CONVERTERS = {int: _to_int, float: _to_float, str: _to_str, date: _to_date}
+
+# Ingest stages timed per sheet.
+INGEST_STAGES = ("read", "normalize", "validate", "write")
+
+class SheetReport:
+    """
+    Collects the per-stage timings of one sheet and the cells that failed
+    coercion, keeping the first `limit` in full and counting the rest.
+    """
+
+    def __init__(self, sheet_name: str, limit: int = 100):
+        self.sheet_name = sheet_name
+        self.limit = limit
+        self.count = 0
+        self.errors: list[dict] = []
+        self.timings = dict.fromkeys(INGEST_STAGES, 0.0)
+
+    @contextmanager
+    def timed(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - started
+
+    def add(self, row: int, column: str, value: Any, message: str):
+        self.count += 1
+        if len(self.errors) < self.limit:
+            self.errors.append({
+                "sheet": self.sheet_name,
+                "row": row,
+                "column": column,
+                "value": None if pd.isna(value) else str(value),
+                "error": message,
+            })
+
+    def add_cells(self, mask: pd.Series, values: pd.Series, row_offset: int, column: str, message: str):
+        """
+        Records every cell selected by mask. Rows are numbered as in the source
+        file: the header is row 1, so the first data row is row 2.
+        """
+        for position in mask.to_numpy().nonzero()[0]:
+            self.add(row_offset + int(position) + 2, column, values.iloc[position], message)
+
+    def stage_seconds(self) -> dict:
+        return {stage: round(seconds, 4) for stage, seconds in self.timings.items()}
+
+def _field_type(annotation: Any) -> Any:
+    """
+    Unwraps Optional[X] to X.
+    """
+    if get_origin(annotation) is Union:
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+@dataclass(frozen=True)
+class SheetSpec:
+    """
+    Describes how one sheet (or CSV) maps onto a table.
+
+    `columns` maps source headers that can't be derived by normalization to
+    schema fields. `prepare` is an optional hook run on the raw frame, for
+    vectorized clean-up of source columns. `derive` is an optional hook run on
+    the coerced frame to compute fields. `collect` optionally folds the
+    validated row batches into the records stored in `model`, for sheets that
+    don't map one row to one record.
+    """
+    name: str
+    model: Type[Model]
+    schema: Type[BaseModel]
+    columns: dict[str, str] = field(default_factory=dict)
+    aliases: tuple[str, ...] = ()
+    derive: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None
+    prepare: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None
+    collect: Optional[Callable[[Iterator[list[dict]]], Iterator[list[dict]]]] = None
+
+@dataclass(frozen=True)
+class SheetPlan:
+    """
+    A compiled header mapping and type-coercion plan for one header signature.
+    Each entry is (field name, source column index, source header, converter).
+    """
+    spec: SheetSpec
+    columns: tuple[tuple[str, int, str, Callable[[pd.Series], pd.Series]], ...]
+    unmapped: tuple[str, ...]
+
+    def coerce(self, df: pd.DataFrame, report: SheetReport, row_offset: int = 0) -> pd.DataFrame:
+        """
+        Coerces every mapped column to its schema type in one vectorized pass,
+        recording cells that can't be converted in the report and leaving them empty.
+        Rows missing a required field are reported and dropped.
+        """
+        out = pd.DataFrame(index=df.index)
+        for name, index, header, convert in self.columns:
+            values = df.iloc[:, index]
+            present = _present(values)
+            coerced = convert(values)
+            invalid = present & coerced.isna()
+            if invalid.any():
+                report.add_cells(invalid, values, row_offset, header, f"expected {_type_name(self.spec, name)}")
+            out[name] = coerced.where(present, None) if convert is _to_date else coerced.where(present)
+        if self.spec.derive is not None:
+            out = self.spec.derive(out)
+
+        missing = pd.Series(False, index=out.index)
+        for name, info in self.spec.schema.model_fields.items():
+            if name not in out:
+                out[name] = info.default if not info.is_required() else None
+            elif not info.is_required() and info.default is not None:
+                out[name] = out[name].fillna(info.default)
+            if info.is_required():
+                absent = out[name].isna()
+                if absent.any():
+                    header = next((header for field_name, _, header, _ in self.columns if field_name == name), name)
+                    report.add_cells(absent, out[name], row_offset, header, "missing required value")
+                    missing |= absent
+        return out.loc[~missing, list(self.spec.schema.model_fields)]
+
+SHEET_REGISTRY: dict[str, SheetSpec] = {}
+
+def register_sheet(spec: SheetSpec) -> SheetSpec:
+    for sheet_name in (spec.name, *spec.aliases):
+        SHEET_REGISTRY[sheet_name] = spec
+    return spec
+
+def get_sheet_spec(sheet_name: str) -> Optional[SheetSpec]:
+    return SHEET_REGISTRY.get(sheet_name)
+
+def resolve_field(spec: SheetSpec, header: str) -> Optional[str]:
+    """
+    Resolves a source header to a schema field, or None if it has no target.
+    """
+    fields = spec.schema.model_fields
+    if header in spec.columns:
+        return spec.columns[header]
+    for candidate in (header, header.replace('.', '_')):
+        if candidate in fields:
+            return candidate
+        if candidate.lower() in fields:
+            return candidate.lower()
+    normalized = normalize_key(header.replace('.', '_'))
+    return normalized if normalized in fields else None
+
+@lru_cache(maxsize=256)
+def compile_plan(sheet_name: str, headers: tuple[str, ...]) -> SheetPlan:
+    """
+    Compiles the column mapping and converters for a sheet's header signature.
+    Results are cached, so repeated uploads of the same layout skip this work.
+    """
+    spec = SHEET_REGISTRY[sheet_name]
+    fields = spec.schema.model_fields
+    columns = []
+    unmapped = []
+    claimed = set()
+    for index, header in enumerate(headers):
+        target = resolve_field(spec, header)
+        # The first header mapped to a field wins, so 'Sample' takes priority over Picard's empty 'SAMPLE'.
+        if target is None or target in claimed:
+            unmapped.append(header)
+            continue
+        claimed.add(target)
+        converter = _CONVERTERS.get(_field_type(fields[target].annotation), _passthrough)
+        columns.append((target, index, header, converter))
+    return SheetPlan(spec=spec, columns=tuple(columns), unmapped=tuple(unmapped))
+
+def _type_name(spec: SheetSpec, field_name: str) -> str:
+    field_type = _field_type(spec.schema.model_fields[field_name].annotation)
+    return {int: "integer", float: "number", str: "text", date: "date"}.get(field_type, "value")
+
+def _to_records(df: pd.DataFrame) -> list[dict]:
+    # Converting column-wise to plain Python values is much faster than DataFrame.to_dict("records").
+    names = list(df.columns)
+    columns = [df[name].to_numpy(dtype=object, na_value=None).tolist() for name in names]
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+def build_rows(spec: SheetSpec, df: pd.DataFrame, report: SheetReport = None, row_offset: int = 0) -> list[dict]:
+    """
+    Maps and validates a frame with the compiled plan for its headers and returns its rows.
+    """
+    report = report if report is not None else SheetReport(spec.name)
+    with report.timed("normalize"):
+        if spec.prepare is not None:
+            df = spec.prepare(df)
+        plan = compile_plan(spec.name, tuple(str(column) for column in df.columns))
+    with report.timed("validate"):
+        df = plan.coerce(df.reset_index(drop=True), report, row_offset)
+    with report.timed("normalize"):
+        return _to_records(df)
+
+def parse_frames(spec: SheetSpec, frames: Iterable[pd.DataFrame], report: SheetReport = None) -> Iterator[list[dict]]:
+    """
+    Yields the records to store for each frame of a sheet, applying the spec's collect hook.
+    Validation errors and stage timings from every frame go to report.
+    """
+    report = report if report is not None else SheetReport(spec.name)
+
+    def batches():
+        row_offset = 0
+        frame_iter = iter(frames)
+        while True:
+            with report.timed("read"):
+                df = next(frame_iter, None)
+            if df is None:
+                return
+            yield build_rows(spec, df, report, row_offset)
+            row_offset += len(df)
+
+    rows = batches()
+    if spec.collect is not None:
+        rows = spec.collect(rows)
+    yield from rows
+
+def _derive_screen(df: pd.DataFrame) -> pd.DataFrame:
+    sample_names = df["sample_r1r2"]
+    df["sample"] = sample_names.str.replace(r"-preflight-R\d+$", "", regex=True)
+    df["read"] = sample_names.str.extract(r"-preflight-(R\d+)$", expand=False).fillna("")
+    return df
+
+# fastp metrics reported as "before|after" filtering pairs.
+FASTP_PAIRED_FIELDS = (
+    "total_reads", "total_bases", "q20_bases", "q30_bases", "q20_rate", "q30_rate",
+    "read1_mean_length", "read2_mean_length", "gc_content",
+    "read1_total_reads", "read1_total_bases", "read1_q20_bases", "read1_q30_bases",
+    "read2_total_reads", "read2_total_bases", "read2_q20_bases", "read2_q30_bases",
+)
+
+def split_fastp_pairs(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Splits each "before|after" column into the after-filtering value, kept under
+    the column's name, and the before-filtering value in '<column>_before'.
+    A value without a '|' is taken as the after-filtering value.
+    """
+    df = df.copy()
+    for column in df.columns:
+        if str(column).replace('.', '_') not in FASTP_PAIRED_FIELDS:
+            continue
+        parts = df[column].astype("string").str.strip().str.split("|", n=1, expand=True)
+        if parts.shape[1] == 1:
+            parts[1] = pd.NA
+        paired = parts[1].notna()
+        df[f"{column}_before"] = pd.to_numeric(parts[0].where(paired), errors="coerce", dtype_backend="numpy_nullable")
+        df[column] = pd.to_numeric(parts[1].where(paired, parts[0]), errors="coerce", dtype_backend="numpy_nullable")
+    return df
+
+
+REPORTED_AGES = register_sheet(SheetSpec(
+    name="reportedAges",
+    model=models.ReportedAges,
+    schema=schemas.ReportedAgesSchema,
+    columns={
+        "Sample": "sample",
+        "sampleDate": "sample_date",
+        "menopausalStatus": "menopausal_status",
+        "WBC": "wbc",
+        "adjOvary(menopause)": "adj_ovary_menopause",
+        "adjOvary(noMenopause)": "adj_ovary_no_menopause",
+    },
+    aliases=("raw_reportedAges",),
+))
+
+register_sheet(SheetSpec(
+    name="bsrate",
+    model=models.BsRate,
+    schema=schemas.BsRateSchema,
+    columns={"pUC19vector": "puc19vector", "λ-DNA(ConversionRate)": "lambda_dna_conversion_rate"},
+))
+register_sheet(SheetSpec(name="coverage", model=models.Coverage, schema=schemas.CoverageSchema))
+register_sheet(SheetSpec(name="fastp", model=models.Fastp, schema=schemas.FastpSchema, prepare=split_fastp_pairs))
+register_sheet(SheetSpec(name="markdup.markdup.txt", model=models.Markdup, schema=schemas.MarkdupSchema))
+register_sheet(SheetSpec(
+    name="picard.alignmentSummary.txt",
+    model=models.PicardAlignmentSummary,
+    schema=schemas.PicardAlignmentSummarySchema,
+))
+register_sheet(SheetSpec(
+    name="picard.gcBias.txt",
+    model=models.PicardGcBias,
+    schema=schemas.PicardGcBiasSchema,
+    aliases=("picard.gcBias",),
+    collect=gc_bias.collect_curves,
+))
+register_sheet(SheetSpec(
+    name="picard.gcBiasSummary.txt",
+    model=models.PicardGcBiasSummary,
+    schema=schemas.PicardGcBiasSummarySchema,
+))
+register_sheet(SheetSpec(name="picard.hs.txt", model=models.PicardHs, schema=schemas.PicardHsSchema))
+register_sheet(SheetSpec(name="picard.insertSize.txt", model=models.PicardInsertSize, schema=schemas.PicardInsertSizeSchema))
+register_sheet(SheetSpec(name="picard.qualityYield.txt", model=models.PicardQualityYield, schema=schemas.PicardQualityYieldSchema))
+register_sheet(SheetSpec(
+    name="screen",
+    model=models.Screen,
+    schema=schemas.ScreenSchema,
+    columns={"Sample": "sample_r1r2", "Human": "human", "λ-DNA": "lambda_dna", "Human_unmap": "human_unmap"},
+    derive=_derive_screen,
+))
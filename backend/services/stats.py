@@ -0,0 +1,244 @@
+import json
+import math
+import os
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from services import filters
+
+load_dotenv()
+
+# Relative accuracy of quantiles read from a sketch: 0.01 means within 1% of the true value.
+STATS_RELATIVE_ACCURACY = float(os.getenv("STATS_RELATIVE_ACCURACY", "0.01"))
+
+DEFAULT_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+DEFAULT_BINS = 20
+MAX_BINS = 1000
+
+_GAMMA = (1 + STATS_RELATIVE_ACCURACY) / (1 - STATS_RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+def _bucket_value(index: int) -> float:
+    # Every value in bucket i lies in (gamma^(i-1), gamma^i]; this is within the accuracy of all of them.
+    return 2 * _GAMMA ** index / (_GAMMA + 1)
+
+def _count_buckets(buckets: dict, magnitudes: np.ndarray, sign: int):
+    if not len(magnitudes):
+        return
+    indexes, counts = np.unique(np.ceil(np.log(magnitudes) / _LOG_GAMMA).astype(np.int64), return_counts=True)
+    for index, count in zip(indexes.tolist(), counts.tolist()):
+        total = buckets.get(index, 0) + sign * count
+        if total:
+            buckets[index] = total
+        else:
+            buckets.pop(index, None)
+
+class Sketch:
+    """
+    Distribution summary of one numeric column that values can be added to and
+    removed from, so ingest keeps it current from the rows it writes:
+      - count and moments about a fixed shift (exact mean and stddev)
+      - min and max, marked stale when a removed value was one of them
+      - a log-bucketed quantile sketch (DDSketch): each bucket counts values within
+        STATS_RELATIVE_ACCURACY of one another, so quantiles keep that relative error
+    """
+
+    def __init__(self, state: Optional[dict] = None):
+        state = state or {}
+        self.shift = state.get("shift")
+        self.count = state.get("count", 0)
+        self.total = state.get("total", 0.0)
+        self.total_sq = state.get("total_sq", 0.0)
+        self.min = state.get("min")
+        self.max = state.get("max")
+        self.stale = state.get("stale", False)
+        self.zeros = state.get("zeros", 0)
+        self.positive = {int(index): count for index, count in state.get("positive", {}).items()}
+        self.negative = {int(index): count for index, count in state.get("negative", {}).items()}
+
+    @classmethod
+    def loads(cls, text: str) -> "Sketch":
+        return cls(json.loads(text))
+
+    def dumps(self) -> str:
+        return json.dumps({
+            "shift": self.shift, "count": self.count, "total": self.total, "total_sq": self.total_sq,
+            "min": self.min, "max": self.max, "stale": self.stale, "zeros": self.zeros,
+            "positive": self.positive, "negative": self.negative,
+        }, separators=(",", ":"))
+
+    def _update(self, values: np.ndarray, sign: int):
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        if self.shift is None:
+            self.shift = float(values[0])
+        shifted = values - self.shift
+        self.count += sign * len(values)
+        self.total += sign * float(shifted.sum())
+        self.total_sq += sign * float((shifted * shifted).sum())
+        self.zeros += sign * int((values == 0).sum())
+        _count_buckets(self.positive, values[values > 0], sign)
+        _count_buckets(self.negative, -values[values < 0], sign)
+
+    def add(self, values: np.ndarray):
+        self._update(values, 1)
+        values = values[~np.isnan(values)]
+        if len(values):
+            low, high = float(values.min()), float(values.max())
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+
+    def remove(self, values: np.ndarray):
+        self._update(values, -1)
+        values = values[~np.isnan(values)]
+        if self.count == 0:
+            self.__init__()
+        elif len(values) and (values.min() <= self.min or values.max() >= self.max):
+            self.stale = True
+
+    def mean(self) -> Optional[float]:
+        return self.shift + self.total / self.count if self.count else None
+
+    def stddev(self) -> Optional[float]:
+        if not self.count:
+            return None
+        mean = self.total / self.count
+        return math.sqrt(max(self.total_sq / self.count - mean * mean, 0.0))
+
+    def _buckets(self) -> list[tuple[float, int]]:
+        """
+        Returns (value, count) for every bucket, in value order.
+        """
+        buckets = [(-_bucket_value(index), count) for index, count in sorted(self.negative.items(), reverse=True)]
+        if self.zeros:
+            buckets.append((0.0, self.zeros))
+        buckets.extend((_bucket_value(index), count) for index, count in sorted(self.positive.items()))
+        return buckets
+
+    def quantiles(self, qs: list[float]) -> list[Optional[float]]:
+        if not self.count:
+            return [None] * len(qs)
+        values, counts = zip(*self._buckets())
+        cumulative = np.cumsum(counts)
+        ranks = np.asarray(qs) * (self.count - 1)
+        found = np.searchsorted(cumulative, ranks, side="right").clip(0, len(values) - 1)
+        return [min(max(values[i], self.min), self.max) for i in found.tolist()]
+
+    def histogram(self, bins: int) -> tuple[list[float], list[int]]:
+        if not self.count:
+            return [], []
+        values, counts = zip(*self._buckets())
+        values = np.clip(values, self.min, self.max)
+        counts, edges = np.histogram(values, bins=bins, range=(self.min, self.max), weights=counts)
+        return edges.tolist(), counts.astype(np.int64).tolist()
+
+def numeric_columns(model) -> list[str]:
+    """
+    Returns the catalogued numeric columns of a metric table.
+    """
+    return [field.name for field in filters.numeric_fields(model)]
+
+def _as_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+def to_array(values: list) -> np.ndarray:
+    """
+    Returns column values (or rows of them) as floats. None and text a sheet
+    stored in a numeric column (e.g. fastp's per-base counts) become NaN, which
+    the sketches and summaries skip.
+    """
+    try:
+        return np.array(values, dtype=float)
+    except (TypeError, ValueError):
+        return np.vectorize(_as_float, otypes=[float])(np.array(values, dtype=object))
+
+class TableStats:
+    """
+    The sketches of one table's numeric columns, updated from the rows ingest writes.
+    """
+
+    def __init__(self, model, sketches: dict[str, Sketch]):
+        self.model = model
+        self.sketches = sketches
+        self.key_names = [field.name for field in model._meta.get_primary_keys()]
+
+    def columns(self, rows: list[dict]) -> list[str]:
+        """
+        Returns the sketched columns the rows set.
+        """
+        return [name for name in rows[0] if name in self.sketches] if rows else []
+
+    def update(self, rows: list[dict], columns: list[str], existing: dict[tuple, tuple]):
+        """
+        Replaces the stored values of rows already in the table (`existing`, by
+        primary key, in `columns` order) with the rows' new values.
+        """
+        # A key repeated within the rows is stored once, with its last values.
+        rows = list({tuple(row[name] for name in self.key_names): row for row in rows}.values())
+        old_values = list(existing.values())
+        for position, name in enumerate(columns):
+            sketch = self.sketches[name]
+            if old_values:
+                sketch.remove(to_array([values[position] for values in old_values]))
+            sketch.add(to_array([row[name] for row in rows]))
+
+def summarize(sketch: Sketch, qs: list[float], bins: int) -> dict:
+    """
+    Summarizes a column from its sketch: exact count, min, max, mean and stddev;
+    quantiles and histogram within STATS_RELATIVE_ACCURACY.
+    """
+    edges, counts = sketch.histogram(bins)
+    return {
+        "count": sketch.count,
+        "min": sketch.min,
+        "max": sketch.max,
+        "mean": sketch.mean(),
+        "stddev": sketch.stddev(),
+        "quantiles": dict(zip(map(str, qs), sketch.quantiles(qs))),
+        "histogram": {"edges": edges, "counts": counts},
+        "exact": False,
+    }
+
+def summarize_values(values: np.ndarray, qs: list[float], bins: int) -> dict:
+    """
+    Summarizes a column exactly from its values.
+    """
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return {
+            "count": 0, "min": None, "max": None, "mean": None, "stddev": None,
+            "quantiles": {str(q): None for q in qs}, "histogram": {"edges": [], "counts": []}, "exact": True,
+        }
+    counts, edges = np.histogram(values, bins=bins)
+    return {
+        "count": int(len(values)),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+        "stddev": float(values.std()),
+        "quantiles": dict(zip(map(str, qs), np.quantile(values, qs).tolist())),
+        "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+        "exact": True,
+    }
+
+def parse_request(quantiles: Optional[str], bins: int) -> list[float]:
+    """
+    Checks a stats request's bins and returns its quantiles.
+    """
+    if not 1 <= bins <= MAX_BINS:
+        raise ValueError(f"bins must be between 1 and {MAX_BINS}")
+    if quantiles is None:
+        return DEFAULT_QUANTILES
+    try:
+        qs = [float(q) for q in quantiles.split(",") if q.strip()]
+    except ValueError:
+        raise ValueError(f"Invalid quantiles '{quantiles}'")
+    if not qs or any(not 0 <= q <= 1 for q in qs):
+        raise ValueError("quantiles must be between 0 and 1")
+    return qs
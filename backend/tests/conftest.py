@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app reads DATABASE_URL when database.py is imported, so every test shares
+# one throwaway database; tests use their own sample ids and user names.
+os.environ["DATABASE_URL"] = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient
+
+import crud
+import main
+from auth import get_password_hash
+import schemas
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+@pytest.fixture(scope="session")
+def login(client):
+    def login(username: str, is_admin: bool = False) -> dict:
+        """
+        Creates an approved user and returns the headers of a request made as them.
+        """
+        password = "password12345"
+        user = crud.get_user_by_username(username)
+        if user is None:
+            user = crud.create_user(schemas.UserCreate(username=username, email=f"{username}@example.com", password=password),
+                                    get_password_hash(password))
+        user.status = "approved"
+        user.is_admin = is_admin
+        user.save()
+        token = client.post("/api/v1/auth/token", data={"username": username, "password": password}).json()["access_token"]
+        return {"Authorization": f"Bearer {token}"}
+    return login
@@ -0,0 +1,20 @@
+DEFINITION = {"op": "samples", "samples": ["TEST_COHORT_01"]}
+
+def test_only_owner_or_admin_can_change_a_cohort(client, login):
+    owner = login("cohort_owner")
+    other = login("cohort_other")
+    admin = login("cohort_admin", is_admin=True)
+
+    assert client.put("/api/v1/cohorts/owned", json=DEFINITION, headers=owner).status_code == 200
+
+    assert client.put("/api/v1/cohorts/owned", json=DEFINITION, headers=other).status_code == 403
+    assert client.post("/api/v1/cohorts/owned/refresh", headers=other).status_code == 403
+    assert client.delete("/api/v1/cohorts/owned", headers=other).status_code == 403
+    assert client.get("/api/v1/cohorts/owned", headers=other).json()["owner"] == "cohort_owner"
+
+    assert client.put("/api/v1/cohorts/owned", json=DEFINITION, headers=owner).status_code == 200
+    response = client.put("/api/v1/cohorts/owned", json=DEFINITION, headers=admin)
+    assert response.status_code == 200
+    assert response.json()["owner"] == "cohort_owner"
+    assert client.delete("/api/v1/cohorts/owned", headers=admin).status_code == 200
+    assert client.get("/api/v1/cohorts/owned", headers=owner).status_code == 404
@@ -0,0 +1,19 @@
+import crud
+import models
+import schemas
+from database import db
+
+def filter_samples(field: str, value) -> list[str]:
+    criteria = schemas.FilterSchema(filters=[{"field": field, "operator": ">", "value": value}], logical_operators=[])
+    return crud.get_filtered_samples(criteria)
+
+def test_filter_on_shared_column_reads_its_own_table(client):
+    # total_bases is in both Fastp and PicardQualityYield; sample_wide falls back to
+    # the Fastp value for a sample without a PicardQualityYield row.
+    with db.atomic():
+        models.ReportedAges.insert(sample="TEST_FILTER_01").on_conflict_replace().execute()
+        models.Fastp.insert(sample="TEST_FILTER_01", total_bases=10**15).on_conflict_replace().execute()
+        crud.refresh_sample_wide({"TEST_FILTER_01"})
+
+    assert "TEST_FILTER_01" in filter_samples("fastp.total_bases", 10**14)
+    assert "TEST_FILTER_01" not in filter_samples("picardqualityyield.total_bases", 10**14)
@@ -0,0 +1,16 @@
+import crud
+from database import db
+
+def test_ingest_by_another_worker_invalidates_etags(client, login):
+    headers = login("cache_reader")
+    first = client.get("/api/v1/data/initial?limit=1", headers=headers)
+    etag = first.headers["etag"]
+    assert client.get("/api/v1/data/initial?limit=1", headers={**headers, "If-None-Match": etag}).status_code == 304
+
+    # Another worker's ingest only commits a new generation; this process's caches are untouched.
+    with db.atomic():
+        crud.bump_dataset_generation()
+
+    response = client.get("/api/v1/data/initial?limit=1", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
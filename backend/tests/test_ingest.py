@@ -0,0 +1,29 @@
+import models
+from services import file_handler
+
+HEADER = ",Sample,gender,age,sampleDate,menopausalStatus,ptid\n"
+
+def write_ages(path, age: int):
+    path.write_text(HEADER + f"0,TEST_ROLLBACK_01,F,{age},2025-04-16,,PT0001\n")
+    return str(path)
+
+def stored_age() -> int:
+    return models.ReportedAges.get(models.ReportedAges.sample == "TEST_ROLLBACK_01").age
+
+def test_reupload_of_earlier_version_rolls_back(client, tmp_path):
+    first = write_ages(tmp_path / "A.csv", 45)
+    second = write_ages(tmp_path / "B.csv", 99)
+
+    file_handler.ingest_file("A.csv", first)
+    assert stored_age() == 45
+    file_handler.ingest_file("B.csv", second)
+    assert stored_age() == 99
+
+    stats = file_handler.ingest_file("A.csv", first)
+    assert stats and stats[0]["rows_written"] == 1
+    assert stored_age() == 45
+
+def test_reupload_of_last_file_is_skipped(client, tmp_path):
+    path = write_ages(tmp_path / "C.csv", 50)
+    file_handler.ingest_file("C.csv", path)
+    assert file_handler.ingest_file("C.csv", path) == []
@@ -25,13 +25,16 @@ interface SidebarProps {
 
 const FILTERABLE_COLUMNS = {
   "age": "Age",
+  "total_reads": "Total Reads",
   "total_bases": "Total Bases",
   "puc19vector": "pUC19 Vector",
   "lambda_dna_conversion_rate": "Lambda DNA Conversion Rate",
   "human": "Human",
   "lambda_dna": "Lambda DNA",
   "pUC19": "pUC19",
+  "q20_rate": "Q20 Rate",
   "q30_rate": "Q30 Rate",
+  "gc_content": "GC Content",
   "mean_insert_size": "Mean Insert Size",
   "percent_duplication": "Percent Duplication",
   "pct_selected_bases": "Pct Selected Bases",
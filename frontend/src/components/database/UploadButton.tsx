@@ -1,7 +1,7 @@
 import React, { useRef } from "react";
 import { Button } from "@/components/ui/button";
 import { Upload } from "lucide-react";
-import { uploadData } from "@/services/api";
+import { uploadData, waitForJob } from "@/services/api";
 import { toast } from "sonner";
 import { useMutation } from "@tanstack/react-query";
 import { useAuth } from "@/context/AuthContext"; // Import useAuth
@@ -19,10 +19,24 @@ const UploadButton: React.FC<UploadButtonProps> = ({ onUploadSuccess }) => {
       if (!token) {
         throw new Error("No authentication token found. Please log in.");
       }
-      return uploadData(file, token); // Pass token to uploadData
+      const queued = await uploadData(file, token); // Pass token to uploadData
+      toast.info(queued.message || "File queued for processing");
+      const job = await waitForJob(queued.job_id, token);
+      if (job.status === "failed") {
+        throw new Error(job.error || "Ingestion failed.");
+      }
+      return job;
     },
-    onSuccess: (data) => {
-      toast.success(data.message || "File uploaded successfully!");
+    onSuccess: (job) => {
+      if (job.skipped) {
+        toast.info(`${job.filename}: already ingested, nothing to do`);
+      } else {
+        const written = job.sheets.reduce((sum, sheet) => sum + (sheet.rows_written ?? 0), 0);
+        toast.success(`${job.filename}: ${job.rows} rows read, ${written} changed, in ${job.seconds ?? 0}s`);
+        if (job.invalid_cells > 0) {
+          toast.warning(`${job.invalid_cells} invalid cells were stored as empty; see the job report for details.`);
+        }
+      }
       onUploadSuccess();
       if (fileInputRef.current) fileInputRef.current.value = "";
     },
@@ -54,11 +68,11 @@ const UploadButton: React.FC<UploadButtonProps> = ({ onUploadSuccess }) => {
         ref={fileInputRef}
         onChange={handleFileChange}
         style={{ display: "none" }}
-        accept=".csv,.xlsx"
+        accept=".csv,.xlsx,.zip"
       />
       <Button onClick={handleUploadClick} disabled={uploadMutation.isPending || !isAuthenticated}>
         <Upload className="mr-2 h-4 w-4" />
-        {uploadMutation.isPending ? "Uploading..." : "Upload Data"}
+        {uploadMutation.isPending ? "Processing..." : "Upload Data"}
       </Button>
     </div>
   );
@@ -30,21 +30,12 @@ const DatabasePage = () => {
     refetch,
   } = useInfiniteQuery<PaginatedFilterResponse, Error>({
     queryKey: ["cohortData"],
-    queryFn: async ({ pageParam = 0 }) => {
+    queryFn: async ({ pageParam }) => {
       if (!token) throw new Error("No token found");
-      return getInitialData(pageParam as number, PAGE_SIZE, token)
+      return getInitialData(pageParam as string | null, PAGE_SIZE, token)
     },
-    getNextPageParam: (lastPage, allPages) => {
-      const loadedCount = allPages.reduce((acc, page) => {
-        const tableNames = Object.keys(page.data);
-        if (tableNames.length > 0) {
-          return acc + page.data[tableNames[0]].length;
-        }
-        return acc;
-      }, 0);
-      return loadedCount < lastPage.total_count ? allPages.length * PAGE_SIZE : undefined;
-    },
-    initialPageParam: 0,
+    getNextPageParam: (lastPage) => lastPage.next_cursor ?? undefined,
+    initialPageParam: null,
   });
 
   useEffect(() => {
@@ -5,6 +5,53 @@ const API_BASE_URL = "http://172.20.8.24:8088/api/v1";
 
 export interface UploadResponse {
   message: string;
+  job_id: string;
+  status: string;
+}
+
+export interface ValidationError {
+  sheet: string;
+  row: number;
+  column: string;
+  value: string | null;
+  error: string;
+}
+
+export interface SheetProgress {
+  sheet: string;
+  status: "pending" | "running" | "done" | "failed";
+  rows: number;
+  rows_written?: number;
+  rows_skipped?: number;
+  rows_new?: number;
+  rows_updated?: number;
+  skipped?: boolean;
+  invalid_cells?: number;
+  stages?: Record<"read" | "normalize" | "validate" | "write", number>;
+  errors?: ValidationError[];
+  table?: string;
+  seconds?: number;
+  rows_per_second?: number;
+  error?: string;
+}
+
+export interface IngestJob {
+  id: string;
+  filename: string;
+  status: "queued" | "running" | "succeeded" | "failed";
+  dry_run: boolean;
+  skipped: boolean;
+  created_at: string;
+  started_at: string | null;
+  finished_at: string | null;
+  seconds: number | null;
+  current_sheet: string | null;
+  sheets_done: number;
+  sheets_total: number;
+  rows: number;
+  invalid_cells: number;
+  sheets: SheetProgress[];
+  error: string | null;
 }
 
 export interface Filter {
@@ -13,9 +60,18 @@ export interface Filter {
   value: string | number;
 }
 
+export interface FilterNode {
+  op: "and" | "or" | "not" | ">=" | "<=" | ">" | "<" | "==" | "in" | "between" | "is_null";
+  args?: FilterNode[];
+  field?: string;
+  value?: number;
+  values?: number[];
+}
+
 export interface FilterCriteria {
   filters: Filter[];
   logical_operators: ("and" | "or")[];
+  where?: FilterNode;
 }
 
 export interface PaginatedFilterResponse {
@@ -23,6 +79,7 @@ export interface PaginatedFilterResponse {
     [tableName: string]: Record<string, unknown>[];
   };
   total_count: number;
+  next_cursor: string | null;
 }
 
 export interface FilterResponse {
@@ -65,9 +122,36 @@ export async function uploadData(file: File, token: string): Promise<UploadRespo
   }
 }
 
-export async function getInitialData(offset: number = 0, limit: number = 20, token: string): Promise<PaginatedFilterResponse> {
+export async function getJob(jobId: string, token: string): Promise<IngestJob> {
+  const response = await fetch(`${API_BASE_URL}/jobs/${jobId}`, {
+    method: "GET",
+    headers: {
+      "Authorization": `Bearer ${token}`,
+    },
+  });
+
+  if (!response.ok) {
+    const errorData = await response.json();
+    throw new Error(errorData.detail || "Failed to fetch job status.");
+  }
+
+  return response.json();
+}
+
+export async function waitForJob(jobId: string, token: string, intervalMs: number = 1000): Promise<IngestJob> {
+  for (;;) {
+    const job = await getJob(jobId, token);
+    if (job.status === "succeeded" || job.status === "failed") {
+      return job;
+    }
+    await new Promise((resolve) => setTimeout(resolve, intervalMs));
+  }
+}
+
+export async function getInitialData(cursor: string | null, limit: number = 20, token: string): Promise<PaginatedFilterResponse> {
+  const cursorQuery = cursor ? `&cursor=${encodeURIComponent(cursor)}` : "";
   try {
-    const response = await fetch(`${API_BASE_URL}/data/initial?offset=${offset}&limit=${limit}`, {
+    const response = await fetch(`${API_BASE_URL}/data/initial?limit=${limit}&view=summary${cursorQuery}`, {
       method: "GET",
       headers: {
         "Authorization": `Bearer ${token}`,
@@ -112,7 +196,7 @@ export async function downloadData(samples: string[], token: string): Promise<Bl
 
 export async function filterData(filters: FilterCriteria, token: string): Promise<FilterResponse> {
   try {
-    const response = await fetch(`${API_BASE_URL}/data/filter`, {
+    const response = await fetch(`${API_BASE_URL}/data/filter?view=summary`, {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
@@ -139,7 +223,7 @@ export async function searchData(searchTerm: string, token: string): Promise<Fil
   formData.append("search_term", searchTerm);
 
   try {
-    const response = await fetch(`${API_BASE_URL}/data/search`, {
+    const response = await fetch(`${API_BASE_URL}/data/search?view=summary`, {
       method: "POST",
       headers: {
         "Authorization": `Bearer ${token}`,
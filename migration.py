@@ -1,7 +1,14 @@
 from peewee import *
 from playhouse.migrate import *
-from backend.database import db
-from backend.models import Screen
+import pandas as pd
+from backend.models import Screen, Fastp, PicardAlignmentSummary, PicardGcBias, SampleWide, SampleName, SampleNameIndex, IngestionLedger, SheetLedger, RowLedger, ColumnStats
+from backend.crud import create_sample_name_triggers, rebuild_column_stats, rebuild_sample_names, rebuild_sample_wide
+from backend.services.sheet_registry import FASTP_PAIRED_FIELDS, extract_read_id, split_fastp_pairs
+
+# The models bind to `database.db` (backend/ on the path), which can be a different
+# module object than `backend.database.db`; migrate through the models' connection
+# so schema changes and row updates share one transaction.
+db = Screen._meta.database
 
 def add_sample_r1r2_column():
     with db.atomic():
@@ -25,7 +32,138 @@ def add_sample_r1r2_column():
         else:
             print("'sample_r1r2' column already exists in 'screen' table. Skipping migration.")
 
+def pack_gc_bias_curves():
+    """
+    Replaces the row-per-sample picardgcbias table, which kept only the last GC bin,
+    with the packed one-curve-per-row layout. Re-upload the QC workbook afterwards.
+    """
+    table_name = PicardGcBias._meta.table_name
+    with db.atomic():
+        if db.table_exists(table_name):
+            column_names = [col.name for col in db.get_columns(table_name)]
+            if 'bins' in column_names:
+                print(f"'{table_name}' already stores packed curves. Skipping migration.")
+                return
+            print(f"Dropping per-bin '{table_name}' table...")
+            db.drop_tables([PicardGcBias])
+        db.create_tables([PicardGcBias])
+        forget_ledger(table_name)
+        print(f"'{table_name}' recreated with packed curve columns.")
+
+def forget_ledger(table_name):
+    """
+    Drops the ingestion ledger hashes of a table so the next upload re-ingests its sheet.
+    Uploads are skipped by the hash of the whole file, which covers every sheet, so all
+    file hashes go too.
+    """
+    if db.table_exists(IngestionLedger._meta.table_name):
+        IngestionLedger.delete().execute()
+    if db.table_exists(SheetLedger._meta.table_name):
+        SheetLedger.delete().where(SheetLedger.table_name == table_name).execute()
+    if db.table_exists(RowLedger._meta.table_name):
+        RowLedger.delete().where(RowLedger.table_name == table_name).execute()
+
+def rekey_table(model, key_column, derive_key):
+    """
+    Rebuilds a table keyed on sample alone as a WITHOUT ROWID table keyed on
+    (sample, key_column), deriving the new key column from each existing row.
+    """
+    table_name = model._meta.table_name
+    with db.atomic():
+        if db.table_exists(table_name):
+            column_names = [col.name for col in db.get_columns(table_name)]
+            if key_column in column_names and len(db.get_primary_keys(table_name)) > 1:
+                print(f"'{table_name}' is already keyed on (sample, {key_column}). Skipping migration.")
+                return
+            cursor = db.execute_sql(f'SELECT * FROM "{table_name}"')
+            names = [description[0] for description in cursor.description]
+            rows = [dict(zip(names, values)) for values in cursor.fetchall()]
+            print(f"Rebuilding '{table_name}' keyed on (sample, {key_column})...")
+            db.drop_tables([model])
+        else:
+            rows = []
+        db.create_tables([model])
+        fields = model._meta.fields
+        for row in rows:
+            row[key_column] = derive_key(row)
+        rows = [{name: value for name, value in row.items() if name in fields} for row in rows]
+        for start in range(0, len(rows), 100):
+            model.insert_many(rows[start:start + 100]).on_conflict_replace().execute()
+        forget_ledger(table_name)
+        print(f"'{table_name}' rebuilt with {len(rows)} rows.")
+
+def split_fastp_columns():
+    """
+    Adds the '<field>_before' columns and indexes to 'fastp' and backfills rows
+    still holding raw "before|after" text.
+    """
+    table_name = Fastp._meta.table_name
+    with db.atomic():
+        if not db.table_exists(table_name):
+            Fastp.create_table()
+            return
+        migrator = SchemaMigrator(db)
+        column_names = [col.name for col in db.get_columns(table_name)]
+        for name in FASTP_PAIRED_FIELDS:
+            if f"{name}_before" not in column_names:
+                print(f"Adding '{name}_before' column to '{table_name}' table...")
+                migrate(migrator.add_column(table_name, f"{name}_before", Fastp._meta.fields[f"{name}_before"]))
+        # Creates any missing indexes; the table itself already exists.
+        Fastp.create_table(safe=True)
+
+        has_pair = " OR ".join(f"instr(\"{name}\", '|') > 0" for name in FASTP_PAIRED_FIELDS)
+        columns = ", ".join(f'"{name}"' for name in FASTP_PAIRED_FIELDS)
+        cursor = db.execute_sql(f'SELECT sample, {columns} FROM "{table_name}" WHERE {has_pair}')
+        df = pd.DataFrame(cursor.fetchall(), columns=["sample", *FASTP_PAIRED_FIELDS])
+        if df.empty:
+            print(f"No '{table_name}' rows to backfill. Skipping migration.")
+            return
+        df = split_fastp_pairs(df).astype(object)
+        df = df.where(df.notna(), None)
+        assignments = ", ".join(f'"{name}" = ?, "{name}_before" = ?' for name in FASTP_PAIRED_FIELDS)
+        params = [
+            [value for name in FASTP_PAIRED_FIELDS for value in (row[name], row[f"{name}_before"])] + [row["sample"]]
+            for row in df.to_dict("records")
+        ]
+        db.cursor().executemany(f'UPDATE "{table_name}" SET {assignments} WHERE sample = ?', params)
+        print(f"Backfilled {len(params)} '{table_name}' rows.")
+
+def build_sample_wide():
+    """
+    Creates the sample_wide table and fills it from the metric tables. Ingest keeps
+    it current afterwards; re-running rebuilds it from scratch.
+    """
+    with db.atomic():
+        SampleWide.create_table(safe=True)
+        print(f"Built 'sample_wide' with {rebuild_sample_wide()} samples.")
+
+def build_sample_names():
+    """
+    Creates the sample search tables and indexes the id, ptid and aliases of every
+    sample in sample_wide, so run it after build_sample_wide.
+    """
+    with db.atomic():
+        db.create_tables([SampleName, SampleNameIndex])
+        create_sample_name_triggers()
+        print(f"Indexed {rebuild_sample_names()} sample names for search.")
+
+def build_column_stats():
+    """
+    Creates the column_stats table and sketches every numeric column of the metric
+    tables. Ingest keeps the sketches current afterwards; re-running rebuilds them.
+    """
+    with db.atomic():
+        ColumnStats.create_table(safe=True)
+        print(f"Built column statistics for {rebuild_column_stats()} tables.")
+
 if __name__ == "__main__":
     db.connect()
     add_sample_r1r2_column()
+    pack_gc_bias_curves()
+    rekey_table(Screen, 'read', lambda row: extract_read_id(row.get('sample_r1r2') or ''))
+    rekey_table(PicardAlignmentSummary, 'category', lambda row: row.get('category') or '')
+    split_fastp_columns()
+    build_sample_wide()
+    build_sample_names()
+    build_column_stats()
     db.close()